@@ -4,12 +4,22 @@ import logging
 from . import sparkjob
 from . import lsfsparkjob
 from . import slurmsparkjob
+from . import localsparkjob
 from .lsfsparkjob import LSFSparkJob
 from .slurmsparkjob import SLURMSparkJob
+from .localsparkjob import LocalSparkJob
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 def show_clusters():
-    sparkjob.sparkjob().show_clusters()
\ No newline at end of file
+    sparkjob.sparkjob().show_clusters()
+
+def watch_clusters(interval=2):
+    """Show a live-updating view of the clusters; a widget in IPython, a table in the terminal otherwise"""
+    from . import dashboard
+    if sparkjob.IPYTHON: 
+        return dashboard.widget(sparkjob.sparkjob, interval=interval)
+    else: 
+        dashboard.watch(sparkjob.sparkjob, interval=interval)
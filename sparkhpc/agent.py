@@ -0,0 +1,295 @@
+#
+#
+# Per-user agent that owns scheduler polling and the cluster registry
+#
+# Every SparkJob, `current_clusters()` call and `sparkcluster` invocation
+# normally queries the scheduler on its own. When the agent is running,
+# they ask it over a Unix socket instead and get its cached snapshot back.
+#
+#
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import glob
+import time
+import socket
+import getpass
+import tempfile
+import threading
+import logging
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+logger = logging.getLogger('sparkhpc.agent')
+
+
+def socket_path():
+    """
+    Path of the agent's Unix socket; can be overridden with `SPARKHPC_AGENT_SOCKET`
+
+    The socket lives in a directory only this user can write to: `XDG_RUNTIME_DIR` if
+    it is set, otherwise a private directory in the temporary directory.
+    """
+    if 'SPARKHPC_AGENT_SOCKET' in os.environ:
+        return os.environ['SPARKHPC_AGENT_SOCKET']
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, 'sparkhpc-agent.sock')
+    return os.path.join(tempfile.gettempdir(), 'sparkhpc-%s'%getpass.getuser(), 'agent.sock')
+
+
+def _private(path):
+    """Whether `path` belongs to this user and cannot be replaced by anyone else"""
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        st, dir_st = os.lstat(path), os.stat(directory)
+    except OSError:
+        return False
+    return (st.st_uid == os.getuid() and dir_st.st_uid == os.getuid()
+            and dir_st.st_mode & 0o022 == 0)
+
+
+def _connect(timeout):
+    path = socket_path()
+    if not _private(path):
+        raise RuntimeError('Refusing to talk to the sparkhpc agent at %s: it is not private to this user'%path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(path)
+    return sock
+
+
+def query(cmd, timeout=2, **kwargs):
+    """
+    Send a request to the agent and return its reply
+
+    Returns None if the agent is not running, so callers can fall back
+    to querying the scheduler directly.
+    """
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    if not _private(path):
+        # another user could be serving made-up cluster state
+        logger.warning('Ignoring the sparkhpc agent at %s: it is not private to this user'%path)
+        return None
+
+    request = dict(kwargs, cmd=cmd)
+    try:
+        sock = _connect(timeout)
+        try:
+            sock.sendall((json.dumps(request) + '\n').encode())
+            reply = sock.makefile('r').readline()
+        finally:
+            sock.close()
+    except (socket.error, socket.timeout) as e:
+        logger.debug('agent not reachable: %s'%e)
+        return None
+
+    if not reply:
+        return None
+    reply = json.loads(reply)
+    if 'error' in reply:
+        raise RuntimeError('sparkhpc agent: %s'%reply['error'])
+    return reply['result']
+
+
+def notify(cmd, **kwargs):
+    """
+    Like `query`, for requests that only keep the agent up to date, e.g. after a submission
+
+    The caller goes ahead regardless, so errors are logged instead of raised.
+    """
+    try:
+        return query(cmd, **kwargs)
+    except (RuntimeError, ValueError) as e:
+        logger.warning('unable to update the sparkhpc agent: %s'%e)
+        return None
+
+
+def subscribe():
+    """Generator yielding the job states every time they change, as pushed by the agent"""
+    sock = _connect(None)
+    try:
+        sock.sendall((json.dumps({'cmd': 'subscribe'}) + '\n').encode())
+        for line in sock.makefile('r'):
+            yield json.loads(line)['result']
+    finally:
+        sock.close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        agent = self.server.agent
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                cmd = request['cmd']
+                if cmd == 'subscribe':
+                    agent._serve_subscriber(self.wfile)
+                    return
+                result = agent.handle(cmd, **dict([(str(k), v) for k, v in request.items() if k != 'cmd']))
+                reply = {'result': result}
+            except Exception as e:
+                reply = {'error': '%s: %s'%(e.__class__.__name__, e)}
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Agent(object):
+    """
+    Long-lived per-user process serving cluster state over a Unix socket
+
+    The agent queries the scheduler once every `interval` seconds, keeps the
+    registry of cluster metadata files and pushes state changes to subscribers.
+
+    Supported requests:
+
+    * `states` (job ID -> scheduler state from the latest snapshot)
+    * `refresh` (query the scheduler right away and return the new states)
+    * `submitted` (add the newly submitted `jobids` to the snapshot without querying the scheduler)
+    * `cancelled` (drop the cancelled `jobids` from the snapshot without querying the scheduler)
+    * `clusters` (job IDs of all registered clusters that are known to the scheduler)
+    * `subscribe` (keep the connection open and receive the states on every change)
+    * `shutdown`
+    """
+
+    def __init__(self, sparkjob_class, interval=5):
+        self.sparkjob_class = sparkjob_class
+        self.interval = interval
+        self.states = {}
+        self.registry = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._version = 0
+        self._stopped = threading.Event()
+        self._server = None
+
+    def poll(self):
+        """Take a new snapshot of the scheduler and of the registry"""
+        states = self.sparkjob_class._query_job_states()
+
+        from .sparkjob import home_dir
+        registry = sorted([os.path.basename(f)[9:] for f in glob.glob(os.path.join(home_dir, '.sparkhpc*'))
+                           if re.match(r'\.sparkhpc\d+$', os.path.basename(f))])
+
+        self._update(states, registry)
+        return states
+
+    def _update(self, states, registry):
+        with self._lock:
+            changed = states != self.states
+            self.states, self.registry = states, registry
+
+        if changed:
+            with self._changed:
+                self._version += 1
+                self._changed.notify_all()
+
+    def handle(self, cmd, jobids=()):
+        if cmd == 'states':
+            with self._lock:
+                return dict(self.states)
+        elif cmd == 'refresh':
+            return self.poll()
+        elif cmd in ('submitted', 'cancelled'):
+            # the next poll corrects anything the scheduler does differently
+            with self._lock:
+                states, registry = dict(self.states), list(self.registry)
+            for jobid in jobids:
+                if cmd == 'submitted':
+                    states.setdefault(jobid, 'PEND')
+                    if jobid not in registry:
+                        registry.append(jobid)
+                else:
+                    states.pop(jobid, None)
+            self._update(states, sorted(registry))
+            return states
+        elif cmd == 'clusters':
+            with self._lock:
+                return [jobid for jobid in self.registry if jobid in self.states]
+        elif cmd == 'shutdown':
+            threading.Thread(target=self.stop).start()
+            return True
+        else:
+            raise ValueError('unknown request %s'%cmd)
+
+    def _serve_subscriber(self, wfile):
+        version = -1
+        while not self._stopped.is_set():
+            with self._changed:
+                if version == self._version:
+                    self._changed.wait(self.interval)
+                if version == self._version:
+                    continue
+                version = self._version
+            with self._lock:
+                states = dict(self.states)
+            wfile.write((json.dumps({'result': states}) + '\n').encode())
+            wfile.flush()
+
+    def _poll_loop(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.warning('scheduler query failed: %s'%e)
+
+    def serve_forever(self):
+        """Serve requests until `stop()` is called or a `shutdown` request arrives"""
+        path = socket_path()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0o700)
+        dir_st = os.stat(directory)
+        if dir_st.st_uid != os.getuid() or dir_st.st_mode & 0o022:
+            raise RuntimeError('%s must belong to you and must not be writable by others'%directory)
+        if os.path.exists(path):
+            if query('states') is not None:
+                raise RuntimeError('An agent is already running at %s'%path)
+            os.remove(path)
+
+        self.poll()
+        self._server = _Server(path, _Handler)
+        self._server.agent = self
+        os.chmod(path, 0o600)
+
+        poller = threading.Thread(target=self._poll_loop)
+        poller.daemon = True
+        poller.start()
+
+        logger.info('sparkhpc agent listening on %s'%path)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stop(self):
+        self._stopped.set()
+        with self._changed:
+            self._changed.notify_all()
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def daemonize():
+    """Detach the current process from the terminal"""
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
@@ -0,0 +1,154 @@
+#
+#
+# Live views of the running clusters
+#
+# Each refresh takes one scheduler snapshot through `SparkJob._cluster_records`
+# and only redraws the rows that changed since the previous refresh.
+#
+#
+from __future__ import print_function
+import sys
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger('sparkhpc.dashboard')
+
+columns = [('clusterid', 'ID', 4),
+           ('jobid', 'Job ID', 12),
+           ('status', 'Status', 10),
+           ('ncores', 'Cores', 6),
+           ('workers', 'Workers', 8),
+           ('cores_attached', 'Attached', 9),
+           ('uptime', 'Uptime', 9),
+           ('walltime_remaining', 'Remaining', 10),
+           ('master_ui', 'Spark UI', 0)]
+
+
+def _format_duration(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    return '%d:%02d:%02d'%(seconds//3600, (seconds%3600)//60, seconds%60)
+
+
+def _format_value(key, value):
+    if key in ('uptime', 'walltime_remaining'):
+        return _format_duration(value)
+    if value is None:
+        return '-'
+    return str(value)
+
+
+def _format_row(values):
+    return ' '.join([('%-*s'%(width, v) if width else v) for v, (_, _, width) in zip(values, columns)])
+
+
+def format_record(record):
+    """Format a cluster record as one row of the dashboard table"""
+    return _format_row([_format_value(key, record.get(key)) for key, _, _ in columns])
+
+
+def header():
+    return _format_row([title for _, title, _ in columns])
+
+
+def watch(sparkjob_class, interval=2, iterations=None, stream=None):
+    """
+    Show a continuously updated table of the clusters in the terminal
+
+    Only the rows that changed since the previous refresh are rewritten.
+
+    Parameters
+
+    sparkjob_class: class
+        the `SparkJob` subclass for the scheduler in use
+    interval: float
+        seconds between refreshes
+    iterations: int
+        stop after this many refreshes; default is to run until interrupted
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    rows = None
+    n = 0
+    try:
+        while iterations is None or n < iterations:
+            new_rows = [format_record(r) for r in sparkjob_class._cluster_records(workers=True)]
+            new_rows.append('%d cluster(s) - refreshed %s'%(len(new_rows), time.strftime('%H:%M:%S')))
+
+            if rows is None or len(rows) != len(new_rows):
+                # clear the screen and draw the whole table
+                stream.write('\033[2J\033[H' + header() + '\n' + '\n'.join(new_rows) + '\n')
+            else:
+                for i, (old, new) in enumerate(zip(rows, new_rows)):
+                    if old != new:
+                        # move to the row (the header is on line 1) and replace it
+                        stream.write('\033[%d;1H\033[2K%s'%(i+2, new))
+                stream.write('\033[%d;1H'%(len(new_rows)+2))
+            stream.flush()
+
+            rows = new_rows
+            n += 1
+            if iterations is None or n < iterations:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def widget(sparkjob_class, interval=2):
+    """
+    Return an IPython widget showing a live table of the clusters
+
+    The table is refreshed from a background thread every `interval` seconds and
+    only the rows that changed are updated. Requires `ipywidgets`. Call `stop()`
+    on the returned widget to stop refreshing.
+    """
+    try:
+        import ipywidgets
+    except ImportError:
+        raise ImportError('The live cluster view requires ipywidgets -- install it with `pip install ipywidgets`')
+
+    def html_row(values, tag='td'):
+        return '<table style="table-layout:fixed;width:100%%"><tr>%s</tr></table>'%''.join(
+            ['<%s>%s</%s>'%(tag, v, tag) for v in values])
+
+    head = ipywidgets.HTML(html_row([title for _, title, _ in columns], tag='th'))
+    box = ipywidgets.VBox([head])
+    stopped = threading.Event()
+    box.stop = stopped.set
+
+    def refresh():
+        rows = OrderedDict()
+        while not stopped.is_set():
+            try:
+                records = sparkjob_class._cluster_records(workers=True)
+            except Exception as e:
+                logger.warning('unable to refresh the cluster view: %s'%e)
+                records = []
+
+            current = OrderedDict()
+            for record in records:
+                values = [_format_value(key, record.get(key)) for key, _, _ in columns]
+                if record.get('master_ui'):
+                    values[-1] = '<a target="_blank" href="%s">%s</a>'%(record['master_ui'], record['master_ui'])
+                value = html_row(values)
+                jobid = record['jobid']
+                if jobid in rows:
+                    if rows[jobid].value != value:
+                        rows[jobid].value = value
+                    current[jobid] = rows[jobid]
+                else:
+                    current[jobid] = ipywidgets.HTML(value)
+
+            if list(current) != list(rows):
+                box.children = [head] + list(current.values())
+            rows = current
+            stopped.wait(interval)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    return box
@@ -0,0 +1,223 @@
+#
+#
+# Post-run performance analysis of Spark event logs
+#
+# The event log is read one event at a time, so arbitrarily long logs can be
+# analyzed; only a few numbers per stage and per executor are kept.
+#
+#
+from __future__ import print_function
+import os
+import io
+import json
+import glob
+import logging
+from array import array
+
+logger = logging.getLogger('sparkhpc.eventlog')
+
+# thresholds for flagging issues
+SKEW_RATIO = 3.
+SKEW_MIN_SECONDS = 10.
+SPILL_BYTES = 100*1024*1024
+GC_FRACTION = 0.1
+IDLE_FRACTION = 0.5
+
+
+def find_event_logs(directory):
+    """Return the event logs in `directory`, oldest first; rolling logs are returned as their directory"""
+    logs = [f for f in glob.glob(os.path.join(directory, '*'))
+            if not f.endswith('.inprogress') or os.path.isfile(f)]
+    return sorted(logs, key=os.path.getmtime)
+
+
+def _open(path):
+    """Open one event log file as a text stream, decompressing if necessary"""
+    if path.endswith('.zstd') or path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Reading zstd-compressed event logs requires the zstandard package')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8')
+    elif path.endswith('.lz4'):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('Reading lz4-compressed event logs requires the lz4 package')
+        return io.TextIOWrapper(lz4.frame.open(path, 'rb'), encoding='utf-8')
+    elif path.endswith('.gz'):
+        import gzip
+        return io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8')
+    return io.open(path, encoding='utf-8')
+
+
+def iter_events(path):
+    """Yield the events of a log one at a time; `path` can be a file or a rolling event log directory"""
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, 'events_*')),
+                       key=lambda f: int(os.path.basename(f).split('_')[1]))
+    else:
+        files = [path]
+
+    for f in files:
+        stream = _open(f)
+        try:
+            for line in stream:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        finally:
+            stream.close()
+
+
+def _median(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.
+    return values[len(values)//2]
+
+
+def analyze(path):
+    """
+    Analyze one event log
+
+    Returns a dictionary with the application duration, one summary per stage
+    (duration, task-time skew, spill and GC time), the executor idle time and
+    a list of issues found.
+    """
+    app = {'name': None, 'start': None, 'end': None}
+    stages = {}
+    executors = {}
+
+    for event in iter_events(path):
+        kind = event.get('Event')
+
+        if kind == 'SparkListenerApplicationStart':
+            app['name'] = event.get('App Name')
+            app['start'] = event.get('Timestamp')
+        elif kind == 'SparkListenerApplicationEnd':
+            app['end'] = event.get('Timestamp')
+
+        elif kind == 'SparkListenerExecutorAdded':
+            executors[event['Executor ID']] = {'added': event['Timestamp'], 'removed': None,
+                                               'cores': event['Executor Info'].get('Total Cores', 1), 'busy': 0.}
+        elif kind == 'SparkListenerExecutorRemoved':
+            if event['Executor ID'] in executors:
+                executors[event['Executor ID']]['removed'] = event['Timestamp']
+
+        elif kind in ('SparkListenerStageSubmitted', 'SparkListenerStageCompleted'):
+            info = event['Stage Info']
+            stage = stages.setdefault((info['Stage ID'], info.get('Stage Attempt ID', 0)), _new_stage())
+            stage['name'] = info.get('Stage Name')
+            stage['tasks'] = info.get('Number of Tasks')
+            if info.get('Submission Time') is not None:
+                stage['submitted'] = info['Submission Time']
+            if info.get('Completion Time') is not None:
+                stage['completed'] = info['Completion Time']
+            if info.get('Failure Reason'):
+                stage['failed'] = True
+
+        elif kind == 'SparkListenerTaskEnd':
+            stage = stages.setdefault((event['Stage ID'], event.get('Stage Attempt ID', 0)), _new_stage())
+            info = event['Task Info']
+            metrics = event.get('Task Metrics') or {}
+            duration = (info['Finish Time'] - info['Launch Time'])/1000.
+            stage['durations'].append(duration)
+            stage['run_time'] += metrics.get('Executor Run Time', 0)/1000.
+            stage['gc_time'] += metrics.get('JVM GC Time', 0)/1000.
+            stage['memory_spilled'] += metrics.get('Memory Bytes Spilled', 0)
+            stage['disk_spilled'] += metrics.get('Disk Bytes Spilled', 0)
+            if info.get('Executor ID') in executors:
+                executors[info['Executor ID']]['busy'] += duration
+
+    end = app['end']
+    if end is None:
+        end = max([s['completed'] or 0 for s in stages.values()] + [app['start'] or 0])
+    total_cores = sum([e['cores'] for e in executors.values()])
+
+    stage_summaries = []
+    for (stage_id, attempt), stage in sorted(stages.items()):
+        durations = stage['durations']
+        summary = {'stage': stage_id,
+                   'attempt': attempt,
+                   'name': stage['name'],
+                   'tasks': stage['tasks'] if stage['tasks'] is not None else len(durations),
+                   'duration': ((stage['completed'] - stage['submitted'])/1000.
+                                if stage['completed'] is not None and stage['submitted'] is not None else None),
+                   'median_task': _median(durations),
+                   'max_task': max(durations) if len(durations) else 0.,
+                   'gc_time': stage['gc_time'],
+                   'run_time': stage['run_time'],
+                   'memory_spilled': stage['memory_spilled'],
+                   'disk_spilled': stage['disk_spilled'],
+                   'failed': stage['failed']}
+        stage_summaries.append(summary)
+
+    available = 0.
+    busy = 0.
+    for e in executors.values():
+        removed = e['removed'] or end
+        if e['added'] is not None:
+            available += e['cores']*(removed - e['added'])/1000.
+        busy += e['busy']
+
+    result = {'path': path,
+              'app_name': app['name'],
+              'duration': (end - app['start'])/1000. if app['start'] is not None else None,
+              'executors': len(executors),
+              'cores': total_cores,
+              'stages': stage_summaries,
+              'executor_core_seconds': available,
+              'busy_core_seconds': busy,
+              'idle_fraction': 1 - busy/available if available > 0 else None}
+    result['issues'] = _find_issues(result)
+    return result
+
+
+def _new_stage():
+    return {'name': None, 'tasks': None, 'submitted': None, 'completed': None, 'failed': False,
+            'durations': array('d'), 'run_time': 0., 'gc_time': 0., 'memory_spilled': 0, 'disk_spilled': 0}
+
+
+def _find_issues(result):
+    issues = []
+    cores = result['cores']
+    for s in result['stages']:
+        label = 'stage %d (%s)'%(s['stage'], s['name'])
+        if cores and s['tasks'] < cores:
+            issues.append('%s: only %d tasks for %d cores -- use more partitions'%(label, s['tasks'], cores))
+        if s['max_task'] > SKEW_MIN_SECONDS and s['median_task'] > 0 and s['max_task'] > SKEW_RATIO*s['median_task']:
+            issues.append('%s: skewed tasks -- the longest took %.1fs, the median %.1fs'%(label, s['max_task'], s['median_task']))
+        if s['disk_spilled'] > SPILL_BYTES:
+            issues.append('%s: %.1f MB spilled to disk -- give executors more memory or use more partitions'%(
+                label, s['disk_spilled']/1024./1024.))
+        if s['run_time'] > 0 and s['gc_time'] > GC_FRACTION*s['run_time']:
+            issues.append('%s: %.0f%% of the task time spent in garbage collection'%(label, 100*s['gc_time']/s['run_time']))
+        if s['failed']:
+            issues.append('%s: failed'%label)
+    if result['idle_fraction'] is not None and result['idle_fraction'] > IDLE_FRACTION:
+        issues.append('executors were idle %.0f%% of the time -- the cluster is larger than the workload needs'%(
+            100*result['idle_fraction']))
+    return issues
+
+
+def format_report(result):
+    lines = ['Application %s (%s)'%(result['app_name'], result['path'])]
+    if result['duration'] is not None:
+        lines.append('  duration %.1fs on %d executors with %d cores, executors idle %s'%(
+            result['duration'], result['executors'], result['cores'],
+            '%.0f%%'%(100*result['idle_fraction']) if result['idle_fraction'] is not None else '-'))
+    lines.append('')
+    lines.append('  %6s %8s %10s %10s %10s %10s %12s  %s'%('stage', 'tasks', 'duration', 'median', 'max', 'GC',
+                                                         'spill [MB]', 'name'))
+    for s in result['stages']:
+        lines.append('  %6d %8d %10s %10.1f %10.1f %10.1f %12.1f  %s'%(
+            s['stage'], s['tasks'], '%.1f'%s['duration'] if s['duration'] is not None else '-',
+            s['median_task'], s['max_task'], s['gc_time'], s['disk_spilled']/1024./1024., s['name']))
+    lines.append('')
+    if result['issues']:
+        lines.append('Issues:')
+        lines += ['  - ' + issue for issue in result['issues']]
+    else:
+        lines.append('No issues found')
+    return '\n'.join(lines)
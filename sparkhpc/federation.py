@@ -0,0 +1,144 @@
+#
+#
+# Fan-out of independent tasks across several concurrent clusters
+#
+#
+from __future__ import print_function
+import sys
+import time
+import traceback
+import multiprocessing
+import logging
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+logger = logging.getLogger('sparkhpc.federation')
+
+_done = None
+
+
+def _cluster_worker(sparkjob_class, jobid, start_spark_kwargs, poll_interval, func, tasks, results):
+    """Wait for the cluster to start, then run tasks against it until there are none left"""
+    sj = sparkjob_class(jobid=jobid)
+    while not sj.job_started():
+        time.sleep(poll_interval)
+
+    sc = sj.start_spark(**start_spark_kwargs)
+    results.put((None, jobid, None, None))
+    logger.info('cluster %s joined the federation'%jobid)
+    try:
+        while True:
+            task = tasks.get()
+            if task is _done:
+                break
+            index, chunk = task
+            try:
+                results.put((index, jobid, [func(sc, item) for item in chunk], None))
+            except Exception:
+                results.put((index, jobid, None, traceback.format_exc()))
+    finally:
+        sc.stop()
+
+
+class Federation(object):
+    """
+    Run independent tasks across several clusters at once
+
+    Each cluster gets a worker process that creates its own SparkContext as soon as
+    the cluster is running. Tasks are held in a single shared queue from which every
+    cluster pulls the next chunk whenever it is free, so faster clusters take on more
+    work and clusters that start late pick up whatever is left once they register.
+
+    Example usage:
+
+        from sparkhpc import sparkjob
+        from sparkhpc.federation import Federation
+
+        sjs = [sparkjob.sparkjob(ncores=16) for i in range(4)]
+        fed = Federation(sjs)
+
+        def count_words(sc, path):
+            return sc.textFile(path).flatMap(lambda l: l.split()).count()
+
+        counts = fed.map(count_words, paths)
+    """
+
+    def __init__(self, sparkjobs, poll_interval=5, **start_spark_kwargs):
+        """
+        Parameters:
+
+        sparkjobs: list
+            the clusters to use, e.g. from `current_clusters()`; SparkJobs that have
+            not been submitted yet are submitted
+        poll_interval: int
+            seconds between checks whether a cluster has started
+        start_spark_kwargs:
+            passed on to `SparkJob.start_spark` for every cluster
+        """
+        if len(sparkjobs) == 0:
+            raise ValueError('A federation needs at least one cluster')
+        for sj in sparkjobs:
+            if sj.jobid is None:
+                sj.submit()
+        self.sparkjobs = sparkjobs
+        self.poll_interval = poll_interval
+        self.start_spark_kwargs = start_spark_kwargs
+
+    def map(self, func, items, chunksize=1):
+        """
+        Return `[func(sc, item) for item in items]`, computed across all clusters
+
+        `sc` is the SparkContext of whichever cluster picked up the item. Items are
+        handed out in chunks of `chunksize`; the results are returned in input order.
+        """
+        items = list(items)
+        chunks = [items[i:i+chunksize] for i in range(0, len(items), chunksize)]
+
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        for task in enumerate(chunks):
+            tasks.put(task)
+        for sj in self.sparkjobs:
+            tasks.put(_done)
+
+        workers = [multiprocessing.Process(target=_cluster_worker,
+                                           args=(sj.__class__, sj.jobid, self.start_spark_kwargs,
+                                                 self.poll_interval, func, tasks, results))
+                   for sj in self.sparkjobs]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        output = [None]*len(chunks)
+        per_cluster = {}
+        joined = set()
+        try:
+            received = 0
+            while received < len(chunks):
+                try:
+                    index, jobid, result, error = results.get(timeout=self.poll_interval)
+                except Empty:
+                    if not any([w.is_alive() for w in workers]):
+                        raise RuntimeError('All clusters exited with %d tasks left'%(len(chunks) - received))
+                    continue
+                if index is None:
+                    joined.add(jobid)
+                    continue
+                if error is not None:
+                    raise RuntimeError('Task %d failed on cluster %s:\n%s'%(index, jobid, error))
+                output[index] = result
+                per_cluster[jobid] = per_cluster.get(jobid, 0) + 1
+                received += 1
+        finally:
+            for sj, w in zip(self.sparkjobs, workers):
+                # clusters that joined stop their SparkContext once they run out of tasks
+                if sj.jobid in joined and sys.exc_info()[0] is None:
+                    w.join()
+                elif w.is_alive():
+                    w.terminate()
+
+        logger.info('chunks per cluster: %s'%', '.join(['%s: %d'%(k, v) for k, v in sorted(per_cluster.items())]))
+        return [r for chunk in output for r in chunk]
@@ -0,0 +1,317 @@
+#
+#
+# Accounting history of finished sparkhpc jobs
+#
+# The scheduler's accounting (sacct on SLURM, bacct on LSF) is queried in bulk
+# for the jobs active since the previous query. The records of the jobs that
+# have sparkhpc metadata are kept in ~/.sparkhpc-history-<scheduler>.json along
+# with the parameters the jobs were submitted with, so every query only fetches
+# new records and the history outlives the metadata files.
+#
+#
+from __future__ import print_function
+import os
+import re
+import json
+import glob
+import time
+import logging
+
+logger = logging.getLogger('sparkhpc.history')
+
+# parameters of the stored SparkJob that define the shape of a job
+shape_keys = ('ncores', 'cores_per_executor', 'memory_per_executor', 'walltime')
+
+# states in which a job counts as successful
+ok_states = ('COMPLETED', 'DONE')
+
+
+def store_path(scheduler):
+    return os.path.join(os.path.expanduser('~'), '.sparkhpc-history-%s.json'%scheduler)
+
+
+def _load(path):
+    if not os.path.exists(path):
+        return {'fetched': None, 'jobs': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save(store, path):
+    tmp = '%s.%d'%(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(store, f)
+    os.rename(tmp, path)
+
+
+def _metadata_files():
+    return [f for f in glob.glob(os.path.join(os.path.expanduser('~'), '.sparkhpc*'))
+            if re.match(r'\.sparkhpc\d+$', os.path.basename(f))]
+
+
+def _minutes(walltime):
+    if isinstance(walltime, int):
+        return walltime
+    h, m = [int(x) for x in walltime.split(':')]
+    return m + 60*h
+
+
+def _job_parameters(jobid):
+    """Return the shape a job was submitted with, from its metadata file, or None if it is not a sparkhpc job"""
+    filename = os.path.join(os.path.expanduser('~'), '.sparkhpc%s'%jobid)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        prop_dict = json.load(f)
+    params = dict([(k, prop_dict.get(k)) for k in shape_keys + ('jobname',)])
+    if params['walltime'] is not None:
+        params['walltime'] = _minutes(params['walltime'])
+    return params
+
+
+def update(cls, scheduler):
+    """
+    Add the accounting records of the sparkhpc jobs that finished since the last update to the store
+
+    `cls` is the `SparkJob` class of the scheduler. Returns the number of records added.
+    """
+    path = store_path(scheduler)
+    store = _load(path)
+    now = time.time()
+
+    since = store['fetched']
+    if since is None:
+        # nothing can have finished before the first job was submitted
+        mtimes = [os.path.getmtime(f) for f in _metadata_files()]
+        if len(mtimes) == 0:
+            return 0
+        since = min(mtimes)
+
+    added = 0
+    # a margin for the clocks of the login and the scheduler nodes
+    for record in cls._query_accounting(since - 60):
+        if record['end'] is None:
+            # still running - the next update fetches it again
+            continue
+        jobid = record['jobid']
+        params = _job_parameters(jobid)
+        if params is None:
+            if jobid not in store['jobs']:
+                continue
+            params = store['jobs'][jobid]['parameters']
+        if jobid not in store['jobs']:
+            added += 1
+        record['parameters'] = params
+        store['jobs'][jobid] = record
+
+    store['fetched'] = now
+    _save(store, path)
+    logger.info('%d new accounting records'%added)
+    return added
+
+
+def _derive(record):
+    """Add the queue wait and run time in seconds, the CPU efficiency and the fraction of the walltime used"""
+    r = dict(record)
+    params = r['parameters']
+    r['wait'] = r['start'] - r['submit'] if r['start'] is not None and r['submit'] is not None else None
+    r['runtime'] = r['end'] - r['start'] if r['start'] is not None else None
+
+    ncpus = r['ncpus'] or params['ncores']
+    if r['runtime'] and ncpus and r['cpu_time'] is not None:
+        r['cpu_efficiency'] = r['cpu_time']/(r['runtime']*ncpus)
+    else:
+        r['cpu_efficiency'] = None
+    if r['runtime'] is not None and params['walltime']:
+        r['walltime_fraction'] = r['runtime']/(60.*params['walltime'])
+    else:
+        r['walltime_fraction'] = None
+    return r
+
+
+def records(cls, scheduler, refresh=True):
+    """Return the records of the finished sparkhpc jobs, oldest first, updating the store first if `refresh`"""
+    if refresh:
+        update(cls, scheduler)
+    jobs = _load(store_path(scheduler))['jobs'].values()
+    return sorted([_derive(r) for r in jobs], key=lambda r: r['submit'] or 0)
+
+
+def _median(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    mid = len(values)//2
+    return values[mid] if len(values) % 2 else (values[mid-1] + values[mid])/2.
+
+
+def _known(records, key):
+    return [r[key] for r in records if r[key] is not None]
+
+
+def summarize(records):
+    """
+    Summarize the job records per shape
+
+    Returns a list with one dictionary per combination of `shape_keys`, most frequent first,
+    with the number of jobs and of failed jobs, the median queue wait and run time in seconds,
+    the largest fraction of the walltime used, the mean CPU efficiency and the peak RSS in MB.
+    """
+    shapes = {}
+    for r in records:
+        shapes.setdefault(tuple([r['parameters'][k] for k in shape_keys]), []).append(r)
+
+    summary = []
+    for shape, jobs in shapes.items():
+        efficiencies = _known(jobs, 'cpu_efficiency')
+        summary.append({'shape': dict(zip(shape_keys, shape)),
+                        'jobs': len(jobs),
+                        'failed': len([r for r in jobs if r['state'] not in ok_states]),
+                        'median_wait': _median(_known(jobs, 'wait')),
+                        'median_runtime': _median(_known(jobs, 'runtime')),
+                        'max_walltime_fraction': max(_known(jobs, 'walltime_fraction') or [None]),
+                        'mean_cpu_efficiency': sum(efficiencies)/len(efficiencies) if efficiencies else None,
+                        'peak_rss_mb': max(_known(jobs, 'max_rss') or [None])})
+    return sorted(summary, key=lambda s: -s['jobs'])
+
+
+def _fmt(value, scale=1., fmt='%10.1f'):
+    return fmt%(value*scale) if value is not None else '%10s'%'-'
+
+
+def format_report(summary):
+    lines = ['%6s %6s %10s %10s %6s %6s %10s %10s %10s %10s %10s'%(
+        'cores', 'c/exec', 'MB/exec', 'walltime', 'jobs', 'failed',
+        'wait [m]', 'run [m]', 'max wall%', 'CPU eff%', 'RSS [MB]')]
+    for s in summary:
+        shape = s['shape']
+        lines.append('%6s %6s %10s %10s %6d %6d %s %s %s %s %s'%(
+            shape['ncores'], shape['cores_per_executor'], shape['memory_per_executor'], shape['walltime'],
+            s['jobs'], s['failed'], _fmt(s['median_wait'], 1/60.), _fmt(s['median_runtime'], 1/60.),
+            _fmt(s['max_walltime_fraction'], 100.), _fmt(s['mean_cpu_efficiency'], 100.),
+            _fmt(s['peak_rss_mb'], fmt='%10.0f')))
+    return '\n'.join(lines)
+
+
+def _megabytes(size):
+    """Convert a memory size such as '2048K', '1.5G' or '63 Mbytes' to MB; plain numbers are KB"""
+    m = re.match(r'([\d.]+)\s*([KMGT]?)', size.strip())
+    if m is None:
+        return None
+    return float(m.group(1))*{'': 1/1024., 'K': 1/1024., 'M': 1., 'G': 1024., 'T': 1024.**2}[m.group(2)]
+
+
+def _duration(text):
+    """Convert a SLURM duration ([DD-][HH:]MM:SS[.mmm]) to seconds"""
+    days = 0
+    if '-' in text:
+        d, text = text.split('-', 1)
+        days = int(d)
+    seconds = 0.
+    for part in text.split(':'):
+        seconds = 60*seconds + float(part)
+    return 86400*days + seconds
+
+
+def _slurm_time(text):
+    if text in ('', 'Unknown', 'None'):
+        return None
+    return time.mktime(time.strptime(text, '%Y-%m-%dT%H:%M:%S'))
+
+
+def parse_sacct(output):
+    """
+    Parse the output of `sacct -n -P -o JobID,JobName,State,Submit,Start,End,NCPUS,TotalCPU,MaxRSS`
+
+    The job steps only contribute their peak memory to the record of their job.
+    """
+    jobs = {}
+    order = []
+    for line in output.split('\n'):
+        fields = line.strip().split('|')
+        if len(fields) < 9:
+            continue
+        jobid, jobname, state, submit, start, end, ncpus, total_cpu, max_rss = fields[:9]
+        rss = _megabytes(max_rss) if max_rss else None
+        if '.' in jobid:
+            record = jobs.get(jobid.split('.')[0])
+            if record is not None and rss is not None:
+                record['max_rss'] = max(record['max_rss'] or 0, rss)
+            continue
+        jobs[jobid] = {'jobid': jobid,
+                       'jobname': jobname,
+                       'state': state.split()[0] if state else None,
+                       'submit': _slurm_time(submit),
+                       'start': _slurm_time(start),
+                       'end': _slurm_time(end),
+                       'ncpus': int(ncpus) if ncpus else None,
+                       'cpu_time': _duration(total_cpu) if total_cpu else None,
+                       'max_rss': rss}
+        order.append(jobid)
+    return [jobs[jobid] for jobid in order]
+
+
+def _unwrap(block):
+    """Join the continuation lines that bacct wraps long lines into"""
+    lines = []
+    for line in block.split('\n'):
+        if line.startswith(' '*20) and len(lines) > 0 and lines[-1].strip():
+            lines[-1] += line.strip()
+        else:
+            lines.append(line)
+    return lines
+
+
+def _lsf_time(lines, event, year):
+    for line in lines:
+        m = re.match(r'\w{3} (\w{3} +\d+ \d+:\d+:\d+)(?: (\d{4}))?: %s'%event, line)
+        if m is not None:
+            stamp = ' '.join(m.group(1).split())
+            for y in ([m.group(2)] if m.group(2) else [year, year - 1]):
+                t = time.mktime(time.strptime('%s %s'%(stamp, y), '%b %d %H:%M:%S %Y'))
+                if t < time.time() + 86400:
+                    # otherwise it is from the end of last year
+                    break
+            return t
+    return None
+
+
+def parse_bacct(output, year=None):
+    """Parse the output of `bacct -l`; event times without a year are taken to be in `year` (default: this year)"""
+    if year is None:
+        year = time.localtime().tm_year
+    records = []
+    for block in re.split(r'\n-{10,}\n', output):
+        lines = _unwrap(block)
+        text = '\n'.join(lines)
+        job = re.search(r'Job <([^>]+)>', text)
+        if job is None:
+            continue
+
+        record = {'jobid': job.group(1),
+                  'jobname': (re.findall(r'Job Name <([^>]*)>', text) or [None])[0],
+                  'state': (re.findall(r'Status <([^>]*)>', text) or [None])[0],
+                  'submit': _lsf_time(lines, 'Submitted', year),
+                  'start': _lsf_time(lines, 'Dispatched', year),
+                  'end': _lsf_time(lines, 'Completed', year),
+                  'ncpus': None, 'cpu_time': None, 'max_rss': None}
+
+        dispatched = re.search(r'Dispatched([^;]*)', text)
+        if dispatched is not None:
+            tasks = re.search(r'(\d+) Task', dispatched.group(1))
+            if tasks is not None:
+                record['ncpus'] = int(tasks.group(1))
+            else:
+                hosts = re.findall(r'<(?:(\d+)\*)?[^<>*]+>', dispatched.group(1))
+                record['ncpus'] = sum([int(n or 1) for n in hosts]) or None
+
+        for i, line in enumerate(lines[:-1]):
+            if line.split()[:2] == ['CPU_T', 'WAIT']:
+                m = re.match(r'\s*([\d.]+)\s+(\d+)\s+(\d+)\s+\w+\s+[\d.]+\s+([\d.]+\s*[KMGT]?)', lines[i+1])
+                if m is not None:
+                    record['cpu_time'] = float(m.group(1))
+                    record['max_rss'] = _megabytes(m.group(4))
+                    if record['start'] is None and record['submit'] is not None:
+                        record['start'] = record['submit'] + int(m.group(2))
+        records.append(record)
+    return records
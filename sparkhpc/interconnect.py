@@ -0,0 +1,129 @@
+#
+#
+# Selection of the network that Spark traffic should use
+#
+# A policy is a comma-separated preference order of interface names, name patterns
+# or subnets, e.g. 'ib0,ib*,10.20.0.0/16'. The first entry that matches an IPv4
+# address of the node decides the address the Spark daemons bind to and advertise.
+#
+# `start_cluster` runs the workers through
+#
+#     python -m sparkhpc.interconnect <policy> <command> ...
+#
+# which resolves the policy on each node, sets SPARK_LOCAL_IP and
+# SPARK_LOCAL_HOSTNAME accordingly and then runs the command. A master restarted
+# on another node is started the same way with `--master`, which also sets
+# SPARK_MASTER_HOST.
+#
+#
+from __future__ import print_function
+import os
+import sys
+import socket
+import struct
+import fnmatch
+import subprocess
+import logging
+
+logger = logging.getLogger('sparkhpc.interconnect')
+
+# variables that make the Spark daemons bind to and advertise an address
+address_variables = ('SPARK_LOCAL_IP', 'SPARK_LOCAL_HOSTNAME')
+
+
+def interface_addresses():
+    """Return a dictionary of interface name -> IPv4 address for the interfaces of this node"""
+    addresses = {}
+    try:
+        import fcntl
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for index, name in socket.if_nameindex():
+                try:
+                    # SIOCGIFADDR
+                    ifreq = fcntl.ioctl(s.fileno(), 0x8915, struct.pack('256s', name[:15].encode()))
+                    addresses[name] = socket.inet_ntoa(ifreq[20:24])
+                except (IOError, OSError):
+                    # no IPv4 address on this interface
+                    pass
+        finally:
+            s.close()
+    except (ImportError, AttributeError):
+        # fall back to the ip tool, e.g. on python 2 which lacks if_nameindex
+        try:
+            out = subprocess.check_output(['ip', '-o', '-4', 'addr', 'show']).decode()
+        except (OSError, subprocess.CalledProcessError):
+            return addresses
+        for line in out.split('\n'):
+            fields = line.split()
+            if len(fields) >= 4 and fields[2] == 'inet':
+                addresses.setdefault(fields[1], fields[3].split('/')[0])
+    return addresses
+
+
+def _in_subnet(address, subnet):
+    network, bits = subnet.split('/')
+    mask = (0xffffffff << (32 - int(bits))) & 0xffffffff
+    to_int = lambda a: struct.unpack('!I', socket.inet_aton(a))[0]
+    return to_int(address) & mask == to_int(network) & mask
+
+
+def select_address(policy, addresses=None):
+    """
+    Return the address of this node chosen by `policy`, or None if no entry of the policy matches
+
+    Parameters
+
+    policy: string
+        comma-separated interface names (`ib0`), name patterns (`ib*`) or subnets
+        (`10.20.0.0/16`), in order of preference
+    addresses: dict
+        interface name -> address; default is the interfaces of this node
+    """
+    if addresses is None:
+        addresses = interface_addresses()
+    for entry in [e.strip() for e in policy.split(',') if e.strip()]:
+        for name in sorted(addresses):
+            if '/' in entry:
+                match = _in_subnet(addresses[name], entry)
+            else:
+                match = fnmatch.fnmatch(name, entry)
+            if match:
+                return addresses[name]
+    return None
+
+
+def apply(policy, environ=None, master=False):
+    """
+    Point the Spark daemons started from `environ` at the address chosen by `policy`
+
+    If the policy matches nothing on this node, the variables are removed so that Spark
+    falls back to its default address instead of one inherited from another node.
+    With `master`, the master also advertises the address. Returns the address, or None.
+    """
+    if environ is None:
+        environ = os.environ
+    address = select_address(policy)
+    if address is None:
+        logger.warning('No interface matching %s on %s - using the default address'%(policy, socket.gethostname()))
+        for var in address_variables:
+            environ.pop(var, None)
+    else:
+        for var in address_variables:
+            environ[var] = address
+        if master:
+            environ['SPARK_MASTER_HOST'] = address
+    return address
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    master = len(args) > 0 and args[0] == '--master'
+    if master:
+        args = args[1:]
+    if len(args) < 2:
+        print('usage: python -m sparkhpc.interconnect [--master] <policy> <command> [args ...]')
+        sys.exit(1)
+    apply(args[0], master=master)
+    os.execvp(args[1], args[1:])
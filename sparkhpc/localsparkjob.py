@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import glob
+import tempfile
+import re
+import signal
+import subprocess
+import logging
+
+from .sparkjob import SparkJob
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('sparkhpc.localsparkjob')
+
+# set in the environment of local jobs; `_current_jobid` picks it up inside the job
+jobid_variable = 'SPARKHPC_LOCAL_JOBID'
+
+
+class LocalSparkJob(SparkJob):
+    """
+    Class for running spark clusters on this machine without a scheduler
+
+    The job script is run as a detached local process whose process ID serves
+    as the job ID; the master and the workers are started by `start_cluster`
+    exactly as in a batch job. The walltime is recorded but not enforced.
+
+    See the `SparkJob` class for keyword descriptions.
+    """
+
+    def __init__(self, walltime='00:30', **kwargs):
+        if kwargs.get('chain'):
+            # there is no way to delay the start of a local job, and the walltime is not enforced anyway
+            raise RuntimeError('Chaining is not supported by %s'%self.__class__.__name__)
+
+        h,m = [int(x) for x in walltime.split(':')]
+
+        super(LocalSparkJob, self).__init__(**kwargs)
+
+        self.prop_dict['walltime'] = m + 60*h
+
+    @classmethod
+    def _format_walltime(cls, minutes):
+        return minutes
+
+    @classmethod
+    def _drain_option(cls, minutes):
+        # the walltime is not enforced, so there is nothing to warn about
+        return ''
+
+    @classmethod
+    def _submit_job(cls, jobfile):
+        """Start the job script as a detached process and return its process ID as the job ID"""
+        # like a batch scheduler, run a copy of the script so the job file can be reused right away
+        with open(jobfile) as f:
+            script = f.read()
+
+        # the log is named after the job ID once it is known
+        fd, log_name = tempfile.mkstemp(prefix='.sparkcluster-', suffix='.log', dir=os.getcwd())
+        log = os.fdopen(fd, 'w')
+        # the shell execs python, so $$ is the process ID of the job
+        proc = subprocess.Popen(['/bin/sh', '-c', 'export %s=$$; exec "$0" -c "$1"'%jobid_variable, sys.executable, script],
+                                stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        log.close()
+        jobid = str(proc.pid)
+
+        # the job counts as running once python has replaced the shell
+        start_time = time.time()
+        while not cls._alive(jobid) and proc.poll() is None and time.time() - start_time < 10:
+            time.sleep(0.05)
+        os.rename(log_name, 'sparkcluster-%s.log'%jobid)
+        logger.info('Started local job %s'%jobid)
+        return jobid
+
+    @classmethod
+    def _alive(cls, jobid):
+        """Whether `jobid` is a running local job of this user"""
+        try:
+            os.kill(int(jobid), 0)
+        except (OSError, ValueError):
+            return False
+        environ = '/proc/%s/environ'%jobid
+        if os.path.exists(environ):
+            # guard against the process ID having been reused by an unrelated process
+            try:
+                with open(environ, 'rb') as f:
+                    return ('%s=%s'%(jobid_variable, jobid)).encode() in f.read().split(b'\0')
+            except (IOError, OSError):
+                return False
+        return True
+
+    @classmethod
+    def _query_job_states(cls):
+        """Return a dictionary of job ID -> state for the local jobs that are still running"""
+        states = {}
+        for f in glob.glob(os.path.join(os.path.expanduser('~'), '.sparkhpc*')):
+            name = os.path.basename(f)
+            if re.match(r'\.sparkhpc\d+$', name) and cls._alive(name[9:]):
+                states[name[9:]] = 'RUNNING'
+        return states
+
+    @classmethod
+    def _signal_many(cls, jobids, signal_name):
+        """Send a signal to all processes of several local jobs"""
+        for jobid in jobids:
+            if cls._alive(jobid):
+                os.killpg(int(jobid), getattr(signal, 'SIG' + signal_name))
+
+    @classmethod
+    def _stop_many(cls, jobids):
+        """Stop several local jobs and their master and worker processes"""
+        cls._signal_many(jobids, 'TERM')
+        logger.info('Stopped local job(s) %s'%', '.join(jobids))
+
+    @classmethod
+    def _query_accounting(cls, since):
+        # there is no accounting without a scheduler
+        return []
+
+    def _estimate_start(self):
+        """Local jobs start right away if this machine has enough cores"""
+        if self.ncores > os.sysconf('SC_NPROCESSORS_ONLN'):
+            return None
+        return 0
+
+    def _describe_estimate(self, estimate):
+        return 'starts immediately'
+
+    def _peek(self):
+        with open(os.path.join(self.workdir, 'sparkcluster-%s.log'%self.jobid)) as f:
+            return f.read()
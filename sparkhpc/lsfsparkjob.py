@@ -4,6 +4,7 @@ from  .sparkjob import SparkJob
 import re
 import subprocess
 import logging
+import shlex
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('sparkhpc.lsfsparkjob')
@@ -11,9 +12,48 @@ logger = logging.getLogger('sparkhpc.lsfsparkjob')
 class LSFSparkJob(SparkJob):
     """Class for submitting spark jobs with the LSF scheduler"""
     _submit_command = 'bsub < %s'
-    _job_regex = 'Job <(\d+)>'
+    _job_regex = r'Job <(\d+)>'
     _kill_command = 'bkill'
+    _signal_command = 'bkill -s %s'
     _get_current_jobs = 'bjobs -o "job_name stat jobid"'
+    _get_hosts = 'bhosts -w'
+    _accounting_command = 'bacct -l -C %s,'
+
+    @classmethod
+    def _begin_option(cls, minutes):
+        return '#BSUB -b %s'%time.strftime('%Y:%m:%d:%H:%M', time.localtime(time.time() + 60*minutes))
+
+    @classmethod
+    def _drain_option(cls, minutes):
+        # LSF signals all the processes of the job; only start_cluster handles SIGURG, and 
+        # the master is started with it ignored
+        return '#BSUB -wa URG\n#BSUB -wt %d'%minutes
+
+    @classmethod
+    def _query_accounting(cls, since):
+        from . import history
+        command = cls._accounting_command%time.strftime('%Y/%m/%d/%H:%M', time.localtime(since))
+        return history.parse_bacct(subprocess.check_output(shlex.split(command)).decode())
+
+    def _estimate_start(self):
+        """
+        Queue-depth heuristic: the number of cores that still need to free up 
+        before enough hosts have `cores_per_executor` free slots for all executors
+        """
+        hosts = subprocess.check_output(shlex.split(self._get_hosts)).decode().split('\n')[1:]
+        
+        free_slots = 0
+        for line in hosts:
+            fields = line.split()
+            if len(fields) < 5 or fields[1] != 'ok':
+                continue
+            free_slots += max(int(fields[3]) - int(fields[4]), 0)//self.cores_per_executor
+
+        number_of_executors = self.ncores//self.cores_per_executor
+        return max(number_of_executors - free_slots, 0)*self.cores_per_executor
+
+    def _describe_estimate(self, estimate):
+        return 'waiting for %d cores to free up'%estimate
 
     def _peek(self):
         return subprocess.check_output(["bpeek", str(self.jobid)]).decode()
@@ -0,0 +1,126 @@
+#
+#
+# Warm pool of pre-started clusters for short interactive workloads
+#
+#
+from __future__ import print_function
+import os
+import glob
+import time
+import signal
+import logging
+
+from . import sparkjob
+
+logger = logging.getLogger('sparkhpc.pool')
+
+
+class ClusterPool(object):
+    """
+    Keep a number of clusters of given shapes running and ready to be leased
+
+    Clusters are handed out with `SparkJob.lease(shape)` and come back to the
+    pool with `SparkJob.release()`. Clusters that are not leased are retired
+    before they run out of walltime and replaced by new ones.
+
+    Example usage:
+
+        from sparkhpc.pool import ClusterPool
+
+        pool = ClusterPool({'small': dict(ncores=8, walltime='04:00'),
+                            'large': dict(ncores=64, cores_per_executor=8, walltime='04:00')},
+                           size={'small': 4, 'large': 1})
+        pool.run()
+
+    and, from the notebooks or scripts using the pool:
+
+        sj = sparkjob.sparkjob.lease('small')
+        sc = sj.start_spark()
+        ...
+        sc.stop()
+        sj.release()
+    """
+
+    def __init__(self, shapes, size=1, retire_margin=15, sparkjob_class=None):
+        """
+        Parameters:
+
+        shapes: dict
+            pool shape name -> `SparkJob` keyword arguments
+        size: int or dict
+            number of unleased clusters to keep for each shape, or a dictionary
+            giving it per shape
+        retire_margin: int
+            minutes of walltime left at which an unleased cluster is retired
+        sparkjob_class: class
+            the `SparkJob` subclass to use; default is the one for the scheduler in use
+        """
+        self.shapes = shapes
+        if isinstance(size, dict):
+            self.size = size
+        else:
+            self.size = dict((shape, size) for shape in shapes)
+        self.retire_margin = retire_margin
+        self.sparkjob_class = sparkjob_class or sparkjob.sparkjob
+
+    def maintain(self):
+        """Retire clusters close to their walltime and top the pool up; returns the number of jobs submitted"""
+        records = self.sparkjob_class._cluster_records()
+
+        retire = []
+        available = dict((shape, 0) for shape in self.shapes)
+        for record in records:
+            shape = record['pool_shape']
+            if shape not in self.shapes or record['leased']:
+                continue
+            remaining = record['walltime_remaining']
+            if remaining is not None and remaining < 60*self.retire_margin:
+                # take the lease ourselves, so that nobody leases the cluster while it is retired
+                if self.sparkjob_class._acquire_lease(record['jobid']):
+                    retire.append(record['jobid'])
+            else:
+                available[shape] += 1
+
+        if len(retire) > 0:
+            logger.info('Retiring clusters %s'%', '.join(retire))
+            self.sparkjob_class._stop_many(retire)
+        self._remove_leases(retire + self._dead_leases(records))
+
+        submitted = 0
+        for shape, kwargs in self.shapes.items():
+            for i in range(self.size.get(shape, 0) - available[shape]):
+                sj = self.sparkjob_class(**kwargs)
+                sj.prop_dict['pool_shape'] = shape
+                sj.submit()
+                logger.info('Submitted job %s for pool shape %s'%(sj.jobid, shape))
+                submitted += 1
+
+        if submitted > 0:
+            # pool clusters must survive the pool manager being interrupted
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        return submitted
+
+    def _dead_leases(self, records):
+        """Return the job IDs with a lease file but no job the scheduler knows about"""
+        live = set([record['jobid'] for record in records])
+        leases = [os.path.basename(f)[9:-6] for f in glob.glob(sparkjob._lease_filename('*'))]
+        return [jobid for jobid in leases if jobid.isdigit() and jobid not in live]
+
+    def _remove_leases(self, jobids):
+        for jobid in jobids:
+            try:
+                os.remove(sparkjob._lease_filename(jobid))
+            except OSError:
+                pass
+
+    def run(self, interval=60):
+        """Maintain the pool every `interval` seconds until interrupted"""
+        try:
+            while True:
+                try:
+                    self.maintain()
+                except Exception as e:
+                    logger.warning('unable to maintain the pool: %s'%e)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,75 @@
+#
+#
+# Aggregation of the PySpark worker profiles collected with `start_spark(profiling=True)`
+#
+# Every driver run dumps one pstats file per profiled RDD or UDF into its own
+# directory under <job_dir>/profiles; this module merges them into one
+# report of the Python hotspots.
+#
+#
+from __future__ import print_function
+import os
+import pstats
+import logging
+
+logger = logging.getLogger('sparkhpc.profiles')
+
+sort_keys = {'tottime': 2, 'cumtime': 3, 'ncalls': 1}
+
+
+def find_profiles(directory):
+    """Return all the pstats files below `directory`"""
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        paths += [os.path.join(root, f) for f in files if f.endswith('.pstats')]
+    return sorted(paths)
+
+
+def merge(paths, output=None):
+    """
+    Merge pstats files into a single `pstats.Stats` object
+
+    If `output` is given, the merged profile is also written there; it can be
+    loaded with `pstats` or any of the usual profile viewers.
+    """
+    if len(paths) == 0:
+        raise RuntimeError('No profiles to merge')
+    stats = pstats.Stats(*paths)
+    if output is not None:
+        stats.dump_stats(output)
+        logger.info('Merged %d profiles into %s'%(len(paths), output))
+    return stats
+
+
+def hotspots(stats, sort='tottime', limit=20):
+    """
+    Return the `limit` most expensive functions of a merged profile
+
+    Each entry is a dictionary with the function, its number of calls and the
+    time spent in it (`tottime`) and in it and its callees (`cumtime`).
+    """
+    if sort not in sort_keys:
+        raise ValueError('sort must be one of %s'%', '.join(sorted(sort_keys)))
+    rows = [(key, value) for key, value in stats.stats.items()]
+    rows.sort(key=lambda row: row[1][sort_keys[sort]], reverse=True)
+    return [{'function': pstats.func_std_string(key),
+             'ncalls': value[1],
+             'tottime': value[2],
+             'cumtime': value[3]} for key, value in rows[:limit]]
+
+
+def report(paths, sort='tottime', limit=20, output=None):
+    """Merge the profiles in `paths` and return their total time and hotspots"""
+    stats = merge(paths, output)
+    return {'profiles': len(paths),
+            'total_time': stats.total_tt,
+            'hotspots': hotspots(stats, sort, limit)}
+
+
+def format_report(report):
+    lines = ['%d profiles, %.2fs of profiled time in the Python workers'%(report['profiles'], report['total_time']),
+             '',
+             '%10s %12s %12s  %s'%('ncalls', 'tottime', 'cumtime', 'function')]
+    for s in report['hotspots']:
+        lines.append('%10d %12.3f %12.3f  %s'%(s['ncalls'], s['tottime'], s['cumtime'], s['function']))
+    return '\n'.join(lines)
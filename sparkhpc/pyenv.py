@@ -0,0 +1,159 @@
+#
+#
+# Shipping the Python environment to node-local disk
+#
+# `pack` archives the running environment once and caches the archive under
+# ~/.sparkhpc-envs by a hash of its file contents; `start_cluster` runs
+# `python -m sparkhpc.pyenv unpack <archive> <dir>` on every node so that the
+# PySpark workers import from local disk instead of the shared filesystem.
+#
+#
+from __future__ import print_function
+import os
+import sys
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import subprocess
+import logging
+
+logger = logging.getLogger('sparkhpc.pyenv')
+
+_complete = '.sparkhpc-complete'
+
+
+def _skip(name):
+    return name == '__pycache__' or name.endswith('.pyc')
+
+
+def is_environment(prefix):
+    """Whether `prefix` is a virtualenv or conda environment rather than a system installation"""
+    if os.path.exists(os.path.join(prefix, 'pyvenv.cfg')) or os.path.exists(os.path.join(prefix, 'conda-meta')):
+        return True
+    # virtualenv on python 2 leaves no marker in the prefix
+    return os.path.realpath(prefix) == os.path.realpath(sys.prefix) and hasattr(sys, 'real_prefix')
+
+
+def fingerprint(prefix=None):
+    """
+    Return a hash of the names and contents of the files packed from the environment at `prefix`
+
+    Compiled bytecode is ignored so that merely importing modules does not change the fingerprint;
+    symbolic links contribute their target.
+    """
+    prefix = prefix or sys.prefix
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(prefix):
+        dirs[:] = sorted([d for d in dirs if not _skip(d)])
+        for f in sorted(files):
+            if _skip(f):
+                continue
+            path = os.path.join(root, f)
+            h.update(('%s\n'%os.path.relpath(path, prefix)).encode())
+            try:
+                if os.path.islink(path):
+                    h.update(os.readlink(path).encode())
+                else:
+                    with open(path, 'rb') as fh:
+                        for block in iter(lambda: fh.read(1 << 20), b''):
+                            h.update(block)
+            except (OSError, IOError):
+                continue
+    return h.hexdigest()[:16]
+
+
+def cache_dir():
+    return os.path.join(os.path.expanduser('~'), '.sparkhpc-envs')
+
+
+def pack(prefix=None, cache=None):
+    """
+    Return the path of an archive of the environment at `prefix`, packing it if necessary
+
+    Archives are kept in `cache` (default ~/.sparkhpc-envs) under the fingerprint of the
+    environment, so an unchanged environment is only packed once. Conda environments are
+    packed with `conda-pack` if it is installed, which makes them relocatable. A system
+    installation is not packed since that would archive all of its prefix, e.g. /usr.
+    """
+    prefix = prefix or sys.prefix
+    if not is_environment(prefix):
+        raise RuntimeError('%s is not a virtualenv or conda environment; refusing to pack it'%prefix)
+    cache = cache or cache_dir()
+    if not os.path.exists(cache):
+        os.makedirs(cache)
+
+    archive = os.path.join(cache, '%s.tar.gz'%fingerprint(prefix))
+    if os.path.exists(archive):
+        logger.info('Using the packed environment %s'%archive)
+        return archive
+
+    logger.info('Packing the environment %s into %s'%(prefix, archive))
+    fd, tmp = tempfile.mkstemp(dir=cache, suffix='.tar.gz')
+    os.close(fd)
+    try:
+        try:
+            import conda_pack
+            conda_pack.pack(prefix=prefix, output=tmp, format='tar.gz', force=True)
+        except ImportError:
+            with tarfile.open(tmp, 'w:gz') as tar:
+                tar.add(prefix, arcname='.', filter=lambda info: None if _skip(os.path.basename(info.name)) else info)
+        os.rename(tmp, archive)
+    except Exception:
+        os.remove(tmp)
+        raise
+    return archive
+
+
+def local_prefix(archive, local_dir):
+    """Where `archive` is unpacked under `local_dir`"""
+    return os.path.join(local_dir, 'sparkhpc-env-%s'%os.path.basename(archive).split('.')[0])
+
+
+def local_python(archive, local_dir):
+    """The interpreter of the copy of `archive` unpacked under `local_dir`"""
+    return os.path.join(local_prefix(archive, local_dir), 'bin', 'python')
+
+
+def unpack(archive, local_dir):
+    """
+    Unpack `archive` under `local_dir` unless an earlier job on this node already did
+
+    Returns the path of the unpacked interpreter.
+    """
+    target = local_prefix(archive, local_dir)
+    if os.path.exists(os.path.join(target, _complete)):
+        logger.info('Reusing %s'%target)
+        return local_python(archive, local_dir)
+
+    if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+    tmp = tempfile.mkdtemp(dir=local_dir, prefix='.sparkhpc-env-')
+    try:
+        with tarfile.open(archive) as tar:
+            if hasattr(tarfile, 'fully_trusted_filter'):
+                # we packed the archive ourselves; keep symlinks such as a virtualenv's bin/python
+                tar.extractall(tmp, filter='fully_trusted')
+            else:
+                tar.extractall(tmp)
+        if os.path.exists(os.path.join(tmp, 'bin', 'conda-unpack')):
+            subprocess.check_call([os.path.join(tmp, 'bin', 'python'), os.path.join(tmp, 'bin', 'conda-unpack')])
+        open(os.path.join(tmp, _complete), 'w').close()
+        try:
+            os.rename(tmp, target)
+        except OSError:
+            # another job on this node got there first
+            shutil.rmtree(tmp)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    logger.info('Unpacked %s into %s'%(archive, target))
+    return local_python(archive, local_dir)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 4 or sys.argv[1] != 'unpack':
+        print('usage: python -m sparkhpc.pyenv unpack <archive> <directory>')
+        sys.exit(1)
+    unpack(sys.argv[2], sys.argv[3])
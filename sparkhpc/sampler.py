@@ -0,0 +1,261 @@
+#
+#
+# Per-node resource sampling and right-sizing reports
+#
+# `start_cluster` runs `python -m sparkhpc.sampler record <dir>` once on every
+# node of the job. Each sampler appends fixed-size binary records to
+# <dir>/<hostname>.samples; `report` summarizes them after the job.
+#
+#
+from __future__ import print_function
+import os
+import sys
+import glob
+import time
+import mmap
+import socket
+import struct
+import signal
+import logging
+
+logger = logging.getLogger('sparkhpc.sampler')
+
+MAGIC = b'SHPCSMP1'
+# number of cpus, total memory in MB, sampling interval in seconds
+HEADER = struct.Struct('<8sIId')
+# time, busy cores, RSS of the user's processes in MB, JVM heap in use in MB,
+# and the cumulative disk read/write and network receive/transmit bytes
+RECORD = struct.Struct('<dfffQQQQ')
+FIELDS = ('time', 'busy_cores', 'rss_mb', 'heap_mb', 'disk_read', 'disk_write', 'net_rx', 'net_tx')
+
+
+def _cpu_jiffies():
+    """Return (busy, total) jiffies summed over all cpus"""
+    with open('/proc/stat') as f:
+        values = [int(x) for x in f.readline().split()[1:]]
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    return sum(values) - idle, sum(values)
+
+
+def _mem_total_mb():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1])//1024
+    return 0
+
+
+def _user_rss_mb(uid):
+    """Total resident memory of all processes of `uid` in MB"""
+    total = 0
+    for status in glob.glob('/proc/[0-9]*/status'):
+        try:
+            with open(status) as f:
+                text = f.read()
+        except (IOError, OSError):
+            continue
+        owner = rss = None
+        for line in text.split('\n'):
+            if line.startswith('Uid:'):
+                owner = int(line.split()[1])
+            elif line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+        if owner == uid and rss is not None:
+            total += rss
+    return total/1024.
+
+
+def _jvm_heap_mb(user):
+    """
+    Heap in use by the user's JVMs in MB
+
+    Read from the hsperfdata files the JVMs maintain in the temporary directory,
+    which is much cheaper than attaching to them with `jstat`.
+    """
+    total = 0
+    for path in glob.glob(os.path.join('/tmp', 'hsperfdata_%s'%user, '*')):
+        try:
+            total += _hsperfdata_heap(path)
+        except Exception as e:
+            logger.debug('unable to read %s: %s'%(path, e))
+    return total/1024./1024.
+
+
+def _hsperfdata_heap(path):
+    """Sum of the `sun.gc.generation.*.space.*.used` counters of one JVM, in bytes"""
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        order = '<' if struct.unpack_from('B', data, 4)[0] == 1 else '>'
+        magic, = struct.unpack_from('>I', data, 0)
+        if magic != 0xcafec0c0:
+            return 0
+        entry_offset, num_entries = struct.unpack_from(order + 'ii', data, 24)
+
+        used = 0
+        offset = entry_offset
+        for i in range(num_entries):
+            length, name_offset, vector_length, data_type, flags, units, variability, data_offset = \
+                struct.unpack_from(order + 'iiicBBBi', data, offset)
+            name_start = offset + name_offset
+            name = data[name_start:data.find(b'\0', name_start)].decode()
+            if data_type == b'J' and vector_length == 0 and name.startswith('sun.gc.generation.') \
+                    and name.endswith('.used') and '.space.' in name:
+                used += struct.unpack_from(order + 'q', data, offset + data_offset)[0]
+            offset += length
+        return used
+    finally:
+        data.close()
+
+
+def _disk_bytes():
+    """Cumulative bytes read and written on the node's block devices"""
+    devices = set(os.listdir('/sys/block')) if os.path.exists('/sys/block') else None
+    read = written = 0
+    with open('/proc/diskstats') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 10 or fields[2].startswith(('loop', 'ram')):
+                continue
+            if devices is not None and fields[2] not in devices:
+                # partitions are already accounted for in their device
+                continue
+            read += int(fields[5])*512
+            written += int(fields[9])*512
+    return read, written
+
+
+def _net_bytes():
+    """Cumulative bytes received and transmitted on all interfaces but loopback"""
+    rx = tx = 0
+    with open('/proc/net/dev') as f:
+        for line in f.readlines()[2:]:
+            name, values = line.split(':', 1)
+            if name.strip() == 'lo':
+                continue
+            values = values.split()
+            rx += int(values[0])
+            tx += int(values[8])
+    return rx, tx
+
+
+def record(outdir, interval=10):
+    """Append a sample of this node's resource usage to `outdir`/<hostname>.samples every `interval` seconds"""
+    if not os.path.exists(outdir):
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            pass
+
+    import getpass
+    user, uid = getpass.getuser(), os.getuid()
+    ncpu = os.sysconf('SC_NPROCESSORS_ONLN')
+
+    running = [True]
+    def stop(signum, frame):
+        running[0] = False
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    path = os.path.join(outdir, '%s.samples'%socket.gethostname().split('.')[0])
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, ncpu, _mem_total_mb(), interval))
+        busy0, total0 = _cpu_jiffies()
+        while running[0]:
+            time.sleep(interval)
+            busy, total = _cpu_jiffies()
+            busy_cores = ncpu*float(busy - busy0)/max(total - total0, 1)
+            busy0, total0 = busy, total
+            f.write(RECORD.pack(time.time(), busy_cores, _user_rss_mb(uid), _jvm_heap_mb(user),
+                                *(_disk_bytes() + _net_bytes())))
+            f.flush()
+
+
+def load(path):
+    """Return the header and the list of samples stored in a sample file"""
+    with open(path, 'rb') as f:
+        magic, ncpu, mem_total_mb, interval = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not a sparkhpc sample file'%path)
+        data = f.read()
+    n = len(data)//RECORD.size
+    samples = [dict(zip(FIELDS, RECORD.unpack_from(data, i*RECORD.size))) for i in range(n)]
+    return {'ncpu': ncpu, 'mem_total_mb': mem_total_mb, 'interval': interval}, samples
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0
+    return values[min(int(q*len(values)), len(values)-1)]
+
+
+def summarize(sample_dir, cores_per_node, memory_per_core, memory_per_executor):
+    """
+    Summarize the samples of a job and recommend a shape for the next submission
+
+    Returns a dictionary with a summary per node and the recommended
+    `cores_per_executor`, `memory_per_core` and `memory_per_executor`.
+    """
+    nodes = {}
+    for path in sorted(glob.glob(os.path.join(sample_dir, '*.samples'))):
+        header, samples = load(path)
+        if len(samples) < 2:
+            continue
+        duration = samples[-1]['time'] - samples[0]['time']
+        busy = [s['busy_cores'] for s in samples]
+        nodes[os.path.basename(path)[:-8]] = {
+            'samples': len(samples),
+            'mean_busy_cores': sum(busy)/len(busy),
+            'p95_busy_cores': _percentile(busy, 0.95),
+            'peak_rss_mb': max([s['rss_mb'] for s in samples]),
+            'peak_heap_mb': max([s['heap_mb'] for s in samples]),
+            'disk_read_mb_s': (samples[-1]['disk_read'] - samples[0]['disk_read'])/1e6/max(duration, 1),
+            'disk_write_mb_s': (samples[-1]['disk_write'] - samples[0]['disk_write'])/1e6/max(duration, 1),
+            'net_rx_mb_s': (samples[-1]['net_rx'] - samples[0]['net_rx'])/1e6/max(duration, 1),
+            'net_tx_mb_s': (samples[-1]['net_tx'] - samples[0]['net_tx'])/1e6/max(duration, 1)}
+
+    if len(nodes) == 0:
+        raise RuntimeError('No samples found in %s'%sample_dir)
+
+    # size for the busiest node, with some headroom
+    p95_cores = max([n['p95_busy_cores'] for n in nodes.values()])
+    peak_rss = max([n['peak_rss_mb'] for n in nodes.values()])
+    peak_heap = max([n['peak_heap_mb'] for n in nodes.values()])
+
+    cores = 1
+    while cores < min(1.1*p95_cores, cores_per_node):
+        cores *= 2
+    cores = min(cores, cores_per_node)
+
+    return {'nodes': nodes,
+            'cores_per_executor': cores,
+            'memory_per_core': max(int(1.2*peak_rss/cores), 100),
+            'memory_per_executor': max(int(1.3*peak_heap), 512) if peak_heap > 0 else memory_per_executor,
+            'requested': {'cores_per_executor': cores_per_node,
+                          'memory_per_core': memory_per_core,
+                          'memory_per_executor': memory_per_executor}}
+
+
+def format_report(summary):
+    lines = ['%-16s %8s %10s %10s %10s %10s %10s %10s'%('node', 'cores', 'p95 cores', 'RSS [MB]', 'heap [MB]',
+                                                      'disk MB/s', 'net MB/s', 'samples')]
+    for name, n in sorted(summary['nodes'].items()):
+        lines.append('%-16s %8.1f %10.1f %10.0f %10.0f %10.1f %10.1f %10d'%(
+            name, n['mean_busy_cores'], n['p95_busy_cores'], n['peak_rss_mb'], n['peak_heap_mb'],
+            n['disk_read_mb_s'] + n['disk_write_mb_s'], n['net_rx_mb_s'] + n['net_tx_mb_s'], n['samples']))
+
+    requested = summary['requested']
+    lines.append('')
+    lines.append('Recommended shape for the next submission:')
+    for key in ('cores_per_executor', 'memory_per_core', 'memory_per_executor'):
+        lines.append('  %-20s %8s (requested %s)'%(key, summary[key], requested[key]))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 3 or sys.argv[1] != 'record':
+        print('usage: python -m sparkhpc.sampler record <directory> [interval]')
+        sys.exit(1)
+    record(sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 10)
@@ -4,6 +4,8 @@ from .sparkjob import SparkJob
 import re
 import subprocess
 import logging
+import shlex
+import tempfile
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('sparkhpc.slurmsparkjob')
@@ -17,9 +19,13 @@ class SLURMSparkJob(SparkJob):
 
     """
     _submit_command = 'sbatch %s'
-    _job_regex = "job (\d+)"
+    _job_regex = r"job (\d+)"
     _kill_command = 'scancel'
+    _signal_command = 'scancel --signal=%s'
     _get_current_jobs = 'squeue -o "%.j %.T %.i" -j'
+    _test_submit_command = 'sbatch --test-only %s'
+    _start_regex = r'to start at (\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})'
+    _accounting_command = 'sacct -n -P -S %s -E now -o JobID,JobName,State,Submit,Start,End,NCPUS,TotalCPU,MaxRSS'
 
     def __init__(self, walltime='00:30', **kwargs): 
         h,m = [int(x) for x in walltime.split(':')]
@@ -28,6 +34,47 @@ class SLURMSparkJob(SparkJob):
 
         self.prop_dict['walltime'] = m + 60*h
 
+    @classmethod
+    def _format_walltime(cls, minutes):
+        return minutes
+
+    @classmethod
+    def _begin_option(cls, minutes):
+        return '#SBATCH --begin=now+%dminutes'%minutes
+
+    @classmethod
+    def _drain_option(cls, minutes):
+        # only the batch script, i.e. start_cluster, gets the signal
+        return '#SBATCH --signal=B:USR1@%d'%(60*minutes)
+
+    @classmethod
+    def _query_accounting(cls, since):
+        from . import history
+        command = cls._accounting_command%time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(since))
+        return history.parse_sacct(subprocess.check_output(shlex.split(command)).decode())
+
+    def _estimate_start(self):
+        """Return the number of seconds until the job would start according to `sbatch --test-only`"""
+        fd, jobfile = tempfile.mkstemp(prefix='job-estimate-', dir='.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self._job_script())
+        try:
+            out = subprocess.check_output(self._test_submit_command%jobfile, shell=True, 
+                                          stderr=subprocess.STDOUT).decode()
+        except subprocess.CalledProcessError as e:
+            logger.debug('sbatch --test-only failed: %s'%e.output)
+            return None
+        finally:
+            os.remove(jobfile)
+
+        start = re.findall(self._start_regex, out)
+        if len(start) == 0:
+            return None
+        return max(time.mktime(time.strptime(start[0], '%Y-%m-%dT%H:%M:%S')) - time.time(), 0)
+
+    def _describe_estimate(self, estimate):
+        return 'expected to start in %d minutes'%(estimate//60)
+
     def _peek(self):
         with open(os.path.join(self.workdir, 'sparkcluster-%s.log'%self.jobid)) as f: 
             job_peek = f.read()
@@ -18,6 +18,13 @@ import sys
 import pkg_resources 
 import logging
 import signal
+import threading
+from . import agent
+
+try: 
+    from shlex import quote
+except ImportError: 
+    from pipes import quote
 
 
 try: 
@@ -63,25 +70,124 @@ def get_scheduler():
     elif which('squeue') is not None: 
         scheduler = 'slurm'
     else:
-        scheduler = None
-        logger.warn('No suitable scheduler found')
+        scheduler = 'local'
+        logger.info('No batch scheduler found - clusters will run on this machine')
 
     return scheduler
 
 slaves_template = "{spark_home}/sbin/start-slave.sh {master_url} -c {cores_per_executor}"
 
-def get_launch_commands(scheduler):
+# without a scheduler to place them, all the workers are started on this machine
+local_slaves_template = "for i in $(seq {number_of_executors}); do {worker} & done; wait"
+
+def get_launch_commands(scheduler, interface=None):
+    master_launch_command = '{0}'
+    worker_command = slaves_template
+    if interface: 
+        # every node resolves its own address on the chosen network
+        worker_command = '%s -m sparkhpc.interconnect %s '%(sys.executable, quote(interface)) + worker_command
+    if scheduler == 'local': 
+        slaves_launch_command = local_slaves_template.replace('{worker}', worker_command)
+    else: 
+        slaves_launch_command = get_node_launcher(scheduler) + worker_command
+
+    return master_launch_command, slaves_launch_command
+
+def get_node_launcher(scheduler, overlap=False):
+    """
+    Return the command prefix that runs a command once on every node of the job
+
+    With `overlap`, the command may run alongside the Spark workers. 
+    """
     if scheduler == 'slurm':
-        master_launch_command = '{0}'
-        slaves_launch_command = 'srun ' + slaves_template
+        return 'srun --overlap ' if overlap else 'srun '
     elif scheduler == 'lsf':
-        master_launch_command = '{0}'
-        slaves_launch_command = 'mpirun --npernode 1 ' + slaves_template
+        return 'mpirun --npernode 1 '
+    elif scheduler == 'local':
+        return ''
 
-    return master_launch_command, slaves_launch_command
+def job_dir(jobid, workdir=None):
+    """Directory for the files a job produces (samples, event logs, ...), under its working directory"""
+    return os.path.join(workdir or os.getcwd(), 'sparkhpc-%s'%jobid)
 
 home_dir = os.path.expanduser('~')
 
+# template text by packaged template name or by (path, modification time)
+_template_cache = {}
+_template_lock = threading.Lock()
+
+
+def _load_template(template_file=None, path=None):
+    """Return the text of a packaged template, or of the template at `path`, reading each only once"""
+    key = template_file if path is None else (path, os.path.getmtime(path))
+    with _template_lock:
+        if key not in _template_cache:
+            if path is None:
+                template_str = pkg_resources.resource_string('sparkhpc', 'templates/%s'%template_file)
+            else:
+                with open(path) as f:
+                    template_str = f.read()
+            if isinstance(template_str, bytes):
+                template_str = template_str.decode()
+            _template_cache[key] = template_str
+        return _template_cache[key]
+
+
+def _current_jobid():
+    """Return the scheduler job ID of the job this process is running in, if any"""
+    for var in ('SPARKHPC_LOCAL_JOBID', 'SLURM_JOB_ID', 'LSB_JOBID'):
+        if var in os.environ:
+            return os.environ[var]
+    return None
+
+
+def _endpoint_filename(jobid):
+    return os.path.join(home_dir, '.sparkhpc%s.endpoint'%jobid)
+
+
+def _read_endpoint(jobid):
+    """Return the endpoint record published by the cluster running in jobid, or None"""
+    try:
+        with open(_endpoint_filename(jobid)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _lease_filename(jobid):
+    return os.path.join(home_dir, '.sparkhpc%s.lease'%jobid)
+
+
+def _update_endpoint(jobid, **kwargs):
+    """Merge kwargs into the endpoint record of jobid
+
+    The record is replaced atomically so that clients never read a partial file.
+    """
+    endpoint = _read_endpoint(jobid) or {}
+    endpoint.update(kwargs)
+    filename = _endpoint_filename(jobid)
+    tmpname = '%s.%d.tmp'%(filename, os.getpid())
+    # the record may hold credentials, e.g. the notebook token
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(endpoint, fp)
+    os.rename(tmpname, filename)
+    return endpoint
+
+
+def _master_status(master_ui, timeout=1):
+    """Return the status reported by the JSON endpoint of the master's web UI, or None"""
+    try:
+        from urllib.request import urlopen
+    except ImportError:
+        from urllib2 import urlopen
+    try:
+        return json.loads(urlopen(master_ui.rstrip('/') + '/json/', timeout=timeout).read().decode())
+    except Exception as e:
+        logger.debug('unable to get the master status from %s: %s'%(master_ui, e))
+        return None
+
+
 # set up logging
 
 LOG_LEVEL = 'DEBUG' if os.environ.get('SPARKHPC_DEBUG', False) == '1' else 'INFO'
@@ -118,7 +224,7 @@ class SparkJob(object):
                 clusterid=None,
                 jobid=None,
                 ncores=4,
-                cores_per_executor=1, 
+                cores_per_executor=None, 
                 walltime='00:30',
                 memory_per_core=2000, 
                 memory_per_executor=None,
@@ -129,7 +235,25 @@ class SparkJob(object):
                 spark_home=None,
                 master_log_dir=None,
                 master_log_filename='spark_master.out',
-                scheduler=None):
+                scheduler=None,
+                chain=0,
+                chain_overlap=10,
+                predecessor=None,
+                optimize_shape=False,
+                layouts=None,
+                application=None,
+                application_args='',
+                notebook=False,
+                sample_interval=None,
+                pack_env=False,
+                stage=None,
+                stage_verify=False,
+                stage_cleanup=True,
+                drain=None,
+                checkpoint_dir=None,
+                interface=None,
+                master_restarts=3,
+                shuffle_service=False):
         """
         Creates a SparkJob
         
@@ -141,6 +265,9 @@ class SparkJob(object):
             same as `clusterid` but using directly the scheduler job ID
         ncores: int
             number of cores to request
+        cores_per_executor: int
+            number of cores for each executor; default is 1. If given, the layout 
+            is never changed by `optimize_shape`
         walltime: string
             walltime in `HH:MM` format as a string
         memory_per_core: int
@@ -168,6 +295,62 @@ class SparkJob(object):
         scheduler: string
             specify manually which scheduler you want to use; 
             usually the automatic determination will work fine so this should not be used
+        chain: int
+            number of follow-on jobs with the same shape to submit so that the cluster 
+            outlives the walltime limit; each job submits its successor once its master is up
+        chain_overlap: int
+            minutes before the end of the walltime at which the successor should start
+        predecessor: 
+            job ID of the job this one takes over from; set automatically when chaining
+        optimize_shape: bool
+            on submission, pick the layout (cores per executor) that is expected to 
+            start first given the current state of the queue
+        layouts: list
+            candidate values of `cores_per_executor` to consider with `optimize_shape`; 
+            default is all powers of two that divide `ncores`
+        application: string
+            run this application inside the job once the cluster is up and 
+            release the allocation when it finishes; a file accepted by 
+            `spark-submit` or a Python entry point as `module:function`
+        application_args: string
+            arguments for the application
+        notebook: bool
+            start a Jupyter notebook server next to the Spark master inside the job; 
+            its address is available from `notebook_url()`
+        sample_interval: float
+            record the resource usage of every node every `sample_interval` seconds; 
+            see `resource_report()`
+        pack_env: bool
+            pack the current Python environment (once, cached by content) and unpack it 
+            to node-local disk on every node so that the PySpark workers do not import 
+            from the shared filesystem
+        stage: list
+            paths or glob patterns of inputs to copy to the local disk of every node 
+            before the workers start; see `staged_paths()`
+        stage_verify: bool
+            compare checksums of the staged copies with the originals
+        stage_cleanup: bool
+            remove the staged copies when the cluster shuts down
+        drain: int
+            minutes before the end of the walltime at which the scheduler warns the job; 
+            the cluster then tells the drivers to checkpoint (see `on_drain`), decommissions 
+            its workers and exits cleanly instead of being killed
+        checkpoint_dir: directory path
+            where `checkpoint_on_drain` saves datasets and `load_checkpoint` finds them again; 
+            should be on fast shared storage. Default is `sparkhpc-checkpoints` in the working directory
+        interface: string
+            network for the Spark traffic as a comma-separated preference order of interface 
+            names, name patterns or subnets, e.g. 'ib0,ib*,10.20.0.0/16'; nodes without a 
+            matching interface use their default address
+        master_restarts: int
+            how often the Spark master is restarted if it dies; the restarted master recovers 
+            the workers and applications from its state in the job directory. 0 disables 
+            recovery and supervision of the master
+        shuffle_service: bool
+            run the external shuffle service in every worker on Spark's default port 7337, 
+            so that dynamic allocation can release executors without losing their shuffle 
+            output; only one cluster per node can do so. Without it, dynamic allocation 
+            keeps the executors that hold shuffle data
 
         Example usage:
         
@@ -207,6 +390,10 @@ class SparkJob(object):
                 if not os.path.exists(spark_home):
                     raise RuntimeError('Please make sure you either put spark in ~/spark or set the SPARK_HOME environment variable.')
 
+            fixed_layout = cores_per_executor is not None
+            if cores_per_executor is None:
+                cores_per_executor = 1
+
             if memory_per_executor is None: 
                 memory_per_executor = memory_per_core * cores_per_executor
 
@@ -226,10 +413,34 @@ class SparkJob(object):
                               'master_log_filename': master_log_filename,
                               'scheduler': scheduler,
                               'workdir': os.getcwd(),
-                              'extra_scheduler_options': extra_scheduler_options
+                              'extra_scheduler_options': extra_scheduler_options,
+                              'chain': chain,
+                              'chain_overlap': chain_overlap,
+                              'predecessor': predecessor,
+                              'optimize_shape': optimize_shape,
+                              'layouts': layouts,
+                              'fixed_layout': fixed_layout,
+                              'application': application,
+                              'application_args': application_args,
+                              'notebook': notebook,
+                              'sample_interval': sample_interval,
+                              'pack_env': pack_env,
+                              'stage': stage,
+                              'stage_verify': stage_verify,
+                              'stage_cleanup': stage_cleanup,
+                              'drain': drain,
+                              'checkpoint_dir': checkpoint_dir or os.path.join(os.getcwd(), 'sparkhpc-checkpoints'),
+                              'interface': interface,
+                              'master_restarts': master_restarts,
+                              'shuffle_service': shuffle_service
                               }
 
-        signal.signal(signal.SIGINT, self._sigint_handler)
+        try: 
+            signal.signal(signal.SIGINT, self._sigint_handler)
+        except ValueError: 
+            # signal handlers can only be set from the main thread, e.g. not when 
+            # submitting from a thread pool
+            pass
 
     def _repr_html_(self): 
         table_header = "<tr>"+self.table_header+"</tr>"
@@ -260,12 +471,328 @@ class SparkJob(object):
 
     def master_url(self): 
         """Get the URL of the Spark master"""
-        return self._master_url(self.jobid)
+        return self._master_url(self._serving_jobid())
 
 
     def master_ui(self): 
         """Get the UI address of the Spark master"""
-        return self._master_ui(self.jobid)
+        return self._master_ui(self._serving_jobid())
+
+
+    def staged_paths(self): 
+        """
+        Return a dictionary mapping each staged input to the path of its copy on the nodes' local disk
+
+        The copies exist on every node of the job, so they can be read with `file://` URLs 
+        by a driver running inside the job, e.g. an application or a notebook started with the cluster. 
+        """
+        endpoint = _read_endpoint(self._serving_jobid())
+        if endpoint is None: 
+            return None
+        return endpoint.get('staged')
+
+
+    def notebook_url(self): 
+        """
+        Get the URL (including the login token) of the notebook server running next to the master
+
+        Returns None until the server is up, and raises RuntimeError if it failed to start. 
+        """
+        endpoint = _read_endpoint(self._serving_jobid())
+        if endpoint is None: 
+            return None
+        if endpoint.get('notebook_error'): 
+            raise RuntimeError('The notebook server failed to start: %s'%endpoint['notebook_error'])
+        return endpoint.get('notebook_url')
+
+
+    @classmethod
+    def lease(cls, shape, timeout=600, poll_interval=5): 
+        """
+        Obtain exclusive use of a running cluster from the warm pool
+
+        Waits until a running cluster of the given pool `shape` (see `sparkhpc.pool.ClusterPool`) 
+        is available and leases it. The lease is recorded next to the cluster's metadata, 
+        so no other caller can obtain the same cluster until it is given back with `release()`. 
+
+        Parameters
+
+        shape: string
+            name of the pool shape
+        timeout: int
+            seconds to wait for a cluster to become available
+        poll_interval: int
+            seconds between attempts
+        """
+        start_time = time.time()
+        while True: 
+            for record in cls._cluster_records(): 
+                if record['pool_shape'] != shape or record['leased'] or record['draining'] or record['master_url'] is None: 
+                    continue
+                if 'RUN' not in record['status']: 
+                    continue
+                if cls._acquire_lease(record['jobid']): 
+                    # ctrl-c in the lessee must not stop the cluster it shares with the pool
+                    handler = signal.getsignal(signal.SIGINT)
+                    sj = cls(jobid=record['jobid'])
+                    try: 
+                        signal.signal(signal.SIGINT, handler)
+                    except (ValueError, TypeError): 
+                        # not the main thread, or a handler not installed from python
+                        pass
+                    logger.info('Leased cluster %s of shape %s'%(sj.jobid, shape))
+                    return sj
+            if time.time() - start_time > timeout: 
+                raise RuntimeError('No cluster of shape %s became available within %d seconds'%(shape, timeout))
+            time.sleep(poll_interval)
+
+
+    @classmethod
+    def _acquire_lease(cls, jobid): 
+        """Atomically create the lease file for jobid; returns False if somebody else holds it"""
+        import socket
+        try: 
+            fd = os.open(_lease_filename(jobid), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except OSError: 
+            return False
+        with os.fdopen(fd, 'w') as fp: 
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, fp)
+        return True
+
+
+    def release(self): 
+        """Give a leased cluster back to the pool"""
+        try: 
+            os.remove(_lease_filename(self.jobid))
+        except OSError: 
+            pass
+        logger.info('Released cluster %s'%self.jobid)
+
+
+    def job_dir(self): 
+        """Directory for the files produced by this job"""
+        return job_dir(self.jobid, self.workdir)
+
+
+    def resource_report(self): 
+        """
+        Summarize the resource usage recorded with `sample_interval` 
+
+        Returns a dictionary with per-node statistics and the recommended `cores_per_executor`, 
+        `memory_per_core` and `memory_per_executor` for the next submission of this workload. 
+        """
+        from . import sampler
+        return sampler.summarize(os.path.join(self.job_dir(), 'samples'), self.cores_per_executor, 
+                                 self.memory_per_core, self.memory_per_executor)
+
+
+    def profile_report(self, sort='tottime', limit=20, output=None): 
+        """
+        Merge the Python worker profiles of all runs with `start_spark(profiling=True)`
+
+        Returns a dictionary with the total profiled time and the `limit` most expensive 
+        functions sorted by `sort` (one of 'tottime', 'cumtime' or 'ncalls'). If `output` 
+        is given, the merged profile is also written there in pstats format. 
+        """
+        from . import profiles
+        profile_dir = os.path.join(self.job_dir(), 'profiles')
+        paths = profiles.find_profiles(profile_dir)
+        if len(paths) == 0: 
+            raise RuntimeError('No profiles found in %s'%profile_dir)
+        return profiles.report(paths, sort, limit, output)
+
+
+    def analyze_event_logs(self): 
+        """
+        Analyze the event logs of the applications run on this cluster with `start_spark`
+
+        Returns one dictionary per application with the stage durations, task-time skew, 
+        spill, GC time, executor idle time and a list of the issues found. 
+        """
+        from . import eventlog
+        event_log_dir = os.path.join(self.job_dir(), 'eventlogs')
+        logs = eventlog.find_event_logs(event_log_dir)
+        if len(logs) == 0: 
+            raise RuntimeError('No event logs found in %s'%event_log_dir)
+        return [eventlog.analyze(log) for log in logs]
+
+
+    @classmethod
+    def history(cls, refresh=True): 
+        """
+        Return the scheduler accounting records of this user's finished sparkhpc jobs, oldest first
+
+        The records are cached in the home directory; with `refresh`, the records of the jobs 
+        that finished since the last call are fetched with a single accounting query first. 
+        Each record has the queue `wait` and `runtime` in seconds, the `cpu_efficiency`, 
+        the peak memory `max_rss` in MB, the `walltime_fraction` used and the `parameters` 
+        the job was submitted with. Summarize per shape with `sparkhpc.history.summarize`. 
+        """
+        from . import history
+        scheduler = dict([(v, k) for k, v in _sparkjob_registry.items()]).get(cls, cls.__name__)
+        return history.records(cls, scheduler, refresh)
+
+
+    @classmethod
+    def _query_accounting(cls, since): 
+        """Return the accounting records of the jobs active since `since` (seconds since the epoch); override in subclasses"""
+        raise NotImplementedError('Job accounting is not supported by %s'%cls.__name__)
+
+
+    def _serving_jobid(self):
+        """Follow the chain of successor jobs to the one currently serving this cluster"""
+        jobid = self.jobid
+        endpoint = _read_endpoint(jobid)
+        while endpoint is not None and endpoint.get('successor') is not None: 
+            successor = _read_endpoint(endpoint['successor'])
+            if successor is None or 'master_url' not in successor:
+                break
+            jobid, endpoint = endpoint['successor'], successor
+        return jobid
+
+
+    def _walltime_minutes(self):
+        """Return the requested walltime in minutes"""
+        walltime = self.walltime
+        if isinstance(walltime, int):
+            return walltime
+        h,m = [int(x) for x in walltime.split(':')]
+        return m + 60*h
+
+
+    def _init_kwargs(self, **overrides):
+        """Return the keyword arguments needed to create a new SparkJob with the same shape"""
+        walltime = self._walltime_minutes()
+        # with optimize_shape, a layout that was not fixed by the user is picked again on submission
+        fixed_layout = self.prop_dict.get('fixed_layout', True) or not self.optimize_shape
+        kwargs = {'ncores': self.ncores,
+                  'cores_per_executor': self.cores_per_executor if fixed_layout else None,
+                  'walltime': '%02d:%02d'%(walltime//60, walltime%60),
+                  'memory_per_core': self.memory_per_core,
+                  'memory_per_executor': self.memory_per_executor if fixed_layout else self.memory_per_executor//self.cores_per_executor,
+                  'jobname': self.jobname,
+                  'template': self.template,
+                  'extra_scheduler_options': self.extra_scheduler_options,
+                  'config_dir': self.config_dir,
+                  'spark_home': self.spark_home,
+                  'master_log_dir': self.master_log_dir,
+                  'master_log_filename': self.master_log_filename,
+                  'scheduler': self.scheduler,
+                  'chain': self.chain,
+                  'chain_overlap': self.chain_overlap,
+                  'predecessor': self.predecessor,
+                  'optimize_shape': self.optimize_shape,
+                  'layouts': self.layouts,
+                  'application': self.application,
+                  'application_args': self.application_args,
+                  'notebook': self.notebook,
+                  'sample_interval': self.sample_interval,
+                  'pack_env': self.pack_env,
+                  'stage': self.stage,
+                  'stage_verify': self.stage_verify,
+                  'stage_cleanup': self.stage_cleanup,
+                  'drain': self.drain,
+                  'checkpoint_dir': self.checkpoint_dir,
+                  'interface': self.interface,
+                  'master_restarts': self.master_restarts,
+                  'shuffle_service': self.shuffle_service}
+        kwargs.update(overrides)
+        return kwargs
+
+
+    def submit_successor(self): 
+        """
+        Submit a follow-on job with the same shape that is scheduled to start 
+        `chain_overlap` minutes before this job runs out of walltime
+
+        Once the master of the successor is up, it registers itself in the endpoint record 
+        of this job and `master_url()` transparently returns the address of the new master. 
+        """
+        delay = max(self._walltime_minutes() - self.chain_overlap, 0)
+        
+        successor = self.__class__(**self._init_kwargs(chain=max(self.chain-1, 0),
+                                                       predecessor=self.jobid))
+        # kept apart from extra_scheduler_options, which every generation inherits
+        successor.prop_dict['begin'] = delay
+        if self.prop_dict.get('pool_shape') is not None: 
+            successor.prop_dict['pool_shape'] = self.prop_dict['pool_shape']
+        successor.submit()
+        # so that `stop()` can cancel the successor as well
+        self.prop_dict['successor'] = successor.jobid
+        self._dump_to_json()
+        logger.info('Submitted successor job %s to take over from job %s in %d minutes'%(successor.jobid, self.jobid, delay))
+        return successor
+
+
+    @classmethod
+    def _begin_option(cls, minutes): 
+        """Scheduler directive that delays the start of a job by `minutes`; override in subclasses"""
+        raise NotImplementedError('Chaining is not supported by %s'%cls.__name__)
+
+
+    @classmethod
+    def _drain_option(cls, minutes): 
+        """Scheduler directive to signal the job `minutes` before its walltime runs out; override in subclasses"""
+        raise NotImplementedError('Draining is not supported by %s'%cls.__name__)
+
+
+    def draining(self): 
+        """Whether the cluster has been told that its walltime is about to run out"""
+        endpoint = _read_endpoint(self._serving_jobid())
+        return endpoint is not None and endpoint.get('draining', False)
+
+
+    def on_drain(self, callback, poll_interval=5): 
+        """
+        Call `callback(checkpoint_dir)` once the cluster starts draining before the end of its walltime
+
+        The endpoint record of the cluster currently serving this SparkJob is checked every 
+        `poll_interval` seconds from a background thread. The cluster waits for the running 
+        applications for up to `drain` minutes, less a minute to decommission the workers. 
+        """
+        import threading
+        jobid = self._serving_jobid()
+
+        def watch(): 
+            while True: 
+                endpoint = _read_endpoint(jobid)
+                if endpoint is not None and endpoint.get('draining'): 
+                    logger.info('Cluster %s is draining - calling %s'%(jobid, getattr(callback, '__name__', callback)))
+                    callback(endpoint.get('checkpoint_dir', self.checkpoint_dir))
+                    return
+                time.sleep(poll_interval)
+
+        thread = threading.Thread(target=watch)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+    def checkpoint_on_drain(self, name, dataset, poll_interval=5): 
+        """
+        Save `dataset` (an RDD or a DataFrame) under `name` in the checkpoint directory when the cluster drains
+
+        After resubmitting, `load_checkpoint(name)` returns it without recomputing it. 
+        """
+        def save(checkpoint_dir): 
+            path = _checkpoint_url(os.path.join(checkpoint_dir, name))
+            if hasattr(dataset, 'write'): 
+                dataset.write.mode('overwrite').parquet(path)
+            else: 
+                dataset.saveAsPickleFile(path)
+            logger.info('Saved checkpoint %s to %s'%(name, path))
+        return self.on_drain(save, poll_interval)
+
+
+    def load_checkpoint(self, sc, name): 
+        """Return the dataset saved by `checkpoint_on_drain` under `name`, or None if there is none"""
+        path = os.path.join(self.checkpoint_dir, name)
+        if not os.path.exists(os.path.join(path, '_SUCCESS')): 
+            return None
+        if len(glob.glob(os.path.join(path, '*.parquet'))) > 0: 
+            from pyspark.sql import SparkSession
+            return SparkSession(sc).read.parquet(_checkpoint_url(path))
+        return sc.pickleFile(_checkpoint_url(path))
 
 
     def _dump_to_json(self):
@@ -294,12 +821,17 @@ class SparkJob(object):
         pass
 
 
-    def _get_master(self, jobid, regex = None, timeout=60):
+    def _get_master(self, jobid, key=None, regex = None, timeout=60):
         """Retrieve the spark master address for jobid"""
 
         if self._job_started(jobid): 
             timein = time.time()
             while time.time() - timein < timeout:
+                # clusters started by start_cluster publish their addresses in the endpoint record
+                endpoint = _read_endpoint(jobid)
+                if endpoint is not None and key in endpoint: 
+                    return endpoint[key]
+
                 job_peek = self._peek()
                 logger.debug('job_peek = %s'%job_peek)
 
@@ -320,16 +852,21 @@ class SparkJob(object):
 
     def _master_url(self, jobid, timeout=60): 
         """Retrieve the spark master address for jobid"""
-        return self._get_master(jobid, regex='(spark://\S+:\d{4})',timeout=timeout)
+        return self._get_master(jobid, key='master_url', regex=r'(spark://\S+:\d+)',timeout=timeout)
 
 
     def _master_ui(self, jobid, timeout=60): 
         """Retrieve the web UI address for jobid"""
-        return self._get_master(jobid, regex='(http://\S+:\d{4})',timeout=timeout)
+        return self._get_master(jobid, key='master_ui', regex=r'(http://\S+:\d+)',timeout=timeout)
 
 
     def submit(self): 
-        """Write job file to current working directory and submit to the scheduler"""
+        """
+        Write the job script and submit it to the scheduler
+
+        The script ends up in the job's directory (see `job_dir`), so that several 
+        jobs can be submitted at once, e.g. from a thread pool. Returns the cluster ID.
+        """
 
         # check that the user has setup the java environment
         if 'JAVA_HOME' not in os.environ:
@@ -338,40 +875,263 @@ class SparkJob(object):
         if self.jobid is not None: 
             raise RuntimeError("This SparkJob instance has already submitted a job; you must create a separate instance for a new job")
 
-        if self.template is None: 
-            template_file = templates[self.__class__]
-            template_str = pkg_resources.resource_string('sparkhpc', 'templates/%s'%template_file)
-        else : 
-            with open(self.template) as template_file: 
-                template_str = template_file.read()
-
-        template_str = template_str.decode()
-
-        job = template_str.format(walltime=self.walltime, 
-                                  ncores=self.ncores, 
-                                  cores_per_executor=self.cores_per_executor,
-                                  number_of_executors=int(self.ncores/self.cores_per_executor),
-                                  memory_per_core=self.memory_per_core, 
-                                  memory_per_executor=self.memory_per_executor,
-                                  jobname=self.jobname, 
-                                  spark_home=self.spark_home,
-                                  master_log_dir=self.master_log_dir,
-                                  master_log_filename=self.master_log_filename,
-                                  extra_scheduler_options=self.extra_scheduler_options)
-
-        with open('job', 'w') as jobfile: 
-            jobfile.write(job)
-
-        self.prop_dict['jobid'] = self._submit_job('job')
+        if self.optimize_shape: 
+            self._select_layout()
+
+        self.prop_dict['jobid'] = self._submit_script(self._job_script())
         self.prop_dict['status'] = 'submitted'
         self._dump_to_json()
+        agent.notify('submitted', jobids=[self.jobid])
 
-        sjs = self.current_clusters()
-        clusterid = len(sjs)-1
+        clusterid = self._allocate_clusterid(self.jobid)
         logger.info('Submitted cluster %d'%(clusterid))
         
         return clusterid
 
+
+    def _submit_script(self, script): 
+        """Submit `script` under a name of its own and move it to the job directory; returns the job ID"""
+        import tempfile
+        fd, path = tempfile.mkstemp(prefix='.sparkhpc-job-', dir=self.workdir)
+        with os.fdopen(fd, 'w') as jobfile: 
+            jobfile.write(script)
+
+        try: 
+            jobid = self._submit_job(path)
+        except: 
+            os.remove(path)
+            raise
+
+        # the scheduler has its own copy by now; keep ours with the other files of the job
+        directory = job_dir(jobid, self.workdir)
+        if not os.path.exists(directory): 
+            os.makedirs(directory)
+        os.rename(path, os.path.join(directory, 'job'))
+        return jobid
+
+
+    # per class: the time of the last listing of the clusters and the clusters registered since
+    _submit_lock = threading.RLock()
+    _clusters_snapshot = {}
+
+    @classmethod
+    def _allocate_clusterid(cls, jobid, max_age=10): 
+        """
+        Return the cluster ID of the newly submitted `jobid`
+
+        The ID is the index of the job in the same list of clusters that `current_clusters()` 
+        returns. The agent, if it is running, keeps that list up to date. Otherwise the 
+        scheduler and the metadata files are scanned at most once every `max_age` seconds 
+        per class, or whenever the clusters are listed, and the jobs submitted in the meantime 
+        are added to that listing in memory, so that submitting many clusters in a row does 
+        not rescan the queue or the home directory for each of them. 
+        """
+        try: 
+            registered = agent.query('clusters')
+        except RuntimeError as e: 
+            logger.warning('unable to get the clusters from the sparkhpc agent: %s'%e)
+            registered = None
+        if registered is not None and jobid in registered: 
+            return registered.index(jobid)
+
+        with cls._submit_lock: 
+            snapshot_time, registered = cls._clusters_snapshot.get(cls, (0, None))
+            if registered is None or time.time() - snapshot_time > max_age: 
+                states = dict(cls._job_states())
+                states.setdefault(jobid, 'PEND')
+                registered = cls._registered_jobids(states)
+            elif jobid not in registered: 
+                # same order as the metadata file names
+                registered.append(jobid)
+                registered.sort()
+            return registered.index(jobid)
+
+
+    def _job_script(self, template_file=None, **overrides):
+        """
+        Return the job template filled in with the properties of this SparkJob
+
+        `template_file` selects one of the templates included in the package instead 
+        of the job template; `overrides` replace individual template parameters. 
+        """
+        if template_file is None and self.template is not None: 
+            template_str = _load_template(path=self.template)
+        else : 
+            if template_file is None: 
+                template_file = templates[self.__class__]
+            template_str = _load_template(template_file)
+
+        params = dict(walltime=self.walltime, 
+                      ncores=self.ncores, 
+                      cores_per_executor=self.cores_per_executor,
+                      number_of_executors=int(self.ncores/self.cores_per_executor),
+                      memory_per_core=self.memory_per_core, 
+                      memory_per_executor=self.memory_per_executor,
+                      jobname=self.jobname, 
+                      spark_home=self.spark_home,
+                      master_log_dir=self.master_log_dir,
+                      master_log_filename=self.master_log_filename,
+                      extra_scheduler_options=self.extra_scheduler_options,
+                      chain=self.chain,
+                      predecessor=repr(self.predecessor),
+                      application=repr(self.application),
+                      application_args=repr(self.application_args),
+                      notebook=self.notebook,
+                      sample_interval=self.sample_interval,
+                      python_env=repr(self._python_env()),
+                      stage=repr(self.stage),
+                      stage_verify=self.stage_verify,
+                      stage_cleanup=self.stage_cleanup,
+                      drain=self.drain,
+                      checkpoint_dir=repr(self.checkpoint_dir),
+                      interface=repr(self.interface),
+                      master_restarts=self.master_restarts,
+                      shuffle_service=self.shuffle_service)
+        options = [self.extra_scheduler_options]
+        if self.drain: 
+            options.append(self._drain_option(self.drain))
+        if self.prop_dict.get('begin') is not None: 
+            options.append(self._begin_option(self.prop_dict['begin']))
+        params['extra_scheduler_options'] = '\n'.join([x for x in options if x])
+        params.update(overrides)
+
+        return template_str.format(**params)
+
+
+    def _python_env(self): 
+        """Return the packed environment archive for the job, packing it on first use"""
+        if not self.prop_dict.get('pack_env'): 
+            return None
+        if self.prop_dict.get('python_env') is None: 
+            from . import pyenv
+            self.prop_dict['python_env'] = pyenv.pack()
+        return self.prop_dict['python_env']
+
+
+    def _candidate_layouts(self):
+        """Return the values of `cores_per_executor` that give an equivalent cluster"""
+        if self.layouts is not None:
+            return [c for c in self.layouts if self.ncores % c == 0]
+        layouts = []
+        c = 1
+        while c <= self.ncores:
+            if self.ncores % c == 0:
+                layouts.append(c)
+            c *= 2
+        return layouts
+
+
+    def _select_layout(self):
+        """
+        Switch to the layout with the earliest expected start
+
+        Each candidate layout is rendered and handed to `_estimate_start`; 
+        a layout requested explicitly by the user is never changed. 
+        """
+        if self.fixed_layout:
+            logger.info('Keeping the requested layout of %d cores per executor'%self.cores_per_executor)
+            return
+
+        original = self.cores_per_executor, self.memory_per_executor
+        estimates = []
+        for cores_per_executor in self._candidate_layouts():
+            self._set_layout(cores_per_executor, *original)
+            estimate = self._estimate_start()
+            if estimate is None:
+                logger.info('layout %dx%d: cannot be scheduled'%(self.ncores//cores_per_executor, cores_per_executor))
+            else:
+                logger.info('layout %dx%d: %s'%(self.ncores//cores_per_executor, cores_per_executor, 
+                                                 self._describe_estimate(estimate)))
+                estimates.append((estimate, cores_per_executor))
+        
+        if len(estimates) == 0: 
+            logger.warning('Unable to estimate start times - keeping %d cores per executor'%original[0])
+            self._set_layout(original[0], *original)
+            return
+
+        estimate, cores_per_executor = min(estimates)
+        self._set_layout(cores_per_executor, *original)
+        logger.info('Selected layout %dx%d with %s'%(self.ncores//cores_per_executor, cores_per_executor, 
+                                                    self._describe_estimate(estimate)))
+
+
+    def _set_layout(self, cores_per_executor, original_cores_per_executor, original_memory_per_executor):
+        """Change the layout keeping the memory per core constant"""
+        self.prop_dict['cores_per_executor'] = cores_per_executor
+        self.prop_dict['memory_per_executor'] = original_memory_per_executor*cores_per_executor//original_cores_per_executor
+
+
+    def _estimate_start(self):
+        """
+        Return a score ordering layouts by their expected start, lower is sooner, 
+        or None if the current layout can not be scheduled; override in subclasses
+        """
+        raise NotImplementedError('Start time estimates are not supported by %s'%self.__class__.__name__)
+
+
+    def _describe_estimate(self, estimate):
+        return 'score %s'%estimate
+
+    def submit_race(self, shapes, poll_interval=5):
+        """
+        Submit several alternative shapes at once and keep whichever starts first
+
+        All candidates are watched with a single scheduler query per `poll_interval` 
+        seconds; as soon as one of them is running, the others are cancelled with 
+        a single kill call and this SparkJob takes on the properties of the winner. 
+
+        Parameters
+
+        shapes: list
+            alternative shapes; each entry is either a dictionary of `SparkJob` keyword 
+            arguments to override, e.g. `{'cores_per_executor': 8}` or 
+            `{'extra_scheduler_options': '#SBATCH -p bigmem'}`, or an integer which 
+            is taken as `cores_per_executor`
+        poll_interval: int
+            seconds between scheduler queries
+        """
+        if self.jobid is not None: 
+            raise RuntimeError("This SparkJob instance has already submitted a job; you must create a separate instance for a new job")
+
+        candidates = []
+        winner = None
+        try: 
+            for shape in shapes: 
+                if not isinstance(shape, dict): 
+                    shape = {'cores_per_executor': shape}
+                overrides = dict(shape)
+                if 'cores_per_executor' in overrides and 'memory_per_executor' not in overrides:
+                    overrides['memory_per_executor'] = self.memory_per_executor*overrides['cores_per_executor']//self.cores_per_executor
+                candidate = self.__class__(**self._init_kwargs(**overrides))
+                candidate.submit()
+                candidates.append(candidate)
+
+            logger.info('Racing jobs %s'%', '.join([c.jobid for c in candidates]))
+
+            while winner is None: 
+                states = self._job_states()
+                for candidate in candidates: 
+                    if 'RUN' in states.get(candidate.jobid, ''):
+                        winner = candidate
+                        break
+                else: 
+                    time.sleep(poll_interval)
+        finally:
+            losers = [c for c in candidates if winner is None or c is not winner]
+            if len(losers) > 0: 
+                self._stop_many([c.jobid for c in losers])
+                import shutil
+                for c in losers: 
+                    os.remove(os.path.join(home_dir, '.sparkhpc%s'%c.jobid))
+                    shutil.rmtree(c.job_dir(), ignore_errors=True)
+
+        logger.info('Job %s started first with %d cores per executor'%(winner.jobid, winner.cores_per_executor))
+        self.prop_dict = winner.prop_dict
+        self.job_started()
+
+        return [sj.jobid for sj in self.current_clusters()].index(self.jobid)
+
+
     @classmethod
     def _submit_job(cls, jobfile): 
         """Submits the jobfile and returns the job ID"""
@@ -389,15 +1149,127 @@ class SparkJob(object):
 
 
     def stop(self): 
-        """Stop the current job"""
-        self._stop(self.jobid)
+        """
+        Stop the current job along with any worker jobs attached to it by `scale()` 
+        and the successor jobs queued by chaining
+
+        Only the jobs the scheduler still knows are cancelled; the earlier links of a 
+        chain have usually finished, and killing a finished job is an error on LSF. 
+        """
+        aux_jobs = self.prop_dict.get('aux_jobs', [])
+        jobids = [self.jobid] + self._successor_jobids()
+        # a successor that is being submitted right now finds the marker when it starts
+        for jobid in jobids: 
+            _update_endpoint(jobid, stopped=True)
+        states = self._job_states()
+        live = [jobid for jobid in jobids + [aux['jobid'] for aux in aux_jobs] if jobid in states]
+        if len(live) > 0: 
+            self._stop_many(live)
         self.prop_dict['status'] = 'stopped'
+        self.prop_dict['aux_jobs'] = []
+
+
+    def _successor_jobids(self): 
+        """Return the job IDs of the chain of successors of this job, as recorded in their metadata"""
+        jobids = []
+        jobid = self.jobid
+        while True: 
+            try: 
+                with open(os.path.join(home_dir, '.sparkhpc%s'%jobid)) as f: 
+                    successor = json.load(f).get('successor')
+            except (IOError, OSError, ValueError): 
+                break
+            if successor is None or successor == self.jobid or successor in jobids: 
+                break
+            jobids.append(successor)
+            jobid = successor
+        return jobids
+
+
+    def scale(self, n_executors, decommission_timeout=60): 
+        """
+        Grow or shrink the running cluster to `n_executors` executors
+
+        Scaling up submits an auxiliary worker-only job whose workers attach to 
+        this cluster's master through its endpoint record. Scaling down decommissions 
+        the workers of the most recently added auxiliary jobs, so that Spark can migrate 
+        their blocks and shuffle data, and cancels those jobs after `decommission_timeout` 
+        seconds. The executors of the original job are never removed. 
+
+        Returns the number of executors after scaling. 
+        """
+        aux_jobs = self.prop_dict.setdefault('aux_jobs', [])
+        base = self.ncores//self.cores_per_executor
+        current = base + sum([aux['executors'] for aux in aux_jobs])
+
+        if n_executors > current: 
+            executors = n_executors - current
+            jobid = self._submit_script(self._worker_script(executors))
+            aux_jobs.append({'jobid': jobid, 'executors': executors})
+            logger.info('Adding %d executors to job %s with job %s'%(executors, self.jobid, jobid))
+            current = n_executors
+
+        elif n_executors < current: 
+            remove = []
+            while len(aux_jobs) > 0 and current - aux_jobs[-1]['executors'] >= n_executors: 
+                aux = aux_jobs.pop()
+                remove.append(aux['jobid'])
+                current -= aux['executors']
+            if current > n_executors: 
+                logger.warning('Unable to shrink job %s below %d executors'%(self.jobid, current))
+            if len(remove) > 0: 
+                logger.info('Decommissioning workers of job(s) %s'%', '.join(remove))
+                self._signal_many(remove, 'PWR')
+                time.sleep(decommission_timeout)
+                self._stop_many(remove)
+
+        self._dump_to_json()
+        return current
+
+
+    def _worker_script(self, executors): 
+        """Return the script for a worker-only job that attaches `executors` executors to this cluster"""
+        walltime = self._walltime_minutes()
+        endpoint = _read_endpoint(self.jobid)
+        if endpoint is not None and 'started' in endpoint: 
+            # the workers are of no use once the cluster is gone
+            walltime = max(int(walltime - (time.time() - endpoint['started'])/60), 1)
+
+        return self._job_script(worker_templates[self.__class__], 
+                                walltime=self._format_walltime(walltime), 
+                                ncores=executors*self.cores_per_executor, 
+                                number_of_executors=executors, 
+                                jobname=self.jobname + '-workers', 
+                                parent=self.jobid, 
+                                # worker jobs end with the cluster and do not drain themselves
+                                extra_scheduler_options=self.extra_scheduler_options)
+
+
+    @classmethod
+    def _format_walltime(cls, minutes): 
+        """Format a walltime in minutes the way the job template expects it"""
+        return '%02d:%02d'%(minutes//60, minutes%60)
+
+
+    @classmethod
+    def _signal_many(cls, jobids, signal_name): 
+        """Send a signal to all processes of several jobs with a single scheduler call"""
+        command = shlex.split(cls._signal_command%signal_name) + list(jobids)
+        out = subprocess.check_output(command, stderr=subprocess.STDOUT).decode()
+        logger.info(out)
 
 
     @classmethod
     def _stop(cls, jobid):
-        out = subprocess.check_output([cls._kill_command, jobid], stderr=subprocess.STDOUT).decode()
+        cls._stop_many([jobid])
+
+
+    @classmethod
+    def _stop_many(cls, jobids):
+        """Kill several jobs with a single scheduler call"""
+        out = subprocess.check_output([cls._kill_command] + list(jobids), stderr=subprocess.STDOUT).decode()
         logger.info(out)
+        agent.notify('cancelled', jobids=list(jobids))
 
 
     def job_started(self): 
@@ -411,48 +1283,141 @@ class SparkJob(object):
 
     @classmethod 
     def _job_started(cls, jobid): 
+        return 'RUN' in cls._job_states().get(jobid, '')
+
+
+    @classmethod
+    def _job_states(cls):
+        """Return a dictionary of job ID -> scheduler state, from the agent if it is running"""
+        states = agent.query('states')
+        if states is None:
+            states = cls._query_job_states()
+        return states
+
+
+    @classmethod
+    def _query_job_states(cls):
+        """Return a dictionary of job ID -> scheduler state from a single scheduler query"""
         command = shlex.split(cls._get_current_jobs)
         logger.debug('job status command: ' + cls._get_current_jobs)
-        stat = subprocess.check_output(command).decode().split('\n')
+        stat = subprocess.check_output(command, stderr=subprocess.STDOUT).decode().split('\n')
         logger.debug('get_current_jobs: ' + '\n'.join(stat))
-        
-        running = False
 
-        for line in stat:
-            logger.debug('line: ' + ' '.join(line.split()))
-            if len(line.split()) > 0:
-                if line.split()[-1] == jobid:
-                    try: 
-                        running = 'RUN' in line.split()[1]
-                    except IndexError: 
-                        pass
-        return running
+        states = {}
+        for line in stat[1:]:
+            fields = line.split()
+            if len(fields) >= 3:
+                states[fields[-1]] = fields[1]
+        return states
 
 
     @classmethod
-    def current_clusters(cls):
-        """Determine which Spark clusters are currently running or in the queue"""
-        
-        # set up the command to query the scheduler for current jobs
-        command = shlex.split(cls._get_current_jobs)
-        
+    def current_clusters(cls, lightweight=False):
+        """
+        Determine which Spark clusters are currently running or in the queue
+
+        Parameters
+
+        lightweight: bool
+            instead of `SparkJob` instances, return a list of dictionaries built 
+            from one scheduler snapshot and the stored metadata; nothing blocks waiting 
+            for a master, and fields that are not known yet are set to 'pending'
+        """
+        if lightweight: 
+            records = cls._cluster_records()
+            for record in records: 
+                for k in ('master_url', 'master_ui', 'uptime', 'walltime_remaining'):
+                    if record[k] is None: 
+                        record[k] = 'pending'
+            return records
+
+        return [cls(jobid=jobid) for jobid in cls._registered_jobids()]
+
+
+    @classmethod
+    def _registered_jobids(cls, states=None):
+        """
+        Return the job IDs that have a metadata file and are known to the scheduler
+
+        The list is kept for `_allocate_clusterid`, so that the IDs it hands out match 
+        the clusters listed last. 
+        """
+        if states is None:
+            # the agent keeps both the registry and the scheduler snapshot
+            jobids = agent.query('clusters')
+            if jobids is not None:
+                return jobids
+            states = cls._query_job_states()
+
         # retrieve all the known job metadata files
-        sparkjob_files = glob.glob(os.path.join(os.path.expanduser('~'),'.sparkhpc*'))
+        sparkjob_files = [f for f in glob.glob(os.path.join(os.path.expanduser('~'),'.sparkhpc*')) 
+                          if re.match(r'\.sparkhpc\d+$', os.path.basename(f))]
         sparkjob_files.sort()
         logger.debug('sparkjob files found: ' + '\n'.join(sparkjob_files))
 
-        # get all the running job IDs from the scheduler
-        jobs = subprocess.check_output(command, stderr=subprocess.STDOUT).decode()
-        jobids = set([s.split()[2] for s in jobs.split('\n')[1:-1]])
+        # keep the job IDs that have a metadata file
+        jobids = [os.path.basename(fname)[9:] for fname in sparkjob_files 
+                  if os.path.basename(fname)[9:] in states]
+        with cls._submit_lock: 
+            cls._clusters_snapshot[cls] = (time.time(), list(jobids))
+        return jobids
 
-        # generate SparkJob instances from the collected job IDs that have a metadata file
-        sjs = []
-        for fname in sparkjob_files: 
-            jobid = os.path.basename(fname)[9:]
-            if jobid in jobids: 
-                sjs.append(cls(jobid=jobid))
-        
-        return sjs
+
+    @classmethod
+    def _cluster_records(cls, workers=False):
+        """
+        Return a list of dictionaries describing the current clusters
+
+        The records are built from a single scheduler snapshot, the metadata files 
+        and the endpoint records, without creating `SparkJob` instances or waiting 
+        for the masters to come up. If `workers` is True, the number of workers and 
+        cores attached is requested from each running master's web UI. 
+        """
+        states = cls._job_states()
+        now = time.time()
+
+        records = []
+        for clusterid, jobid in enumerate(cls._registered_jobids(states)):
+            try:
+                with open(os.path.join(home_dir, '.sparkhpc%s'%jobid)) as f:
+                    props = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            endpoint = _read_endpoint(jobid) or {}
+
+            walltime = props['walltime']
+            if not isinstance(walltime, int):
+                h,m = [int(x) for x in walltime.split(':')]
+                walltime = m + 60*h
+
+            record = {'clusterid': clusterid,
+                      'jobid': jobid,
+                      'jobname': props['jobname'],
+                      'ncores': props['ncores'],
+                      'cores_per_executor': props['cores_per_executor'],
+                      'status': states[jobid],
+                      'master_url': endpoint.get('master_url'),
+                      'master_ui': endpoint.get('master_ui'),
+                      'uptime': None,
+                      'walltime_remaining': None,
+                      'workers': None,
+                      'cores_attached': None,
+                      'pool_shape': props.get('pool_shape'),
+                      'leased': os.path.exists(_lease_filename(jobid)),
+                      'draining': endpoint.get('draining', False)}
+
+            if 'started' in endpoint: 
+                record['uptime'] = now - endpoint['started']
+                record['walltime_remaining'] = max(endpoint['started'] + 60*walltime - now, 0)
+
+            if workers and record['master_ui'] is not None and 'RUN' in record['status']:
+                status = _master_status(record['master_ui'])
+                if status is not None:
+                    record['workers'] = status.get('aliveworkers')
+                    record['cores_attached'] = status.get('cores')
+
+            records.append(record)
+        return records
 
 
     def show_clusters(self): 
@@ -478,7 +1443,13 @@ class SparkJob(object):
                     executor_memory=None,
                     profiling=False, 
                     graphframes_package='graphframes:graphframes:0.3.0-spark2.0-s_2.11', 
-                    extra_conf = None):
+                    extra_conf = None, 
+                    event_log=True, 
+                    event_log_compress=False, 
+                    dynamic_allocation=False, 
+                    min_executors=0, 
+                    max_executors=None, 
+                    executor_idle_timeout='60s'):
         """Launch a SparkContext 
         
         Parameters
@@ -489,13 +1460,32 @@ class SparkJob(object):
             executor memory in java memory string format, e.g. '4G'
             If `None`, `memory_per_executor` is used. 
         profiling: boolean
-            whether to turn on python profiling or not
+            whether to turn on python profiling or not; the profiles are written to the 
+            job directory when the context stops, see `profile_report`
         graphframes_package: string
             which graphframes to load - if it isn't found, spark will attempt to download it
         extra_conf: dict
             additional configuration options
+        event_log: boolean
+            whether to keep the Spark event log in the job directory for `analyze_event_logs`; 
+            a `spark.eventLog.dir` set in spark-defaults.conf is left alone
+        event_log_compress: boolean
+            whether to compress the event log with zstd; reading it back requires `zstandard`
+        dynamic_allocation: boolean
+            request executors only while there are tasks to run and release them when they 
+            have been idle for `executor_idle_timeout`, so that several applications can share 
+            the cluster; shuffle output is kept by the workers' external shuffle service
+        min_executors: int
+            number of executors to keep even when idle
+        max_executors: int
+            upper limit on the number of executors; default is all executors of the cluster
+        executor_idle_timeout: string
+            time after which an idle executor is released, e.g. '60s'
         """
 
+        if self.draining(): 
+            raise RuntimeError('Cluster %s is draining before the end of its walltime - start a new one'%self._serving_jobid())
+
         os.environ['PYSPARK_SUBMIT_ARGS'] = "--packages {graphframes_package} pyspark-shell"\
                                             .format(graphframes_package=graphframes_package)
         
@@ -504,7 +1494,12 @@ class SparkJob(object):
 
         os.environ['SPARK_CONF_DIR'] = os.path.realpath(spark_conf)
 
-        os.environ['PYSPARK_PYTHON'] = sys.executable
+        endpoint = _read_endpoint(self._serving_jobid())
+        if endpoint is not None and endpoint.get('pyspark_python'): 
+            # the workers use the copy of the environment on their node's local disk
+            os.environ['PYSPARK_PYTHON'] = endpoint['pyspark_python']
+        else: 
+            os.environ['PYSPARK_PYTHON'] = sys.executable
 
         try: 
             import findspark; findspark.init()
@@ -522,9 +1517,29 @@ class SparkJob(object):
         conf.set('spark.executor.memory', executor_memory)
 
         if profiling: 
+            # each driver run dumps its profiles into a directory of its own
+            profile_dir = os.path.join(self.job_dir(), 'profiles', 
+                                       '%s-%d'%(time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
             conf.set('spark.python.profile', 'true')
+            conf.set('spark.python.profile.dump', profile_dir)
         else:
             conf.set('spark.python.profile', 'false')
+
+        if endpoint is not None and endpoint.get('interface'): 
+            from . import interconnect
+            address = interconnect.select_address(endpoint['interface'])
+            if address is not None: 
+                # the executors connect back to the driver on the same network as the cluster
+                conf.set('spark.driver.host', address)
+
+        if dynamic_allocation: 
+            for k, v in self._dynamic_allocation_conf(endpoint, min_executors, max_executors, 
+                                                      executor_idle_timeout).items(): 
+                conf.set(k, v)
+
+        if event_log: 
+            for k, v in self._event_log_conf(spark_conf, event_log_compress).items(): 
+                conf.set(k, v)
         
         if extra_conf is not None: 
             for k,v in extra_conf.items(): 
@@ -532,20 +1547,175 @@ class SparkJob(object):
 
         sc = SparkContext(master=self.master_url(), conf=conf)
 
+        if profiling: 
+            _dump_profiles_on_stop(sc, profile_dir)
+
         return sc    
 
+    def _event_log_conf(self, spark_conf, compress=False): 
+        """
+        Return the Spark configuration for keeping the event log in the job directory
+
+        Nothing is changed if spark-defaults.conf in `spark_conf` already sends the event 
+        logs somewhere, e.g. to the directory of the site's History Server, or if the job 
+        has not been submitted and so has no directory. 
+        """
+        if self.jobid is None: 
+            return {}
+        site_dir = _spark_defaults(spark_conf).get('spark.eventLog.dir')
+        if site_dir is not None: 
+            logger.info('Event logs go to %s as configured in spark-defaults.conf'%site_dir)
+            return {}
+
+        event_log_dir = os.path.join(self.job_dir(), 'eventlogs')
+        if not os.path.exists(event_log_dir): 
+            os.makedirs(event_log_dir)
+        conf = {'spark.eventLog.enabled': 'true', 
+                'spark.eventLog.dir': 'file://' + event_log_dir}
+        if compress: 
+            conf['spark.eventLog.compress'] = 'true'
+            conf['spark.eventLog.compression.codec'] = 'zstd'
+        return conf
+
+    def _dynamic_allocation_conf(self, endpoint, min_executors=0, max_executors=None, executor_idle_timeout='60s'): 
+        """Return the Spark configuration for dynamic allocation on this cluster"""
+        if max_executors is None: 
+            max_executors = (self.ncores//self.cores_per_executor + 
+                             sum([aux['executors'] for aux in self.prop_dict.get('aux_jobs', [])]))
+
+        conf = {'spark.dynamicAllocation.enabled': 'true', 
+                'spark.dynamicAllocation.minExecutors': str(min_executors), 
+                'spark.dynamicAllocation.initialExecutors': str(min_executors), 
+                'spark.dynamicAllocation.maxExecutors': str(max_executors), 
+                'spark.dynamicAllocation.executorIdleTimeout': executor_idle_timeout, 
+                # one executor per worker, as without dynamic allocation
+                'spark.executor.cores': str(self.cores_per_executor)}
+
+        if endpoint is not None and endpoint.get('shuffle_service_port'): 
+            conf['spark.shuffle.service.enabled'] = 'true'
+            conf['spark.shuffle.service.port'] = str(endpoint['shuffle_service_port'])
+        else: 
+            # no shuffle service on the workers: keep executors that hold shuffle data (Spark 3.0+)
+            conf['spark.dynamicAllocation.shuffleTracking.enabled'] = 'true'
+        return conf
+
+
     def _sigint_handler(self, signal, frame): 
         """Handle ctrl-c from the user"""
         self.stop()
         sys.exit(0)
 
 
+def start_workers(parent, 
+                  memory, 
+                  cores_per_executor=1, 
+                  spark_home=None, 
+                  timeout=600, 
+                  python_env=None, 
+                  number_of_executors=None): 
+    """
+    Start workers that attach to the cluster running in another job
+
+    This is the script used by the worker-only jobs submitted by `SparkJob.scale`. 
+
+    Parameters
+
+    parent: string
+        job ID of the job running the Spark master
+    memory: string
+        memory specified using java memory format
+    cores_per_executor: int
+        number of cores per worker
+    spark_home: directory path
+        path to base spark installation
+    timeout: int
+        time in seconds to wait for the master to publish its address
+    python_env: path
+        packed Python environment to unpack on every node, into the same 
+        directory the master's job used
+    number_of_executors: int
+        number of workers to start; only used without a scheduler, where all 
+        workers run on the same machine
+    """
+    scheduler = get_scheduler()
+    master_launch_command, slaves_launch_command = get_launch_commands(scheduler)
+
+    if spark_home is None: 
+        spark_home = os.environ.get('SPARK_HOME', os.path.join(home_dir,'spark'))
+
+    os.environ['SPARK_EXECUTOR_MEMORY'] = '%s'%memory
+    os.environ['SPARK_WORKER_MEMORY'] = '%s'%memory
+    os.environ['SPARK_NO_DAEMONIZE'] = '1'
+    # let the worker migrate its blocks away when it receives SIGPWR on scale-down
+    os.environ['SPARK_WORKER_OPTS'] = (os.environ.get('SPARK_WORKER_OPTS', '') + 
+                                       ' -Dspark.decommission.enabled=true').strip()
+
+    start_time = time.time()
+    endpoint = _read_endpoint(parent)
+    while endpoint is None or 'master_url' not in endpoint: 
+        if time.time() - start_time > timeout: 
+            raise RuntimeError('The master of job %s did not publish its address within %d seconds'%(parent, timeout))
+        time.sleep(5)
+        endpoint = _read_endpoint(parent)
+
+    master_url = endpoint['master_url']
+    logger.info('['+bc.OKGREEN+'start_workers] '+bc.ENDC+'attaching to %s'%master_url)
+    if endpoint.get('interface'): 
+        master_launch_command, slaves_launch_command = get_launch_commands(scheduler, endpoint['interface'])
+
+    if endpoint.get('shuffle_service_port') and not (scheduler == 'local' and (number_of_executors or 1) > 1): 
+        _enable_shuffle_service(endpoint['shuffle_service_port'])
+
+    if python_env is not None and 'python_env_dir' in endpoint: 
+        _unpack_python_env(scheduler, python_env, endpoint['python_env_dir'])
+
+    stage = endpoint.get('stage')
+    if stage is not None: 
+        # the added nodes need the same inputs as the rest of the cluster
+        _stage_inputs(scheduler, stage['patterns'], stage['dir'], stage['verify'])
+
+    sys.stdout.flush()
+    slaves_command = slaves_launch_command.format(spark_home=spark_home, master_url=master_url, cores_per_executor=cores_per_executor, 
+                                                  number_of_executors=number_of_executors or 1)
+    logger.info('slaves command: ' + slaves_command)
+    p = _launch_workers(slaves_command, os.environ, scheduler)
+    p.wait()
+    if stage is not None and stage['cleanup']: 
+        _clean_staged(scheduler, stage['dir'])
+
+
+def current_job(): 
+    """Return the SparkJob of the cluster this process is running in, e.g. from a notebook started with `notebook=True`"""
+    jobid = _current_jobid()
+    if jobid is None: 
+        raise RuntimeError('Not running inside a scheduler job')
+    return sparkjob(jobid=jobid)
+
+
 def start_cluster(memory, 
                   cores_per_executor=1, 
                   timeout=30, 
                   spark_home=None, 
                   master_log_dir=None, 
-                  master_log_filename='spark_master.out'):
+                  master_log_filename='spark_master.out',
+                  chain=0,
+                  predecessor=None,
+                  application=None,
+                  application_args='',
+                  number_of_executors=None,
+                  worker_timeout=300,
+                  notebook=False,
+                  dynamic_ports=True,
+                  sample_interval=None,
+                  python_env=None,
+                  stage=None,
+                  stage_verify=False,
+                  stage_cleanup=True,
+                  shuffle_service=False,
+                  drain=None,
+                  checkpoint_dir=None,
+                  interface=None,
+                  master_restarts=3):
     """
     Start the spark cluster
 
@@ -564,11 +1734,85 @@ def start_cluster(memory,
         path to directory where the spark master process writes 
         its stdout/stderr to a file name spark_master.out
     master_log_filename: string
-        name of the file to write Spark master's output to.
+        name of the file to write Spark master's output to; inside a job, the 
+        job ID is added to the default name so that clusters sharing a node 
+        do not overwrite each other's log
+    chain: int
+        number of follow-on jobs still to be submitted; if nonzero, a successor 
+        job is submitted as soon as the master is up
+    predecessor: 
+        job ID of the job this cluster takes over from; its endpoint record 
+        is pointed at this job once the master is up
+    application: string
+        if given, run this application on the master node once all workers 
+        have registered and shut the cluster down when it finishes; either 
+        anything `spark-submit` accepts (a .py file, a jar, ...) or a Python 
+        entry point in `module:function` form. The application's exit status 
+        is used as the exit status of the job.
+    application_args: string
+        arguments passed on to the application
+    number_of_executors: int
+        number of workers to wait for before starting the application; 
+        if None, the application is started once the first worker registers
+    worker_timeout: int
+        time in seconds to wait for the workers to register
+    notebook: bool
+        start a Jupyter notebook server on the master node and publish its 
+        URL and token in the endpoint record; `current_job().start_spark()` 
+        inside the notebook connects to this cluster
+    dynamic_ports: bool
+        run the master and the workers on ports that are free on the master node 
+        instead of the Spark defaults, so that several clusters can share a node; 
+        the ports are published in the endpoint record
+    sample_interval: float
+        if given, record CPU, memory, JVM heap, disk and network usage on every 
+        node every `sample_interval` seconds into the job directory; 
+        summarize with `sparkcluster report <jobid>`
+    python_env: path
+        archive of a packed Python environment; it is unpacked to node-local 
+        disk on every node (or reused if an earlier job left it there) and the 
+        PySpark workers use the unpacked interpreter
+    stage: list
+        paths or glob patterns of inputs to copy to the local disk of every node 
+        before the workers start; the local paths are published in the endpoint record
+    stage_verify: bool
+        compare checksums of the staged copies with the originals
+    stage_cleanup: bool
+        remove the staged copies when the cluster shuts down
+    shuffle_service: bool
+        run the external shuffle service in every worker, so that applications using 
+        dynamic allocation can release executors without losing their shuffle output; 
+        it uses Spark's default port 7337 on every node, since each worker needs the 
+        same port and Spark does not fall back to another one, so only one cluster per 
+        node can enable it; the port is published in the endpoint record
+    drain: int
+        minutes of warning the scheduler gives before the walltime runs out; on the 
+        warning, the cluster is marked as draining in the endpoint record, the running 
+        applications get until a minute before the end to checkpoint and finish, and the 
+        workers are decommissioned before the job exits
+    checkpoint_dir: directory path
+        published in the endpoint record for the drivers to save their checkpoints to
+    interface: string
+        network for the Spark traffic as a comma-separated preference order of interface 
+        names, name patterns or subnets; the master and every worker bind to and advertise 
+        their address on the first match, or their default address if nothing matches
+    master_restarts: int
+        if nonzero, the master keeps its state in the job directory and is restarted up 
+        to this many times if it dies, on this node or, if it cannot start here, on another 
+        node of the job; the workers and applications re-register with the new master and 
+        its addresses are published in the endpoint record
     """
 
     scheduler = get_scheduler()
-    master_launch_command, slaves_launch_command = get_launch_commands(scheduler)
+    jobid = _current_jobid()
+
+    for j in (jobid, predecessor): 
+        endpoint = _read_endpoint(j) if j is not None else None
+        if endpoint is not None and endpoint.get('stopped'): 
+            logger.info('['+bc.WARNING+'start_cluster] '+bc.ENDC+'job %s was stopped - not starting'%j)
+            return
+
+    master_launch_command, slaves_launch_command = get_launch_commands(scheduler, interface)
 
     if spark_home is None: 
         spark_home = os.environ.get('SPARK_HOME', os.path.join(home_dir,'spark'))
@@ -579,7 +1823,49 @@ def start_cluster(memory,
     os.environ['SPARK_WORKER_MEMORY'] = '%s'%memory
     os.environ['SPARK_NO_DAEMONIZE'] = '1'
 
+    if dynamic_ports: 
+        # workers on other nodes fall back to the next port if theirs is taken (spark.port.maxRetries)
+        ports = {'master': _free_port(), 'master_ui': _free_port(), 
+                 'worker': _free_port(), 'worker_ui': _free_port()}
+        os.environ['SPARK_MASTER_PORT'] = str(ports['master'])
+        os.environ['SPARK_MASTER_WEBUI_PORT'] = str(ports['master_ui'])
+        os.environ['SPARK_WORKER_PORT'] = str(ports['worker'])
+        os.environ['SPARK_WORKER_WEBUI_PORT'] = str(ports['worker_ui'])
+        logger.info('using ports %s'%', '.join(['%s=%d'%(k, v) for k, v in sorted(ports.items())]))
+
+    if scheduler == 'local' and (number_of_executors or 1) > 1: 
+        # the workers would all try to run the service on the same port of this machine
+        shuffle_service = False
+    if shuffle_service: 
+        # a port that is free here may be taken on the other nodes
+        shuffle_port = 7337
+        _enable_shuffle_service(shuffle_port)
+
+    if drain: 
+        # let the workers migrate their blocks away when they are decommissioned
+        os.environ['SPARK_WORKER_OPTS'] = (os.environ.get('SPARK_WORKER_OPTS', '') + 
+                                           ' -Dspark.decommission.enabled=true').strip()
+
     env = os.environ
+
+    pyspark_python = None
+    if python_env is not None: 
+        import tempfile
+        python_env_dir = tempfile.gettempdir()
+        pyspark_python = _unpack_python_env(scheduler, python_env, python_env_dir)
+        if jobid is not None: 
+            _update_endpoint(jobid, pyspark_python=pyspark_python, python_env_dir=python_env_dir)
+
+    stage_dir = None
+    if stage: 
+        import tempfile
+        from . import staging
+        stage_dir = os.path.join(tempfile.gettempdir(), 'sparkhpc-stage-%s'%(jobid or os.getpid()))
+        _stage_inputs(scheduler, stage, stage_dir, stage_verify)
+        if jobid is not None: 
+            _update_endpoint(jobid, staged=staging.local_paths(stage, stage_dir), 
+                             stage={'patterns': stage, 'dir': stage_dir, 
+                                    'verify': stage_verify, 'cleanup': stage_cleanup})
     
     # Start the master
     master_command = os.path.join(spark_sbin, 'start-master.sh')
@@ -593,7 +1879,15 @@ def start_cluster(memory,
     else:
         import socket
         master_host=socket.gethostbyname(socket.gethostname())
+    # the address login nodes reach this node at, whatever network Spark uses
+    node_host = master_host
     
+    if interface: 
+        from . import interconnect
+        address = interconnect.apply(interface)
+        if address is not None: 
+            master_host = address
+
     os.environ['SPARK_MASTER_HOST'] = master_host
     logger.info('master command: ' + master_launch_command.format(master_command))
 
@@ -603,44 +1897,517 @@ def start_cluster(memory,
     if not os.path.exists(master_log_dir):
         os.makedirs(master_log_dir)
 
+    if jobid is not None and master_log_filename == 'spark_master.out': 
+        master_log_filename = 'spark_master-%s.out'%jobid
+
     master_log = os.path.join(master_log_dir,master_log_filename)
     logger.info('Logging spark master process output to:'+master_log)
-    outfile = open(master_log, 'w+')
-    master = subprocess.Popen(shlex.split(master_launch_command.format(master_command)), stdout=outfile, stderr=subprocess.STDOUT)
 
-    started = False
+    if master_restarts: 
+        # on the shared filesystem, so that a master on another node finds it as well
+        _enable_master_recovery(os.path.join(job_dir(jobid or os.getpid()), 'recovery'))
+
+    try: 
+        master, master_url, master_webui = _start_master(master_launch_command.format(master_command), 
+                                                         master_log, timeout)
+    except RuntimeError: 
+        subprocess.call('{spark_sbin}/stop-master.sh'.format(spark_sbin=spark_sbin))
+        raise
+
+    logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'master running at %s'%master_url)
+    logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'master UI available at %s'%master_webui)
+
+    if jobid is not None:
+        _update_endpoint(jobid, master_url=master_url, master_ui=master_webui, 
+                         master_host=master_host, started=time.time())
+        if dynamic_ports: 
+            _update_endpoint(jobid, ports=ports)
+        if shuffle_service: 
+            _update_endpoint(jobid, shuffle_service_port=shuffle_port)
+        if interface: 
+            _update_endpoint(jobid, interface=interface)
+        if predecessor is not None:
+            # switch clients over to this cluster; the old job drains until its walltime runs out
+            _update_endpoint(predecessor, successor=jobid)
+            logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'taking over from job %s'%predecessor)
+        if chain and not (_read_endpoint(jobid) or {}).get('stopped'): 
+            sparkjob(jobid=jobid).submit_successor()
+
+    sys.stdout.flush()
+    slaves_command = slaves_launch_command.format(spark_home=spark_home, master_url=master_url, cores_per_executor=cores_per_executor, 
+                                                  number_of_executors=number_of_executors or 1)
+    logger.info('slaves command: ' + slaves_command)
+    p = _launch_workers(slaves_command, env, scheduler)
+
+    sampler = None
+    if sample_interval and jobid is not None: 
+        sampler_command = get_node_launcher(scheduler, overlap=True) + '%s -m sparkhpc.sampler record %s %s'%(
+            sys.executable, os.path.join(job_dir(jobid), 'samples'), sample_interval)
+        logger.info('sampler command: ' + sampler_command)
+        sampler = subprocess.Popen(sampler_command, env=env, shell=True)
+
+    notebook_server = None
+    if notebook: 
+        notebook_server = _start_notebook(node_host, master_url, jobid)
+
+    supervisor = None
+    if master_restarts: 
+        def restart_master(host, attempt): 
+            if host is None: 
+                command = master_launch_command.format(master_command)
+            else: 
+                command = _remote_master_command(scheduler, host, master_command, interface)
+            return _start_master(command, '%s.%d'%(master_log, attempt), timeout, host)
+        supervisor = _MasterSupervisor(master, restart_master, jobid, master_restarts, 
+                                       _fallback_hosts(scheduler, master_host), 
+                                       on_failure=lambda: _stop_workers(p))
+        supervisor.start()
+
+    if drain: 
+        def drain_handler(signum, frame): 
+            _drain(jobid, master_webui, p, drain, checkpoint_dir, supervisor)
+        for name in ('SIGUSR1', 'SIGURG'): 
+            signal.signal(getattr(signal, name), drain_handler)
+
+    if application is None: 
+        p.wait()
+        if supervisor is not None: 
+            supervisor.stop()
+        for proc in (notebook_server, sampler): 
+            if proc is not None: 
+                proc.terminate()
+        if stage_dir is not None and stage_cleanup: 
+            _clean_staged(scheduler, stage_dir)
+        return
+
+    try: 
+        _wait_for_workers(master_webui, number_of_executors or 1, worker_timeout)
+        if jobid is not None: 
+            _update_endpoint(jobid, application=application, application_status='running')
+        returncode = _run_application(application, application_args, master_url, spark_home, pyspark_python)
+        if jobid is not None: 
+            _update_endpoint(jobid, application_status='finished', application_returncode=returncode)
+    finally:
+        # release the allocation as soon as the application is done
+        _stop_workers(p)
+        if supervisor is not None: 
+            master = supervisor.stop()
+        master.terminate()
+        for proc in (notebook_server, sampler): 
+            if proc is not None: 
+                proc.terminate()
+        if stage_dir is not None and stage_cleanup: 
+            _clean_staged(scheduler, stage_dir)
+
+    logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'application exited with status %d'%returncode)
+    sys.exit(returncode)
+
+
+def _drain(jobid, master_webui, workers, minutes, checkpoint_dir, supervisor=None): 
+    """Wind the cluster down before the walltime runs out, giving the drivers a chance to checkpoint"""
+    logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'walltime warning received - draining')
+    if supervisor is not None: 
+        # the master is not brought back while the cluster shuts down
+        supervisor.stop()
+    if jobid is not None: 
+        _update_endpoint(jobid, draining=True, drain_started=time.time(), checkpoint_dir=checkpoint_dir)
+
+    # the last minute is for decommissioning the workers
+    deadline = time.time() + max(60*minutes - 60, 0)
+    while time.time() < deadline: 
+        status = _master_status(master_webui)
+        if status is None or len(status.get('activeapps', [])) == 0: 
+            break
+        time.sleep(5)
+
+    if jobid is not None and hasattr(signal, 'SIGPWR'): 
+        # some schedulers deliver the signal to this process as well
+        signal.signal(signal.SIGPWR, signal.SIG_IGN)
+        try: 
+            sparkjob._signal_many([jobid], 'PWR')
+            time.sleep(min(30, 60*minutes))
+        except Exception as e: 
+            logger.warning('unable to decommission the workers: %s'%e)
+    _stop_workers(workers)
+
+
+def _launch_workers(command, env, scheduler): 
+    """
+    Start the workers with `command` and return the process
+
+    Local workers are backgrounded by a shell loop, so they get a process group of their own 
+    that `_stop_workers` can signal; terminating this process then stops them as well. 
+    """
+    if scheduler != 'local': 
+        return subprocess.Popen(command, env=env, shell=True)
+
+    workers = subprocess.Popen(command, env=env, shell=True, preexec_fn=os.setpgrp)
+    workers.process_group = True
+    def terminate(signum, frame): 
+        _stop_workers(workers)
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, terminate)
+    return workers
+
+
+def _stop_workers(workers): 
+    """Terminate the workers started by `_launch_workers`, including the children of a local worker loop"""
+    if getattr(workers, 'process_group', False): 
+        try: 
+            os.killpg(workers.pid, signal.SIGTERM)
+        except OSError: 
+            # all gone already
+            pass
+    else: 
+        workers.terminate()
+
+
+def _ignore_drain_signals(): 
+    """
+    Keep the master out of the drain: LSF sends the walltime warning to every process of 
+    the job, and the decommissioning signal is only meant for the workers
+    """
+    for name in ('SIGURG', 'SIGPWR'): 
+        if hasattr(signal, name): 
+            signal.signal(getattr(signal, name), signal.SIG_IGN)
+
+
+def _start_master(command, master_log, timeout, host=None): 
+    """
+    Start a Spark master with `command` and wait until it reports its addresses
+
+    With `host`, the master advertises that host instead of SPARK_MASTER_HOST. 
+    Returns the process, the master URL and the web UI address. 
+    """
+    env = dict(os.environ)
+    if host is not None: 
+        from . import interconnect
+        env['SPARK_MASTER_HOST'] = host
+        # the address of this node is of no use on the other one
+        for var in interconnect.address_variables: 
+            env.pop(var, None)
+    with open(master_log, 'w+') as outfile: 
+        master = subprocess.Popen(shlex.split(command), stdout=outfile, stderr=subprocess.STDOUT, env=env, 
+                                  preexec_fn=_ignore_drain_signals)
+
     start_time = time.time()
-    while not started: 
+    while True: 
         with open(master_log,'r') as f: 
             log = f.read()
         try : 
-            master_url, master_webui = re.findall('(spark://\S+:\d{4}|http://\S+:\d{4})', log)
-            started = True
+            master_url, master_webui = re.findall(r'(spark://\S+:\d+|http://\S+:\d+)', log)
+            return master, master_url, master_webui
         except ValueError: 
+            if master.poll() is not None: 
+                raise RuntimeError('Spark master exited with status %d -- check the logs at: %s'%(master.returncode, master_log))
             if time.time() - start_time < timeout:
                 time.sleep(.5)
-                pass
             else:
-                subprocess.call('{spark_sbin}/stop-master.sh'.format(spark_sbin=spark_sbin))
+                master.terminate()
                 raise RuntimeError('Spark master appears to not be starting -- check the logs at: %s'%master_log)
 
-    logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'master running at %s'%master_url)
-    logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'master UI available at %s'%master_webui)
 
-    sys.stdout.flush()
-    slaves_command = slaves_launch_command.format(spark_home=spark_home, master_url=master_url, cores_per_executor=cores_per_executor)
-    logger.info('slaves command: ' + slaves_command)
-    p = subprocess.Popen(slaves_command, env = env, shell=True)
-    p.wait()
+def _enable_master_recovery(directory): 
+    """Make the master started from this process keep its state in `directory` and recover it on restart"""
+    if not os.path.exists(directory): 
+        os.makedirs(directory)
+    os.environ['SPARK_MASTER_OPTS'] = (os.environ.get('SPARK_MASTER_OPTS', '') + 
+                                       ' -Dspark.deploy.recoveryMode=FILESYSTEM -Dspark.deploy.recoveryDirectory=%s'%directory).strip()
+    logger.info('master state kept in %s'%directory)
+
+
+def _remote_launcher(scheduler, host): 
+    """Return the command prefix that runs a command once on `host`, another node of the job"""
+    if scheduler == 'slurm':
+        return 'srun --overlap --nodes=1 --ntasks=1 --nodelist=%s '%host
+    elif scheduler == 'lsf':
+        return 'blaunch %s '%host
+    else:
+        raise RuntimeError('Unable to start processes on other nodes with scheduler %s'%scheduler)
+
+
+def _remote_master_command(scheduler, host, master_command, interface=None): 
+    """Return the command that starts the master on `host`, resolving the address on `interface` there"""
+    command = _remote_launcher(scheduler, host)
+    if interface: 
+        command += '%s -m sparkhpc.interconnect --master %s '%(sys.executable, quote(interface))
+    return command + master_command
+
+
+def _fallback_hosts(scheduler, master_host): 
+    """Return the other nodes of the job, where the master can be restarted if it cannot run on this one"""
+    import socket
+    try: 
+        if scheduler == 'slurm' and 'SLURM_JOB_NODELIST' in os.environ: 
+            hosts = subprocess.check_output(['scontrol', 'show', 'hostnames', os.environ['SLURM_JOB_NODELIST']]).decode().split()
+        elif scheduler == 'lsf': 
+            hosts = os.environ.get('LSB_HOSTS', '').split()
+        else: 
+            return []
+    except (OSError, subprocess.CalledProcessError): 
+        return []
+
+    this_node = [master_host.split('.')[0], socket.gethostname().split('.')[0]]
+    fallback = []
+    for host in hosts: 
+        host = host.split('.')[0]
+        if host not in this_node and host not in fallback: 
+            fallback.append(host)
+    return fallback
+
+
+class _MasterSupervisor(object): 
+    """
+    Restart the Spark master of a job whenever it dies
+
+    Each restart is tried on this node first and then on the `fallback_hosts` in turn; 
+    `restart(host, attempt)` starts a master (on this node if `host` is None) and returns 
+    the process, the master URL and the web UI address. The new addresses are published 
+    in the endpoint record. If no master can be started, or after `max_restarts` restarts, 
+    `on_failure` is called and the supervisor gives up. 
+    """
+
+    def __init__(self, master, restart, jobid, max_restarts, fallback_hosts=(), poll_interval=5, on_failure=None): 
+        self.master = master
+        self.restart = restart
+        self.jobid = jobid
+        self.max_restarts = max_restarts
+        self.fallback_hosts = list(fallback_hosts)
+        self.poll_interval = poll_interval
+        self.on_failure = on_failure
+        self.restarts = 0
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self): 
+        """Supervise the master from a background thread"""
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self): 
+        """Stop supervising and return the current master process"""
+        with self._lock: 
+            self._stopped.set()
+            return self.master
+
+    def _run(self): 
+        while not self._stopped.wait(self.poll_interval): 
+            if not self.check(): 
+                break
+
+    def check(self): 
+        """Restart the master if it has died; returns False once the master is gone for good"""
+        with self._lock: 
+            if self._stopped.is_set() or self.master.poll() is None: 
+                return True
+
+            logger.warning('['+bc.WARNING+'start_cluster] '+bc.ENDC+'master exited with status %s'%self.master.returncode)
+            if self.restarts < self.max_restarts: 
+                self.restarts += 1
+                for host in [None] + self.fallback_hosts: 
+                    try: 
+                        master, master_url, master_webui = self.restart(host, self.restarts)
+                    except (RuntimeError, OSError) as e: 
+                        logger.warning('unable to restart the master on %s: %s'%(host or 'this node', e))
+                        continue
+                    self.master = master
+                    logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'master restarted at %s'%master_url)
+                    if self.jobid is not None: 
+                        _update_endpoint(self.jobid, master_url=master_url, master_ui=master_webui, 
+                                         master_restarts=self.restarts)
+                        if host is not None: 
+                            _update_endpoint(self.jobid, master_host=host)
+                    return True
+
+            logger.error('['+bc.FAIL+'start_cluster] '+bc.ENDC+'giving up on the master after %d restarts'%self.restarts)
+            self._stopped.set()
+            if self.on_failure is not None: 
+                self.on_failure()
+            return False
+
+
+def _spark_defaults(conf_dir): 
+    """Return the properties set in spark-defaults.conf in `conf_dir`"""
+    props = {}
+    path = os.path.join(conf_dir, 'spark-defaults.conf')
+    if os.path.exists(path): 
+        with open(path) as f: 
+            for line in f: 
+                m = re.match(r'\s*([^#\s=:]+)\s*[=:\s]\s*(.*?)\s*$', line)
+                if m is not None: 
+                    props[m.group(1)] = m.group(2)
+    return props
+
+
+def _checkpoint_url(path): 
+    """Executors have to write checkpoints to the shared filesystem, not their default filesystem"""
+    return path if '://' in path else 'file://' + os.path.abspath(path)
+
+
+def _enable_shuffle_service(port): 
+    """Make the workers started from this process run the external shuffle service on `port`"""
+    os.environ['SPARK_WORKER_OPTS'] = (os.environ.get('SPARK_WORKER_OPTS', '') + 
+                                       ' -Dspark.shuffle.service.enabled=true -Dspark.shuffle.service.port=%d'%port).strip()
+    logger.info('external shuffle service on port %d'%port)
+
+
+def _run_on_nodes(scheduler, module, *args): 
+    """Run `python -m module args` once on every node of the job and wait for it to finish"""
+    command = get_node_launcher(scheduler) + ' '.join([quote(x) for x in (sys.executable, '-m', module) + args])
+    logger.info('node command: ' + command)
+    subprocess.check_call(command, shell=True)
+
+
+def _unpack_python_env(scheduler, archive, local_dir): 
+    """Unpack the packed environment `archive` under `local_dir` on every node and return the local interpreter"""
+    from . import pyenv
+    _run_on_nodes(scheduler, 'sparkhpc.pyenv', 'unpack', archive, local_dir)
+    return pyenv.local_python(archive, local_dir)
+
+
+def _stage_inputs(scheduler, patterns, stage_dir, verify=False): 
+    """Copy the inputs matched by `patterns` to `stage_dir` on every node"""
+    logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'staging %s to %s'%(', '.join(patterns), stage_dir))
+    _run_on_nodes(scheduler, 'sparkhpc.staging', 'verify' if verify else 'copy', stage_dir, *patterns)
+
+
+def _clean_staged(scheduler, stage_dir): 
+    """Remove the staged inputs from every node"""
+    try: 
+        _run_on_nodes(scheduler, 'sparkhpc.staging', 'clean', stage_dir)
+    except subprocess.CalledProcessError as e: 
+        logger.warning('unable to remove the staged inputs: %s'%e)
+
+
+def _dump_profiles_on_stop(sc, path): 
+    """Make `sc.stop()` write the Python profiles collected so far to `path` before stopping"""
+    stop = sc.stop
+    def stop_and_dump(): 
+        if sc._jsc is not None: 
+            sc.dump_profiles(path)
+            logger.info('Python worker profiles written to %s'%path)
+        stop()
+    sc.stop = stop_and_dump
+
+
+def _free_port(host=''):
+    """Return a port that is currently free on this node"""
+    import socket
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try: 
+        s.bind((host, 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def _notebook_token_option(version=None): 
+    """Return the option that sets the login token; Notebook 7 is built on Jupyter Server"""
+    if version is None: 
+        try: 
+            from notebook import __version__ as version
+        except ImportError: 
+            version = '0'
+    major = re.match(r'\d*', version).group(0)
+    return '--%s.token'%('ServerApp' if major and int(major) >= 7 else 'NotebookApp')
+
+
+def _wait_for_port(host, port, process, timeout): 
+    """Wait until `process` accepts connections on `port`; returns False if it exits or times out first"""
+    import socket
+    start_time = time.time()
+    while process.poll() is None and time.time() - start_time < timeout: 
+        try: 
+            socket.create_connection((host, port), 1).close()
+            return True
+        except (socket.error, socket.timeout): 
+            time.sleep(0.5)
+    return False
+
+
+def _start_notebook(host, master_url, jobid, timeout=120): 
+    """
+    Start a Jupyter notebook server on this node and publish its URL in the endpoint record
+
+    The URL is only published once the server accepts connections; if it does not come up 
+    within `timeout` seconds, the failure is recorded instead and None is returned. 
+    """
+    import binascii
+    token = binascii.hexlify(os.urandom(24)).decode()
+    port = _free_port()
 
-    outfile.close()
+    env = dict(os.environ)
+    env['SPARKHPC_MASTER_URL'] = master_url
+
+    command = [sys.executable, '-m', 'notebook', '--no-browser', '--ip=%s'%host, '--port=%d'%port, 
+               '%s=%s'%(_notebook_token_option(), token), '--notebook-dir=%s'%os.getcwd()]
+    notebook_server = subprocess.Popen(command, env=env)
+
+    if not _wait_for_port(host, port, notebook_server, timeout): 
+        if notebook_server.poll() is None: 
+            notebook_server.terminate()
+            error = 'not listening on port %d after %d seconds'%(port, timeout)
+        else: 
+            error = 'exited with status %d'%notebook_server.returncode
+        logger.error('['+bc.FAIL+'start_cluster] '+bc.ENDC+'the notebook server %s'%error)
+        if jobid is not None: 
+            _update_endpoint(jobid, notebook_error=error)
+        return None
+
+    notebook_url = 'http://%s:%d/?token=%s'%(host, port, token)
+    if jobid is not None: 
+        _update_endpoint(jobid, notebook_url=notebook_url)
+    logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'notebook running at http://%s:%d'%(host, port))
+    return notebook_server
+
+
+def _wait_for_workers(master_webui, number_of_executors, timeout): 
+    """Block until `number_of_executors` workers have registered with the master"""
+    start_time = time.time()
+    while True: 
+        status = _master_status(master_webui)
+        alive = status.get('aliveworkers', 0) if status is not None else 0
+        if alive >= number_of_executors: 
+            logger.info('['+bc.OKGREEN+'start_cluster] '+bc.ENDC+'%d workers registered'%alive)
+            return
+        if time.time() - start_time > timeout: 
+            raise RuntimeError('Only %d out of %d workers registered within %d seconds'%(alive, number_of_executors, timeout))
+        time.sleep(1)
+
+
+def _run_application(application, application_args, master_url, spark_home, pyspark_python=None): 
+    """Run the application against the cluster and return its exit status"""
+    env = dict(os.environ)
+    env['SPARKHPC_MASTER_URL'] = master_url
+    if pyspark_python is not None: 
+        # the workers use the environment unpacked to their node
+        env['PYSPARK_PYTHON'] = pyspark_python
+
+    if re.match(r'^[\w\.]+:\w+$', application): 
+        # python entry point - a SparkContext created without a master connects to this cluster
+        module, function = application.split(':')
+        env['PYSPARK_SUBMIT_ARGS'] = '--master %s pyspark-shell'%master_url
+        command = [sys.executable, '-c', 
+                   'import sys, %s; sys.exit(%s.%s(*sys.argv[1:]))'%(module, module, function)]
+    else: 
+        command = [os.path.join(spark_home, 'bin', 'spark-submit'), '--master', master_url, application]
+    command += shlex.split(application_args)
+
+    logger.info('application command: ' + ' '.join(command))
+    sys.stdout.flush()
+    return subprocess.call(command, env=env)
 
 
 from .lsfsparkjob import LSFSparkJob
 from .slurmsparkjob import SLURMSparkJob
+from .localsparkjob import LocalSparkJob
 
-templates = {LSFSparkJob: 'sparkjob.lsf.template', SLURMSparkJob: 'sparkjob.slurm.template'}
-_sparkjob_registry = {'lsf': LSFSparkJob, 'slurm': SLURMSparkJob}
+templates = {LSFSparkJob: 'sparkjob.lsf.template', SLURMSparkJob: 'sparkjob.slurm.template', 
+             LocalSparkJob: 'sparkjob.local.template'}
+worker_templates = {LSFSparkJob: 'sparkworker.lsf.template', SLURMSparkJob: 'sparkworker.slurm.template', 
+                    LocalSparkJob: 'sparkworker.local.template'}
+_sparkjob_registry = {'lsf': LSFSparkJob, 'slurm': SLURMSparkJob, 'local': LocalSparkJob}
 
 def _sparkjob_factory(scheduler): 
     """Return the correct class for the given scheduler"""
@@ -0,0 +1,133 @@
+#
+#
+# Staging of input data to node-local storage
+#
+# `start_cluster` runs `python -m sparkhpc.staging copy <dir> <pattern> ...` once
+# on every node before the workers start, so that every node holds a complete
+# copy of the inputs under the same local path. Each input matched by the
+# patterns is copied to <dir>/<basename>; the files are copied by several
+# threads at once and a node skips files that an earlier attempt already copied.
+#
+#
+from __future__ import print_function
+import os
+import sys
+import glob
+import zlib
+import shutil
+import logging
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger('sparkhpc.staging')
+
+
+def _matches(patterns):
+    matches = []
+    for pattern in patterns:
+        if pattern.startswith('~'):
+            pattern = os.path.expanduser(pattern)
+        found = sorted(glob.glob(pattern))
+        if len(found) == 0:
+            raise RuntimeError('Nothing to stage matches %s'%pattern)
+        matches += [os.path.abspath(f) for f in found]
+    return matches
+
+
+def local_paths(patterns, stage_dir):
+    """Return a dictionary mapping each input matched by `patterns` to its path under `stage_dir`"""
+    paths = {}
+    for src in _matches(patterns):
+        dst = os.path.join(stage_dir, os.path.basename(src.rstrip('/')))
+        if dst in paths.values():
+            raise RuntimeError('More than one input to stage is called %s'%os.path.basename(dst))
+        paths[src] = dst
+    return paths
+
+
+def _files(patterns, stage_dir):
+    """Return (source, destination, size) for every file to copy, largest first"""
+    files = []
+    for src, dst in local_paths(patterns, stage_dir).items():
+        if os.path.isdir(src):
+            for root, dirs, names in os.walk(src):
+                for name in names:
+                    path = os.path.join(root, name)
+                    files.append((path, os.path.join(dst, os.path.relpath(path, src)), os.path.getsize(path)))
+        else:
+            files.append((src, dst, os.path.getsize(src)))
+    # the largest files first so that the threads finish at about the same time
+    return sorted(files, key=lambda f: -f[2])
+
+
+def _checksum(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def _copy(args):
+    src, dst, size, verify = args
+    st = os.stat(src)
+    if os.path.exists(dst) and os.path.getsize(dst) == size and int(os.path.getmtime(dst)) == int(st.st_mtime):
+        return 0
+
+    parent = os.path.dirname(dst)
+    if not os.path.exists(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # created by another thread in the meantime
+            pass
+    tmp = dst + '.staging'
+    shutil.copy2(src, tmp)
+    if verify and _checksum(src) != _checksum(tmp):
+        os.remove(tmp)
+        raise RuntimeError('Staged copy of %s does not match the original'%src)
+    os.rename(tmp, dst)
+    return size
+
+
+def copy(patterns, stage_dir, verify=False, threads=8):
+    """
+    Copy the inputs matched by `patterns` to `stage_dir` on this node
+
+    Parameters
+
+    patterns: list
+        paths or glob patterns of files and directories
+    stage_dir: directory path
+        local directory to copy to
+    verify: bool
+        compare checksums of every copy with its original
+    threads: int
+        number of files copied at once
+
+    Returns the number of bytes copied.
+    """
+    files = _files(patterns, stage_dir)
+    pool = ThreadPool(threads)
+    try:
+        copied = sum(pool.map(_copy, [f + (verify,) for f in files], chunksize=1))
+    finally:
+        pool.close()
+    logger.info('Staged %d files (%.1f MB copied) to %s'%(len(files), copied/1024./1024., stage_dir))
+    return copied
+
+
+def clean(stage_dir):
+    """Remove the staged copies on this node"""
+    shutil.rmtree(stage_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) >= 4 and sys.argv[1] in ('copy', 'verify'):
+        copy(sys.argv[3:], sys.argv[2], verify=sys.argv[1] == 'verify')
+    elif len(sys.argv) == 3 and sys.argv[1] == 'clean':
+        clean(sys.argv[2])
+    else:
+        print('usage: python -m sparkhpc.staging copy|verify <directory> <pattern> ...\n'
+              '       python -m sparkhpc.staging clean <directory>')
+        sys.exit(1)
@@ -2,6 +2,9 @@ import pytest
 import os
 import sparkhpc 
 import sys
+import time
+import shutil
+import glob
 
 if sys.version_info.major == 2: 
     fnfe = (OSError, IOError)
@@ -54,6 +57,11 @@ def sj(monkeypatch, request):
         os.remove(os.path.join(testdir,'.sparkhpc1'))
     except fnfe:
         pass
+
+    for jobid in ['0', '1', '5']:
+        shutil.rmtree(sparkhpc.sparkjob.job_dir(jobid), ignore_errors=True)
+        if os.path.exists(sparkhpc.sparkjob._endpoint_filename(jobid)):
+            os.remove(sparkhpc.sparkjob._endpoint_filename(jobid))
     
 def test_job_submission(sj):
     clusterid = sj.submit()
@@ -131,4 +139,1041 @@ def test_pretty_prints(sj, monkeypatch):
     monkeypatch.setattr(sparkhpc.sparkjob, 'IPYTHON', True)
 
     sj.show_clusters()
-    
\ No newline at end of file
+    
+
+def test_endpoint_record(sj):
+    sj.submit()
+    sparkhpc.sparkjob._update_endpoint(sj.jobid, master_url='spark://2.2.2.2:7077', master_ui='http://2.2.2.2:8080')
+    assert(sj.master_url() == 'spark://2.2.2.2:7077')
+    assert(sj.master_ui() == 'http://2.2.2.2:8080')
+    os.remove(sparkhpc.sparkjob._endpoint_filename(sj.jobid))
+
+
+def test_chained_successor(sj, monkeypatch):
+    sj.submit()
+    # the successor only takes over once its master has published an address
+    sparkhpc.sparkjob._update_endpoint(sj.jobid, successor='2')
+    assert(sj._serving_jobid() == '1')
+    sparkhpc.sparkjob._update_endpoint('2', master_url='spark://2.2.2.2:7077')
+    assert(sj._serving_jobid() == '2')
+    for jobid in ['1','2']:
+        os.remove(sparkhpc.sparkjob._endpoint_filename(jobid))
+
+    begin = sj._begin_option(50)
+    assert(begin.startswith('#SBATCH --begin=now+50minutes') or begin.startswith('#BSUB -b'))
+
+    # every generation is delayed once, however long the chain
+    scripts = []
+    def submit_job(cls, jobfile):
+        with open(jobfile) as f:
+            scripts.append(f.read())
+        return str(len(scripts) + 1)
+    monkeypatch.setattr(sj.__class__, '_submit_job', classmethod(submit_job))
+    sj2 = sj.__class__(jobid='1').submit_successor()
+    sj2.submit_successor()
+    assert(len(scripts) == 2)
+    begin_directive = '#SBATCH --begin' if isinstance(sj, sparkhpc.SLURMSparkJob) else '#BSUB -b'
+    for script in scripts:
+        assert(script.count(begin_directive) == 1)
+    assert(sj2.extra_scheduler_options == sj.extra_scheduler_options)
+    for jobid in ['2', '3']:
+        os.remove(os.path.join(testdir, '.sparkhpc%s'%jobid))
+        shutil.rmtree(sparkhpc.sparkjob.job_dir(jobid))
+
+
+def test_stop_chain(sj, monkeypatch):
+    sj.submit()
+    jobids = iter(['2', '3'])
+    monkeypatch.setattr(sj.__class__, '_submit_job', classmethod(lambda cls, jobfile: next(jobids)))
+    killed = []
+    monkeypatch.setattr(sj.__class__, '_stop_many', classmethod(lambda cls, jobids: killed.extend(jobids)))
+
+    # each generation queues the next one from inside its job
+    sj.__class__(jobid='1').submit_successor()
+    sj.__class__(jobid='2').submit_successor()
+    with monkeypatch.context() as m:
+        m.setattr(sj.__class__, '_job_states', classmethod(lambda cls: {'1': 'RUN', '2': 'PEND', '3': 'PEND'}))
+        sj.stop()
+    assert(killed == ['1', '2', '3'])
+
+    # the links of the chain that have finished are not cancelled again
+    del killed[:]
+    with monkeypatch.context() as m:
+        m.setattr(sj.__class__, '_job_states', classmethod(lambda cls: {'3': 'PEND'}))
+        sj.stop()
+    assert(killed == ['3'])
+
+    # a successor that starts anyway does not serve the stopped cluster
+    assert(sparkhpc.sparkjob.start_cluster('1000M', predecessor='2') is None)
+    for jobid in ['1', '2', '3']:
+        os.remove(sparkhpc.sparkjob._endpoint_filename(jobid))
+    for jobid in ['2', '3']:
+        os.remove(os.path.join(testdir, '.sparkhpc%s'%jobid))
+        shutil.rmtree(sparkhpc.sparkjob.job_dir(jobid))
+
+
+def test_init_kwargs(sj, tmpdir):
+    kwargs = dict(ncores=8, cores_per_executor=2, walltime='01:10', memory_per_core=1000, memory_per_executor=3000,
+                  jobname='roundtrip', extra_scheduler_options='#SBATCH -p big', chain=2, chain_overlap=5,
+                  predecessor='7', layouts=[2, 4], application='app.py', application_args='-x', notebook=True,
+                  sample_interval=5, pack_env=True, stage=['/data/*'], stage_verify=True, stage_cleanup=False,
+                  drain=10, checkpoint_dir=str(tmpdir), interface='ib0', master_restarts=1,
+                  shuffle_service=True)
+    original = sj.__class__(**kwargs)
+    copy = sj.__class__(**original._init_kwargs())
+    assert(copy.prop_dict == original.prop_dict)
+    # every constructor argument but the identity of the job is carried over
+    code = sparkhpc.sparkjob.SparkJob.__init__.__code__
+    missing = set(code.co_varnames[1:code.co_argcount]) - set(original._init_kwargs())
+    assert(missing == set(['clusterid', 'jobid']))
+
+    # a layout picked by optimize_shape is picked again
+    optimized = sj.__class__(ncores=4, optimize_shape=True)
+    optimized._set_layout(2, 1, optimized.memory_per_executor)
+    copy = sj.__class__(**optimized._init_kwargs())
+    assert(copy.optimize_shape and not copy.fixed_layout and copy.memory_per_executor == 2000)
+
+
+def test_optimize_shape(sj):
+    sj2 = sj.__class__(ncores=4, optimize_shape=True)
+    sj2.submit()
+    # the mock sbatch starts jobs on fewer nodes sooner, the mock bhosts has enough free slots for any layout
+    if isinstance(sj2, sparkhpc.SLURMSparkJob):
+        assert(sj2.cores_per_executor == 4)
+    else:
+        assert(sj2.cores_per_executor == 1)
+    assert(sj2.memory_per_executor == sj2.memory_per_core*sj2.cores_per_executor)
+
+    # a layout given by the user is honoured
+    sj3 = sj.__class__(ncores=4, cores_per_executor=2, optimize_shape=True)
+    sj3._select_layout()
+    assert(sj3.cores_per_executor == 2)
+
+
+def test_submit_race(sj, monkeypatch):
+    # the mock schedulers list job 0 as pending and job 1 as running
+    jobids = iter(['0', '1'])
+    monkeypatch.setattr(sj.__class__, '_submit_job', classmethod(lambda cls, jobfile: next(jobids)))
+    killed = []
+    monkeypatch.setattr(sj.__class__, '_stop_many', classmethod(lambda cls, jobids: killed.extend(jobids)))
+
+    clusterid = sj.submit_race([1, 2], poll_interval=0)
+    assert(sj.jobid == '1')
+    assert(sj.cores_per_executor == 2)
+    assert(killed == ['0'])
+    assert(not os.path.exists(os.path.join(testdir, '.sparkhpc0')))
+    assert(clusterid == 0)
+
+
+def test_concurrent_submission(sj, monkeypatch):
+    from multiprocessing.pool import ThreadPool
+    import itertools
+    import pkg_resources
+
+    counter = itertools.count(100)
+    submitted = {}
+    def submit_job(cls, jobfile):
+        jobid = str(next(counter))
+        with open(jobfile) as f:
+            submitted[jobid] = f.read()
+        return jobid
+    monkeypatch.setattr(sj.__class__, '_submit_job', classmethod(submit_job))
+
+    queries, loads = [], []
+    query = sj.__class__._query_job_states
+    monkeypatch.setattr(sj.__class__, '_query_job_states', classmethod(lambda cls: queries.append(1) or query()))
+    load = pkg_resources.resource_string
+    monkeypatch.setattr(pkg_resources, 'resource_string', lambda *args: loads.append(1) or load(*args))
+    monkeypatch.setattr(sparkhpc.sparkjob, '_template_cache', {})
+    monkeypatch.setattr(sj.__class__, '_clusters_snapshot', {})
+    scans = []
+    scan = glob.glob
+    def glob_metadata(pattern):
+        if pattern.endswith('.sparkhpc*'):
+            scans.append(pattern)
+        return scan(pattern)
+    monkeypatch.setattr(glob, 'glob', glob_metadata)
+
+    def submit(ncores):
+        job = sj.__class__(ncores=ncores, jobname='job%d'%ncores)
+        job.submit()
+        return job.jobid
+
+    pool = ThreadPool(8)
+    try:
+        jobids = pool.map(submit, range(1, 17))
+    finally:
+        pool.close()
+
+    assert(sorted(jobids) == sorted(submitted))
+    try:
+        # every job has a script of its own in its directory
+        for ncores, jobid in zip(range(1, 17), jobids):
+            with open(os.path.join(sparkhpc.sparkjob.job_dir(jobid), 'job')) as f:
+                assert(f.read() == submitted[jobid])
+            assert('job%d\n'%ncores in submitted[jobid])
+            assert(os.path.exists(os.path.join(testdir, '.sparkhpc%s'%jobid)))
+        # the template is read and the scheduler queried once for all the submissions
+        assert(len(loads) == 1)
+        assert(len(queries) == 1)
+        # and the home directory scanned once; the later clusters are registered in memory
+        assert(len(scans) == 1)
+        registered = sj.__class__._clusters_snapshot[sj.__class__][1]
+        assert(set(jobids) <= set(registered))
+        assert(sorted(registered) == registered)
+    finally:
+        for jobid in jobids:
+            os.remove(os.path.join(testdir, '.sparkhpc%s'%jobid))
+            shutil.rmtree(sparkhpc.sparkjob.job_dir(jobid))
+
+
+def test_clusterid_matches_listing(sj, monkeypatch):
+    states = {}
+    jobids = iter(range(100, 103))
+    def submit_job(cls, path):
+        jobid = str(next(jobids))
+        states[jobid] = 'RUN'
+        return jobid
+    monkeypatch.setattr(sj.__class__, '_submit_job', classmethod(submit_job))
+    monkeypatch.setattr(sj.__class__, '_query_job_states', classmethod(lambda cls: dict(states)))
+    monkeypatch.setattr(sj.__class__, '_clusters_snapshot', {})
+
+    try:
+        for i in range(2):
+            sj.__class__().submit()
+
+        # the first cluster finishes and is dropped from the listing ...
+        del states['100']
+        assert([c['jobid'] for c in sj.current_clusters(lightweight=True)] == ['101'])
+
+        # ... so the next one gets the ID the listing gives it, not its place in the older snapshot
+        clusterid = sj.__class__().submit()
+        clusters = sj.current_clusters(lightweight=True)
+        assert([c['jobid'] for c in clusters] == ['101', '102'])
+        assert(clusters[clusterid]['jobid'] == '102')
+    finally:
+        for jobid in ('100', '101', '102'):
+            if os.path.exists(os.path.join(testdir, '.sparkhpc%s'%jobid)):
+                os.remove(os.path.join(testdir, '.sparkhpc%s'%jobid))
+            shutil.rmtree(sparkhpc.sparkjob.job_dir(jobid), ignore_errors=True)
+
+
+def test_agent(sj, monkeypatch, tmpdir):
+    import threading
+    from sparkhpc import agent
+    monkeypatch.setenv('SPARKHPC_AGENT_SOCKET', str(tmpdir.join('agent.sock')))
+
+    # no agent running yet
+    assert(agent.query('states') is None)
+
+    ag = agent.Agent(sj.__class__, interval=60)
+    t = threading.Thread(target=ag.serve_forever)
+    t.start()
+    try: 
+        for i in range(100): 
+            if agent.query('states') is not None: 
+                break
+            time.sleep(0.05)
+        sj.submit()
+
+        # once the agent is up, the scheduler is no longer queried directly
+        def fail(cls):
+            raise AssertionError('scheduler queried directly')
+        monkeypatch.setattr(sj.__class__, '_query_job_states', classmethod(fail))
+        assert(sj._job_started('1'))
+        assert(agent.query('clusters') == ['1'])
+        assert(len(sj.current_clusters()) == 1)
+
+        # submissions and cancellations update the snapshot without a scheduler query
+        assert(agent.query('submitted', jobids=['7'])['7'] == 'PEND')
+        assert('7' in agent.query('states'))
+        agent.query('cancelled', jobids=['7'])
+        assert('7' not in agent.query('states'))
+
+        # nor is a socket that someone else could have put there
+        mode = tmpdir.stat().mode
+        tmpdir.chmod(0o777)
+        try:
+            assert(agent.query('states') is None)
+        finally:
+            tmpdir.chmod(mode & 0o777)
+    finally:
+        agent.query('shutdown')
+        t.join()
+    assert(agent.query('states') is None)
+
+    # the job is submitted even if the agent cannot be updated
+    def error_reply(cmd, **kwargs):
+        raise RuntimeError('sparkhpc agent: unknown command')
+    with monkeypatch.context() as m:
+        m.setattr(agent, 'query', error_reply)
+        m.setattr(sj.__class__, '_job_states', classmethod(lambda cls: {'1': 'PEND'}))
+        m.setattr(sj.__class__, '_clusters_snapshot', {})
+        sj2 = sj.__class__()
+        assert(sj2.submit() == 0 and sj2.jobid == '1')
+
+    # by default the socket is in the private runtime directory
+    monkeypatch.delenv('SPARKHPC_AGENT_SOCKET')
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmpdir))
+    assert(agent.socket_path() == str(tmpdir.join('sparkhpc-agent.sock')))
+
+
+def test_watch(sj, monkeypatch):
+    from sparkhpc import dashboard
+    try:
+        from StringIO import StringIO
+    except ImportError: 
+        from io import StringIO
+
+    sj.submit()
+    sparkhpc.sparkjob._update_endpoint(sj.jobid, master_ui='http://1.1.1.1:8080', started=time.time()-60)
+    monkeypatch.setattr(sparkhpc.sparkjob, '_master_status', lambda ui: {'aliveworkers': 2, 'cores': 8})
+
+    records = sj._cluster_records(workers=True)
+    assert(len(records) == 1)
+    assert(records[0]['workers'] == 2 and records[0]['cores_attached'] == 8)
+    assert(59 < records[0]['uptime'] < 120)
+
+    # instantiating SparkJobs on every refresh is what the dashboard avoids
+    monkeypatch.setattr(sj.__class__, '__init__', None)
+    out = StringIO()
+    dashboard.watch(sj.__class__, interval=0, iterations=2, stream=out)
+    assert('http://1.1.1.1:8080' in out.getvalue())
+    os.remove(sparkhpc.sparkjob._endpoint_filename(sj.jobid))
+
+
+def test_lightweight_clusters(sj, monkeypatch):
+    sj.submit()
+
+    # nothing may block on the master
+    def fail(*args, **kwargs): 
+        raise AssertionError('waited for the master')
+    monkeypatch.setattr(sj.__class__, '_get_master', fail)
+
+    records = sj.current_clusters(lightweight=True)
+    assert(len(records) == 1)
+    assert(records[0]['jobid'] == '1')
+    assert('RUN' in records[0]['status'])
+    assert(records[0]['master_url'] == 'pending')
+
+
+def test_application_mode(sj, tmpdir):
+    sj2 = sj.__class__(application='app.py', application_args='--input data')
+    job = sj2._job_script()
+    assert("application='app.py'" in job)
+    assert("application_args='--input data'" in job)
+
+    # the exit status of the application becomes the exit status of the job
+    bindir = tmpdir.mkdir('bin')
+    spark_submit = bindir.join('spark-submit')
+    spark_submit.write('#!/bin/sh\nexit 3\n')
+    spark_submit.chmod(0o755)
+    assert(sparkhpc.sparkjob._run_application('app.py', '', 'spark://1.1.1.1:7077', str(tmpdir)) == 3)
+
+    # the application's workers use the unpacked environment
+    spark_submit.write('#!/bin/sh\ntest "$PYSPARK_PYTHON" = /local/env/bin/python\n')
+    assert(sparkhpc.sparkjob._run_application('app.py', '', 'spark://1.1.1.1:7077', str(tmpdir), 
+                                              '/local/env/bin/python') == 0)
+
+
+def fake_notebook(tmpdir):
+    """A stand-in for the notebook package whose server only accepts connections"""
+    package = tmpdir.mkdir('fake-notebook').mkdir('notebook')
+    package.join('__init__.py').write("__version__ = '7.0.0'\n")
+    package.join('__main__.py').write('import sys, socket\n'
+                                      'args = dict([a[2:].split("=", 1) for a in sys.argv[1:] if "=" in a])\n'
+                                      'assert("ServerApp.token" in args)\n'
+                                      's = socket.socket()\n'
+                                      's.bind((args["ip"], int(args["port"])))\n'
+                                      's.listen(5)\n'
+                                      'while True:\n'
+                                      '    s.accept()[0].close()\n')
+    return str(package.dirpath())
+
+
+def test_notebook_url(sj, tmpdir, monkeypatch):
+    sj2 = sj.__class__(notebook=True)
+    assert('notebook=True' in sj2._job_script())
+
+    sj.submit()
+    assert(sj.notebook_url() is None)
+    sparkhpc.sparkjob._update_endpoint(sj.jobid, notebook_url='http://1.1.1.1:9999/?token=abc')
+    assert(sj.notebook_url() == 'http://1.1.1.1:9999/?token=abc')
+    # the token must not be readable by other users
+    assert(os.stat(sparkhpc.sparkjob._endpoint_filename(sj.jobid)).st_mode & 0o077 == 0)
+    os.remove(sparkhpc.sparkjob._endpoint_filename(sj.jobid))
+
+    # Notebook 7 runs on Jupyter Server, which takes the token under another name
+    assert(sparkhpc.sparkjob._notebook_token_option('6.5.4') == '--NotebookApp.token')
+    assert(sparkhpc.sparkjob._notebook_token_option('7.0.0') == '--ServerApp.token')
+
+    # the URL is only published once the server is listening ...
+    monkeypatch.setattr(sparkhpc.sparkjob, '_notebook_token_option', lambda: '--ServerApp.token')
+    monkeypatch.setenv('PYTHONPATH', fake_notebook(tmpdir))
+    server = sparkhpc.sparkjob._start_notebook('127.0.0.1', 'spark://1.1.1.1:7077', sj.jobid, timeout=30)
+    try:
+        assert(server.poll() is None)
+        assert(sj.notebook_url().startswith('http://127.0.0.1:'))
+    finally:
+        server.kill()
+        server.wait()
+    os.remove(sparkhpc.sparkjob._endpoint_filename(sj.jobid))
+
+    # ... and a server that does not come up is reported instead of advertised
+    monkeypatch.setenv('PYTHONPATH', str(tmpdir.mkdir('no-notebook')))
+    monkeypatch.setattr(sys, 'executable', 'false')
+    assert(sparkhpc.sparkjob._start_notebook('127.0.0.1', 'spark://1.1.1.1:7077', sj.jobid, timeout=30) is None)
+    with pytest.raises(RuntimeError):
+        sj.notebook_url()
+    os.remove(sparkhpc.sparkjob._endpoint_filename(sj.jobid))
+
+
+def test_dynamic_ports(sj, monkeypatch):
+    port = sparkhpc.sparkjob._free_port()
+    assert(0 < port < 65536)
+
+    sj.submit()
+    monkeypatch.setattr(sj.__class__, '_peek', lambda self: log_string.replace('7077', '45123').replace('8080', '45124'))
+    assert(sj.master_url() == 'spark://1.1.1.1:45123')
+    assert(sj.master_ui() == 'http://1.1.1.1:45124')
+
+
+def test_scale(sj, monkeypatch):
+    sj.submit()
+    monkeypatch.setattr(sj.__class__, '_submit_job', classmethod(lambda cls, jobfile: '5'))
+    signalled, killed = [], []
+    monkeypatch.setattr(sj.__class__, '_signal_many', classmethod(lambda cls, jobids, sig: signalled.extend(jobids)))
+    monkeypatch.setattr(sj.__class__, '_stop_many', classmethod(lambda cls, jobids: killed.extend(jobids)))
+
+    # the default cluster has 4 single-core executors
+    assert(sj.scale(6) == 6)
+    assert(sj.aux_jobs == [{'jobid': '5', 'executors': 2}])
+    with open(os.path.join(sparkhpc.sparkjob.job_dir('5'), 'job')) as f: 
+        job = f.read()
+    assert("start_workers('1'" in job)
+
+    # the auxiliary jobs are tracked in the metadata
+    assert(sj.__class__(jobid=1).aux_jobs == sj.aux_jobs)
+
+    # the original executors are never removed
+    assert(sj.scale(2, decommission_timeout=0) == 4)
+    assert(signalled == ['5'] and killed == ['5'])
+
+    sj.scale(6)
+    monkeypatch.setattr(sj.__class__, '_job_states', classmethod(lambda cls: {'1': 'RUN', '5': 'RUN'}))
+    sj.stop()
+    assert(killed == ['5', '1', '5'])
+
+
+def test_pool_lease(sj, monkeypatch):
+    import signal
+    from sparkhpc.pool import ClusterPool
+
+    pool = ClusterPool({'small': dict(ncores=2)}, size=1, sparkjob_class=sj.__class__)
+    assert(pool.maintain() == 1)
+    # the mock scheduler reports the job as running, so the pool is full
+    assert(pool.maintain() == 0)
+
+    # leases are only handed out once the master has published its address
+    with pytest.raises(RuntimeError):
+        sj.__class__.lease('small', timeout=0)
+    sparkhpc.sparkjob._update_endpoint('1', master_url='spark://1.1.1.1:7077', started=time.time())
+
+    handler = signal.getsignal(signal.SIGINT)
+    leased = sj.__class__.lease('small', timeout=0)
+    assert(leased.jobid == '1')
+    # ctrl-c in the lessee leaves the pool's cluster alone
+    assert(signal.getsignal(signal.SIGINT) == handler)
+    with pytest.raises(RuntimeError):
+        sj.__class__.lease('small', timeout=0)
+    leased.release()
+    assert(sj.__class__.lease('small', timeout=0).jobid == '1')
+    leased.release()
+
+    # a cluster that is about to be retired cannot be leased any more ...
+    killed = []
+    monkeypatch.setattr(sj.__class__, '_stop_many', classmethod(lambda cls, jobids: killed.extend(jobids)))
+    monkeypatch.setattr(sj.__class__, 'submit', lambda self: None)
+    records = [{'jobid': '1', 'pool_shape': 'small', 'leased': False, 'walltime_remaining': 60}]
+    monkeypatch.setattr(sj.__class__, '_cluster_records', classmethod(lambda cls: records))
+    acquire = sj.__class__._acquire_lease
+    def lease_meanwhile(cls, jobid):
+        # somebody leases the cluster between the pool's check and the retirement
+        acquire(jobid)
+        return acquire(jobid)
+    with monkeypatch.context() as m:
+        m.setattr(sj.__class__, '_acquire_lease', classmethod(lease_meanwhile))
+        pool.maintain()
+    assert(killed == [])
+    leased.release()
+
+    # ... a retired cluster does not leave its lease behind ...
+    pool.maintain()
+    assert(killed == ['1'])
+    assert(not os.path.exists(sparkhpc.sparkjob._lease_filename('1')))
+
+    # ... and neither does one that has ended while it was leased
+    del records[:]
+    assert(sj.__class__._acquire_lease('1'))
+    pool.maintain()
+    assert(not os.path.exists(sparkhpc.sparkjob._lease_filename('1')))
+
+    os.remove(sparkhpc.sparkjob._endpoint_filename('1'))
+
+
+def test_federation(sj, monkeypatch):
+    from sparkhpc.federation import Federation
+
+    class FakeContext(object):
+        def stop(self): 
+            pass
+
+    monkeypatch.setattr(sj.__class__, 'start_spark', lambda self, **kwargs: FakeContext())
+    sj.submit()
+
+    fed = Federation([sj, sj.__class__(jobid=1)], poll_interval=0.1)
+    assert(fed.map(lambda sc, x: x*2, range(10), chunksize=3) == [x*2 for x in range(10)])
+
+    def fail(sc, x): 
+        raise ValueError('bad item')
+    with pytest.raises(RuntimeError):
+        fed.map(fail, range(2))
+
+
+def test_resource_report(sj, tmpdir, monkeypatch):
+    from sparkhpc import sampler
+    import shutil
+
+    sj2 = sj.__class__(ncores=16, cores_per_executor=8, sample_interval=10)
+    assert('sample_interval=10' in sj2._job_script())
+    sj2.submit()
+
+    # two nodes using at most 3 of their 8 cores and 3000 MB
+    sample_dir = os.path.join(sj2.job_dir(), 'samples')
+    os.makedirs(sample_dir)
+    for node in ['node1', 'node2']:
+        with open(os.path.join(sample_dir, '%s.samples'%node), 'wb') as f:
+            f.write(sampler.HEADER.pack(sampler.MAGIC, 8, 64000, 10))
+            for i in range(10):
+                f.write(sampler.RECORD.pack(1000+10*i, 2+i/10., 3000, 1000, 0, 0, 10*i, 10*i))
+
+    summary = sj2.resource_report()
+    assert(sorted(summary['nodes']) == ['node1', 'node2'])
+    assert(summary['cores_per_executor'] == 4)
+    assert(summary['memory_per_core'] == 900)
+    assert(summary['memory_per_executor'] == 1300)
+    assert('Recommended shape' in sampler.format_report(summary))
+    shutil.rmtree(sj2.job_dir())
+
+    # the probes work on this node
+    assert(sampler._cpu_jiffies()[1] > 0)
+    assert(sampler._user_rss_mb(os.getuid()) > 0)
+
+
+def test_analyze_event_logs(sj):
+    from sparkhpc import eventlog
+    import json
+    import shutil
+
+    # one executor with 4 cores; stage 0 has 2 skewed tasks that spill, stage 1 is balanced
+    events = [{'Event': 'SparkListenerApplicationStart', 'App Name': 'test', 'Timestamp': 0},
+              {'Event': 'SparkListenerExecutorAdded', 'Executor ID': '0', 'Timestamp': 0,
+               'Executor Info': {'Total Cores': 4}},
+              {'Event': 'SparkListenerStageSubmitted',
+               'Stage Info': {'Stage ID': 0, 'Stage Attempt ID': 0, 'Stage Name': 'count', 'Number of Tasks': 2,
+                              'Submission Time': 0}}]
+    for i, duration in enumerate([5000, 60000]):
+        events.append({'Event': 'SparkListenerTaskEnd', 'Stage ID': 0, 'Stage Attempt ID': 0,
+                       'Task Info': {'Launch Time': 0, 'Finish Time': duration, 'Executor ID': '0'},
+                       'Task Metrics': {'Executor Run Time': duration, 'JVM GC Time': duration/2,
+                                        'Memory Bytes Spilled': 0, 'Disk Bytes Spilled': 200*1024*1024}})
+    events.append({'Event': 'SparkListenerStageCompleted',
+                   'Stage Info': {'Stage ID': 0, 'Stage Attempt ID': 0, 'Stage Name': 'count', 'Number of Tasks': 2,
+                                  'Submission Time': 0, 'Completion Time': 60000}})
+    events.append({'Event': 'SparkListenerApplicationEnd', 'Timestamp': 100000})
+
+    sj.submit()
+    event_log_dir = os.path.join(sj.job_dir(), 'eventlogs')
+    os.makedirs(event_log_dir)
+    with open(os.path.join(event_log_dir, 'app-1'), 'w') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+
+    result, = sj.analyze_event_logs()
+    shutil.rmtree(sj.job_dir())
+
+    assert(result['app_name'] == 'test')
+    assert(result['duration'] == 100)
+    stage = result['stages'][0]
+    assert(stage['duration'] == 60 and stage['max_task'] == 60 and stage['median_task'] == 60)
+    assert(stage['disk_spilled'] == 400*1024*1024)
+    assert(abs(result['idle_fraction'] - (1 - 65/400.)) < 1e-6)
+
+    issues = '\n'.join(result['issues'])
+    for expected in ['only 2 tasks for 4 cores', 'spilled to disk', 'garbage collection', 'idle']:
+        assert(expected in issues)
+    assert('Issues' in eventlog.format_report(result))
+
+
+
+def test_event_log_conf(sj, tmpdir):
+    conf_dir = str(tmpdir.mkdir('conf'))
+    # a job that was never submitted has no directory to keep the logs in
+    assert(sj._event_log_conf(conf_dir) == {})
+    assert(not os.path.exists(sj.job_dir()))
+
+    sj.submit()
+    conf = sj._event_log_conf(conf_dir)
+    assert(conf['spark.eventLog.enabled'] == 'true')
+    assert(conf['spark.eventLog.dir'] == 'file://' + os.path.join(sj.job_dir(), 'eventlogs'))
+
+    # a site History Server directory is not clobbered
+    with open(os.path.join(conf_dir, 'spark-defaults.conf'), 'w') as f:
+        f.write('# site defaults\nspark.eventLog.enabled   true\nspark.eventLog.dir  hdfs:///spark-history\n')
+    assert(sparkhpc.sparkjob._spark_defaults(conf_dir)['spark.eventLog.dir'] == 'hdfs:///spark-history')
+    assert(sj._event_log_conf(conf_dir, compress=True) == {})
+
+
+def test_profile_report(sj, tmpdir):
+    from sparkhpc import profiles
+    import cProfile
+    import pstats
+    import shutil
+
+    def hotspot(n):
+        return sum([i*i for i in range(n)])
+
+    # two driver runs, each with a profile for one RDD
+    sj.submit()
+    for run, n in [('run1', 3), ('run2', 5)]:
+        run_dir = os.path.join(sj.job_dir(), 'profiles', run)
+        os.makedirs(run_dir)
+        profiler = cProfile.Profile()
+        for i in range(n):
+            profiler.runcall(hotspot, 10000)
+        profiler.dump_stats(os.path.join(run_dir, 'rdd_1.pstats'))
+
+    output = str(tmpdir.join('merged.pstats'))
+    report = sj.profile_report(sort='ncalls', output=output)
+    shutil.rmtree(sj.job_dir())
+
+    assert(report['profiles'] == 2)
+    spots = dict((s['function'].split('(')[-1].rstrip(')'), s) for s in report['hotspots'])
+    assert(spots['hotspot']['ncalls'] == 8)
+    assert(pstats.Stats(output).total_calls == sum([s['ncalls'] for s in report['hotspots']]))
+    assert('hotspot' in profiles.format_report(report))
+
+
+def test_pack_env(sj, tmpdir, monkeypatch):
+    from sparkhpc import pyenv
+
+    prefix = tmpdir.mkdir('env')
+    prefix.mkdir('bin').join('python').write('#!/bin/sh\n')
+    prefix.mkdir('lib').join('module.py').write('x = 1\n')
+    cache = str(tmpdir.join('cache'))
+
+    # only virtualenv and conda environments are packed, not a system prefix
+    with pytest.raises(RuntimeError):
+        pyenv.pack(str(prefix), cache)
+    prefix.join('pyvenv.cfg').write('home = /usr/bin\n')
+
+    archive = pyenv.pack(str(prefix), cache)
+    assert(os.path.exists(archive))
+
+    # bytecode does not invalidate the cached archive, new files do
+    prefix.join('lib').mkdir('__pycache__').join('module.cpython.pyc').write('')
+    assert(pyenv.pack(str(prefix), cache) == archive)
+    prefix.join('lib').join('other.py').write('y = 2\n')
+    changed = pyenv.pack(str(prefix), cache)
+    assert(changed != archive)
+    # and so do edits that keep the size and modification time
+    st = os.stat(str(prefix.join('lib', 'module.py')))
+    prefix.join('lib').join('module.py').write('x = 2\n')
+    os.utime(str(prefix.join('lib', 'module.py')), (st.st_atime, st.st_mtime))
+    assert(pyenv.pack(str(prefix), cache) not in (archive, changed))
+
+    local_dir = str(tmpdir.join('local'))
+    python = pyenv.unpack(archive, local_dir)
+    assert(python == pyenv.local_python(archive, local_dir))
+    assert(os.path.exists(python))
+    assert(os.path.exists(os.path.join(pyenv.local_prefix(archive, local_dir), 'lib', 'module.py')))
+    # a second job on the node reuses the unpacked copy
+    assert(pyenv.unpack(archive, local_dir) == python)
+    assert(len(os.listdir(local_dir)) == 1)
+
+    monkeypatch.setattr(pyenv, 'pack', lambda: archive)
+    sj2 = sj.__class__(ncores=4, pack_env=True)
+    assert('python_env=%r'%archive in sj2._job_script())
+    assert('python_env=None' in sj._job_script())
+
+
+def fake_spark(tmpdir, monkeypatch):
+    """A stand-in for spark whose master prints its addresses and whose workers just wait"""
+    spark_home = tmpdir.mkdir('spark')
+    sbin = spark_home.mkdir('sbin')
+    sbin.join('start-master.sh').write('#!/bin/sh\n'
+                                       'echo "Starting Spark master at spark://$SPARK_MASTER_HOST:$SPARK_MASTER_PORT"\n'
+                                       'echo "Started MasterWebUI at http://$SPARK_MASTER_HOST:$SPARK_MASTER_WEBUI_PORT"\n'
+                                       'exec sleep 600\n')
+    # like spark-daemon.sh, the script runs the worker as its child; it records the worker's environment
+    sbin.join('start-slave.sh').write('#!/bin/sh\nenv > %s/worker-env.$$\nsleep 6017\n'%tmpdir)
+    for f in sbin.listdir():
+        f.chmod(0o755)
+
+    # the job process looks for the metadata in the same home directory as the tests
+    monkeypatch.setenv('HOME', os.path.abspath(testdir))
+    monkeypatch.setattr(sparkhpc.sparkjob, 'sparkjob', sparkhpc.sparkjob._sparkjob_factory('local'))
+    return spark_home
+
+
+def remove_local_cluster(sj):
+    sj.stop()
+    start_time = time.time()
+    while sj._alive(sj.jobid) and time.time() - start_time < 10:
+        time.sleep(0.1)
+    for f in ['.sparkhpc%s'%sj.jobid, '.sparkhpc%s.endpoint'%sj.jobid]:
+        if os.path.exists(os.path.join(testdir, f)):
+            os.remove(os.path.join(testdir, f))
+    os.remove('sparkcluster-%s.log'%sj.jobid)
+    shutil.rmtree(sj.job_dir(), ignore_errors=True)
+
+
+def read_worker_envs(tmpdir, count):
+    """Wait for `count` workers to start and return their environments"""
+    for i in range(100):
+        if len(tmpdir.listdir('worker-env.*')) == count:
+            break
+        time.sleep(0.1)
+    assert(len(tmpdir.listdir('worker-env.*')) == count)
+    return [dict([line.split('=', 1) for line in f.read().split('\n') if '=' in line])
+            for f in tmpdir.listdir('worker-env.*')]
+
+
+def test_local_backend(tmpdir, monkeypatch):
+    from sparkhpc.localsparkjob import LocalSparkJob
+
+    spark_home = fake_spark(tmpdir, monkeypatch)
+    monkeypatch.setenv('PYTHONPATH', fake_notebook(tmpdir))
+    assert(sparkhpc.sparkjob.sparkjob is LocalSparkJob)
+
+    with pytest.raises(RuntimeError):
+        LocalSparkJob(ncores=2, spark_home=str(spark_home), chain=1)
+    # an interface other than the one the node's name resolves to stands in for the fabric
+    import socket
+    from sparkhpc import interconnect
+    node_address = socket.gethostbyname(socket.gethostname())
+    fabric = [(name, address) for name, address in sorted(interconnect.interface_addresses().items()) 
+              if address != node_address][0]
+    sj = LocalSparkJob(ncores=2, spark_home=str(spark_home), master_log_dir=str(tmpdir), 
+                       interface=fabric[0], notebook=True)
+    assert('for i in $(seq 2)' in sparkhpc.sparkjob.get_launch_commands('local')[1].format(
+        spark_home='', master_url='', cores_per_executor=1, number_of_executors=2))
+    sj.submit()
+    try:
+        assert(sj.jobid == str(int(sj.jobid)))
+        assert(sj.job_started())
+        assert(sj.master_url().startswith('spark://'))
+        assert(sj.master_ui().startswith('http://'))
+        # spark uses the selected interface, the notebook the node's default address
+        assert(sj.master_url().startswith('spark://%s:'%fabric[1]))
+        for i in range(100):
+            if sj.notebook_url() is not None:
+                break
+            time.sleep(0.1)
+        assert(sj.notebook_url().startswith('http://%s:'%node_address))
+
+        # the launch environment exports the ports published in the endpoint record
+        ports = sparkhpc.sparkjob._read_endpoint(sj.jobid)['ports']
+        assert(sj.master_url().endswith(':%d'%ports['master']))
+        assert(sj.master_ui().endswith(':%d'%ports['master_ui']))
+        for environ in read_worker_envs(tmpdir, 2):
+            assert(environ['SPARK_MASTER_PORT'] == str(ports['master']))
+            assert(environ['SPARK_MASTER_WEBUI_PORT'] == str(ports['master_ui']))
+            assert(environ['SPARK_WORKER_PORT'] == str(ports['worker']))
+            assert(environ['SPARK_WORKER_WEBUI_PORT'] == str(ports['worker_ui']))
+        records = LocalSparkJob.current_clusters(lightweight=True)
+        assert([r['jobid'] for r in records] == [sj.jobid])
+        assert(records[0]['walltime_remaining'] > 0)
+    finally:
+        remove_local_cluster(sj)
+
+    assert(not LocalSparkJob._alive(sj.jobid))
+    assert(LocalSparkJob.current_clusters() == [])
+
+    # the workers go down with the job
+    start_time = time.time()
+    while len(find_processes(b'sleep\x006017\x00')) > 0 and time.time() - start_time < 10:
+        time.sleep(0.1)
+    assert(find_processes(b'sleep\x006017\x00') == [])
+
+
+def test_local_clusters_share_node(tmpdir, monkeypatch):
+    from sparkhpc.localsparkjob import LocalSparkJob
+
+    # two single-worker clusters on one machine, as on a shared node
+    spark_home = fake_spark(tmpdir, monkeypatch)
+    clusters = []
+    try:
+        for i in range(2):
+            sj = LocalSparkJob(ncores=1, spark_home=str(spark_home), master_log_dir=str(tmpdir))
+            sj.submit()
+            clusters.append(sj)
+        for sj in clusters:
+            assert(sj.master_url().startswith('spark://'))
+        # neither asks for the shuffle service on the fixed port unless told to
+        for environ in read_worker_envs(tmpdir, 2):
+            assert('7337' not in environ.get('SPARK_WORKER_OPTS', ''))
+        for sj in clusters:
+            assert('shuffle_service_port' not in sparkhpc.sparkjob._read_endpoint(sj.jobid))
+    finally:
+        for sj in clusters:
+            remove_local_cluster(sj)
+
+
+def find_processes(cmdline):
+    found = []
+    for path in glob.glob('/proc/[0-9]*/cmdline'):
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == cmdline:
+                    found.append(path)
+        except (IOError, OSError):
+            pass
+    return found
+
+
+def test_stop_local_workers(monkeypatch):
+    import signal
+    monkeypatch.setattr(signal, 'signal', lambda signum, handler: None)
+
+    # workers backgrounded by the loop outlive the loop shell unless their process group is signalled
+    workers = sparkhpc.sparkjob._launch_workers('for i in 1 2; do sh -c "sleep 6018" & done; wait', None, 'local')
+    start_time = time.time()
+    while len(find_processes(b'sleep\x006018\x00')) < 2 and time.time() - start_time < 10:
+        time.sleep(0.05)
+    assert(len(find_processes(b'sleep\x006018\x00')) == 2)
+    sparkhpc.sparkjob._stop_workers(workers)
+    workers.wait()
+    start_time = time.time()
+    while len(find_processes(b'sleep\x006018\x00')) > 0 and time.time() - start_time < 10:
+        time.sleep(0.05)
+    assert(find_processes(b'sleep\x006018\x00') == [])
+
+
+def test_stage_inputs(sj, tmpdir):
+    from sparkhpc import staging
+
+    data = tmpdir.mkdir('data')
+    data.join('a.csv').write('1,2\n')
+    data.join('b.csv').write('3,4\n'*1000)
+    data.mkdir('table').join('part-0').write('x')
+    stage_dir = str(tmpdir.join('local'))
+
+    patterns = [str(data.join('*.csv')), str(data.join('table'))]
+    paths = staging.local_paths(patterns, stage_dir)
+    assert(paths[str(data.join('a.csv'))] == os.path.join(stage_dir, 'a.csv'))
+    assert(paths[str(data.join('table'))] == os.path.join(stage_dir, 'table'))
+
+    assert(staging.copy(patterns, stage_dir, verify=True) == 4+4000+1)
+    assert(open(os.path.join(stage_dir, 'table', 'part-0')).read() == 'x')
+    # a second attempt on the same node copies nothing
+    assert(staging.copy(patterns, stage_dir) == 0)
+    staging.clean(stage_dir)
+    assert(not os.path.exists(stage_dir))
+
+    with pytest.raises(RuntimeError):
+        staging.local_paths([str(data.join('*.parquet'))], stage_dir)
+
+    sj2 = sj.__class__(ncores=4, stage=patterns, stage_verify=True)
+    script = sj2._job_script()
+    assert('stage=%r'%patterns in script and 'stage_verify=True' in script and 'stage_cleanup=True' in script)
+
+
+def test_dynamic_allocation_conf(sj):
+    sj2 = sj.__class__(ncores=16, cores_per_executor=4)
+    sj2.prop_dict['aux_jobs'] = [{'jobid': '2', 'executors': 2}]
+
+    conf = sj2._dynamic_allocation_conf({'shuffle_service_port': 40000}, min_executors=1)
+    assert(conf['spark.dynamicAllocation.maxExecutors'] == '6')
+    assert(conf['spark.dynamicAllocation.minExecutors'] == '1')
+    assert(conf['spark.executor.cores'] == '4')
+    assert(conf['spark.shuffle.service.port'] == '40000')
+
+    # the service takes a fixed port on every node, so it has to be asked for
+    assert('shuffle_service=False' in sj._job_script())
+    assert('shuffle_service=True' in sj.__class__(ncores=4, shuffle_service=True)._job_script())
+
+    # clusters without a shuffle service fall back to shuffle tracking
+    conf = sj2._dynamic_allocation_conf(None, max_executors=2)
+    assert(conf['spark.dynamicAllocation.maxExecutors'] == '2')
+    assert('spark.shuffle.service.enabled' not in conf)
+    assert(conf['spark.dynamicAllocation.shuffleTracking.enabled'] == 'true')
+
+
+def test_drain(sj, tmpdir, monkeypatch):
+    import subprocess
+    import signal
+
+    sj2 = sj.__class__(ncores=4, drain=5, checkpoint_dir=str(tmpdir))
+    script = sj2._job_script()
+    if isinstance(sj2, sparkhpc.SLURMSparkJob):
+        assert('#SBATCH --signal=B:USR1@300' in script)
+    else:
+        assert('#BSUB -wa URG' in script and '#BSUB -wt 5' in script)
+    assert('drain=5' in script and 'checkpoint_dir=%r'%str(tmpdir) in script)
+    # worker-only jobs do not drain themselves
+    sj2.submit()
+    assert('USR1' not in sj2._worker_script(2) and 'URG' not in sj2._worker_script(2))
+
+    saved = []
+    sj2.on_drain(saved.append, poll_interval=0.1)
+    assert(not sj2.draining())
+
+    # the walltime warning: no applications are running, so the workers are decommissioned right away
+    signals = []
+    with monkeypatch.context() as m:
+        m.setattr(sj2.__class__, '_signal_many', classmethod(lambda cls, jobids, name: signals.append((jobids, name))))
+        m.setattr(sparkhpc.sparkjob, 'sparkjob', sj2.__class__)
+        m.setattr(time, 'sleep', lambda t: None)
+        m.setattr(signal, 'signal', lambda signum, handler: None)
+        workers = subprocess.Popen(['sleep', '60'])
+        supervised = [True]
+        class Supervisor(object):
+            def stop(self):
+                supervised.remove(True)
+        sparkhpc.sparkjob._drain(sj2.jobid, None, workers, 5, str(tmpdir), Supervisor())
+        assert(workers.wait() != 0)
+    # the master is no longer restarted once the cluster drains
+    assert(supervised == [])
+    assert(signals == [([sj2.jobid], 'PWR')])
+    assert(sj2.draining())
+    start_time = time.time()
+    while len(saved) == 0 and time.time() - start_time < 5:
+        time.sleep(0.1)
+    assert(saved == [str(tmpdir)])
+
+    with pytest.raises(RuntimeError):
+        sj2.start_spark()
+    assert(sj2.load_checkpoint(None, 'missing') is None)
+    os.remove(os.path.join(testdir, '.sparkhpc%s.endpoint'%sj2.jobid))
+
+
+def test_interface_selection(sj, monkeypatch):
+    from sparkhpc import interconnect
+
+    addresses = {'lo': '127.0.0.1', 'eth0': '192.168.1.10', 'ib0': '10.20.3.4', 'ib1': '10.21.0.5'}
+    assert(interconnect.select_address('ib0', addresses) == '10.20.3.4')
+    assert(interconnect.select_address('hsn*,ib*', addresses) == '10.20.3.4')
+    assert(interconnect.select_address('10.21.0.0/16,ib0', addresses) == '10.21.0.5')
+    assert(interconnect.select_address('hsn0', addresses) is None)
+    assert('lo' in interconnect.interface_addresses())
+
+    # a node without the interface drops the address inherited from the master's node
+    monkeypatch.setattr(interconnect, 'interface_addresses', lambda: addresses)
+    environ = {'SPARK_LOCAL_IP': '10.20.0.1', 'SPARK_LOCAL_HOSTNAME': '10.20.0.1'}
+    assert(interconnect.apply('hsn0', environ) is None and environ == {})
+    assert(interconnect.apply('ib*', environ) == '10.20.3.4' and environ['SPARK_LOCAL_IP'] == '10.20.3.4')
+
+    master, workers = sparkhpc.sparkjob.get_launch_commands('slurm', 'ib0,ib*')
+    assert("-m sparkhpc.interconnect 'ib0,ib*' {spark_home}/sbin/start-slave.sh" in workers)
+    assert("interface='ib0'" in sj.__class__(ncores=4, interface='ib0')._job_script())
+
+
+def test_master_recovery(sj, tmpdir, monkeypatch):
+    import subprocess
+    import signal
+
+    assert('master_restarts=3' in sj._job_script())
+    sj.submit()
+
+    # the master state goes to the recovery directory
+    monkeypatch.delenv('SPARK_MASTER_OPTS', raising=False)
+    sparkhpc.sparkjob._enable_master_recovery(str(tmpdir.join('recovery')))
+    assert('-Dspark.deploy.recoveryMode=FILESYSTEM' in os.environ['SPARK_MASTER_OPTS'])
+    assert(tmpdir.join('recovery').check(dir=True))
+
+    # a master that prints its addresses once it is up
+    log = str(tmpdir.join('master.out'))
+    master, url, ui = sparkhpc.sparkjob._start_master(
+        'sh -c "echo spark://node1:7077 http://node1:8080; exec sleep 60"', log, 10)
+    assert((url, ui) == ('spark://node1:7077', 'http://node1:8080'))
+    # the walltime warning and the decommissioning signal that LSF sends to the whole job leave the master alone
+    if os.path.exists('/proc/%d/status'%master.pid):
+        with open('/proc/%d/status'%master.pid) as f:
+            ignored = int([l for l in f if l.startswith('SigIgn:')][0].split()[1], 16)
+        for signum in (signal.SIGURG, signal.SIGPWR):
+            assert(ignored & (1 << (signum - 1)))
+    master.kill()
+    master.wait()
+    with pytest.raises(RuntimeError):
+        sparkhpc.sparkjob._start_master('false', log, 10)
+
+    # a master restarted on another node does not inherit this node's address ...
+    monkeypatch.setenv('SPARK_LOCAL_IP', '10.20.0.1')
+    master, url, ui = sparkhpc.sparkjob._start_master(
+        'sh -c "echo spark://$SPARK_MASTER_HOST:7077 http://node2:8080 local=${SPARK_LOCAL_IP:-unset}; exec sleep 60"', 
+        log, 10, 'node2')
+    master.kill()
+    master.wait()
+    with open(log) as f:
+        assert(url == 'spark://node2:7077' and 'local=unset' in f.read())
+    # ... but resolves the interface again over there
+    command = sparkhpc.sparkjob._remote_master_command('slurm', 'node2', '/spark/sbin/start-master.sh', 'ib0,ib*')
+    assert(command.endswith("--nodelist=node2 %s -m sparkhpc.interconnect --master 'ib0,ib*' /spark/sbin/start-master.sh"%sys.executable))
+    from sparkhpc import interconnect
+    monkeypatch.setattr(interconnect, 'interface_addresses', lambda: {'ib0': '10.20.3.4'})
+    environ = {'SPARK_MASTER_HOST': 'node2'}
+    assert(interconnect.apply('ib0', environ, master=True) == '10.20.3.4')
+    assert(environ == {'SPARK_MASTER_HOST': '10.20.3.4', 'SPARK_LOCAL_IP': '10.20.3.4', 'SPARK_LOCAL_HOSTNAME': '10.20.3.4'})
+
+    # the master cannot be restarted on this node, so it moves to the next one
+    tried = []
+    def restart(host, attempt):
+        tried.append(host)
+        if host is None:
+            raise RuntimeError('port in use')
+        return subprocess.Popen(['sleep', '60']), 'spark://%s:7077'%host, 'http://%s:8080'%host
+    failed = []
+    supervisor = sparkhpc.sparkjob._MasterSupervisor(master, restart, sj.jobid, 1, ['node2', 'node3'],
+                                                     on_failure=lambda: failed.append(True))
+    assert(supervisor.check())
+    assert(tried == [None, 'node2'])
+    assert(sj.master_url() == 'spark://node2:7077')
+    endpoint = sparkhpc.sparkjob._read_endpoint(sj.jobid)
+    assert(endpoint['master_host'] == 'node2' and endpoint['master_restarts'] == 1)
+
+    # after max_restarts the supervisor gives up and releases the workers
+    new_master = supervisor.master
+    new_master.kill()
+    new_master.wait()
+    assert(not supervisor.check())
+    assert(failed == [True])
+    assert(supervisor.stop() is new_master)
+    os.remove(os.path.join(testdir, '.sparkhpc%s.endpoint'%sj.jobid))
+
+
+def test_history(sj):
+    from sparkhpc import history
+
+    sj.submit()
+    path = history.store_path('slurm' if isinstance(sj, sparkhpc.SLURMSparkJob) else 'lsf')
+    try:
+        # only the finished sparkhpc job is kept
+        records = sj.__class__.history()
+        assert([r['jobid'] for r in records] == ['1'])
+        r = records[0]
+        assert((r['wait'], r['runtime'], r['max_rss']) == (300, 1800, 2048))
+        assert(r['cpu_efficiency'] == 0.5 and r['walltime_fraction'] == 1.0)
+        assert(r['parameters']['ncores'] == sj.ncores)
+
+        # the records are fetched only once and outlive the metadata
+        assert(history.update(sj.__class__, 'slurm' if isinstance(sj, sparkhpc.SLURMSparkJob) else 'lsf') == 0)
+        os.remove(os.path.join(testdir, '.sparkhpc1'))
+        assert(len(sj.__class__.history(refresh=False)) == 1)
+
+        summary = history.summarize(records)
+        assert(len(summary) == 1 and summary[0]['jobs'] == 1 and summary[0]['failed'] == 0)
+        assert(summary[0]['shape']['walltime'] == 30)
+        assert('50.0' in history.format_report(summary))
+    finally:
+        os.remove(path)